@@ -0,0 +1,355 @@
+"""End-to-end benchmark of capture path from remote tcpdump to packet analyzer.
+
+Starts local paramiko SSH server whose tcpdump emits synthetic pcap stream at given rate
+and packet size mix, runs ToolRunner against it with counting FIFO consumer in place of
+wireshark/sngrep and reports sustained Mbit/s, packets/s, time to first packet, shutdown
+latency and CPU seconds per second of capture of each stage. Runs offline.
+
+    python benchmarks/bench_end_to_end.py [--duration S] [--rate MBIT] [--sizes SIZE:WEIGHT,...]
+                                          [--modes MODE,...] [--json FILE]
+
+Modes: pump, pump-zstd, pump-lz4, pump-gzip, pump-tee (two consumers), pump-file (consumer
+and file), sshdump (requires wireshark extcap sshdump). Unavailable modes are skipped.
+"""
+import json
+import logging
+import os
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+from argparse import SUPPRESS, ArgumentParser
+from pathlib import Path
+from time import monotonic, process_time, sleep
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import paramiko
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# pylint: disable=wrong-import-position
+from remote_pcap.compression import local_decompressors  # noqa: E402
+from remote_pcap.connection import connect_client  # noqa: E402
+from remote_pcap.process_runner import ProcessRunner  # noqa: E402
+from remote_pcap.remote_command import CaptureOptions  # noqa: E402
+from remote_pcap.sshdump_runner import SSHDumpRunner  # noqa: E402
+from remote_pcap.tool_runner import ToolRunner  # noqa: E402
+
+# pylint: enable=wrong-import-position
+
+USER = 'bench'
+PASSWORD = 'bench'
+
+# Mode: transport, analyzers, compression, write file
+MODES = {
+    'pump': ('pump', ['wireshark'], 'none', False),
+    'pump-zstd': ('pump', ['wireshark'], 'zstd', False),
+    'pump-lz4': ('pump', ['wireshark'], 'lz4', False),
+    'pump-gzip': ('pump', ['wireshark'], 'gzip', False),
+    'pump-tee': ('pump', ['wireshark', 'sngrep'], 'none', False),
+    'pump-file': ('pump', ['wireshark'], 'none', True),
+    'sshdump': ('sshdump', ['wireshark'], 'none', False),
+}
+
+# Internet mix of packet sizes with weights
+DEFAULT_SIZES = '64:7,576:4,1500:1'
+
+STAND_INS = str(Path(__file__).resolve().with_name('stand_ins.py'))
+
+
+class BenchServer(paramiko.ServerInterface):
+
+    def __init__(self, environment: Dict[str, str]):
+        self.environment = environment
+        self.processes: List[subprocess.Popen] = []
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL if (username, password) == (USER, PASSWORD) \
+            else paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self.execute, args=(channel, command.decode()),
+                         daemon=True).start()
+        return True
+
+    def execute(self, channel: paramiko.Channel, command: str):
+        # Command is not left running as orphan of shell, so its CPU time is counted
+        # pylint: disable-next=consider-using-with
+        process = subprocess.Popen(['sh', '-c', f'exec {command}'], stdin=subprocess.DEVNULL,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   env=self.environment)
+        self.processes.append(process)
+        assert process.stdout is not None and process.stderr is not None
+        forward = threading.Thread(target=self.forward,
+                                   args=(process.stderr.fileno(), channel.sendall_stderr),
+                                   daemon=True)
+        forward.start()
+        try:
+            self.forward(process.stdout.fileno(), channel.sendall)
+        except (OSError, EOFError, paramiko.SSHException):
+            # Closed output stops whole pipeline by SIGPIPE, like in sshd
+            process.stdout.close()
+        forward.join(1)
+        try:
+            returncode = process.wait()
+            channel.send_exit_status(returncode if returncode >= 0 else 128 - returncode)
+        finally:
+            channel.close()
+
+    @staticmethod
+    def forward(fd: int, send: Callable[[bytes], None]):
+        while chunk := os.read(fd, 1024 * 1024):
+            send(chunk)
+
+    def usage(self) -> Dict[str, float]:
+        for process in self.processes:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+        times = os.times()
+        return {'sshd': times.user + times.system,
+                'tcpdump': times.children_user + times.children_system}
+
+
+def serve(workdir: str, host_key: str):
+    # Stand-in for remote host: "sudo" and "tcpdump" come from work directory, CPU time of
+    # server and its commands is printed on SIGTERM
+    environment = dict(os.environ, PATH=f'{workdir}:{os.environ["PATH"]}')
+    key = paramiko.RSAKey.from_private_key_file(host_key)
+    server = BenchServer(environment)
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(8)
+
+    def report(_signum, _frame):
+        print(json.dumps(server.usage()), flush=True)
+        os._exit(0)  # pylint: disable=protected-access
+    signal.signal(signal.SIGTERM, report)
+    print(listener.getsockname()[1], flush=True)
+    while True:
+        connection, _ = listener.accept()
+        transport = paramiko.Transport(connection)
+        transport.add_server_key(key)
+        transport.start_server(server=server)
+
+
+class CountingConsumer(ProcessRunner):
+
+    def __init__(self, name: str, pipename: str, result_path: str):
+        super().__init__(name)
+        self.pipename = pipename
+        self.result_path = result_path
+
+    @property
+    def args(self):
+        return [sys.executable, STAND_INS, 'consume', self.pipename, self.result_path]
+
+    def handle_stdout(self, data: str):
+        self.logger.debug(data)
+
+    def handle_stderr(self, data: str):
+        self.logger.error(data)
+
+
+class BenchRunner(ToolRunner):
+
+    def __init__(self, name: str, workdir: str, **kwargs):
+        super().__init__(name, **kwargs)
+        self.workdir = workdir
+
+    # pylint: disable-next=arguments-differ
+    def create_analyzer(self, analyzer_type: str, fifo_path: str):  # type: ignore[override]
+        return CountingConsumer(analyzer_type, fifo_path,
+                                os.path.join(self.workdir, f'{analyzer_type}.json'))
+
+
+class ThreadSampler(threading.Thread):
+    # CPU time of threads of capture path by stage, threads may exit before end of run
+
+    def __init__(self, interval: float = 0.1):
+        super().__init__(name='sampler', daemon=True)
+        self.interval = interval
+        self.cpu: Dict[int, Tuple[str, float]] = {}
+        self._need_stop = threading.Event()
+        # Threads started before capture are counted from now
+        self.sample()
+        self.baseline = {native_id: cpu for native_id, (_, cpu) in self.cpu.items()}
+
+    @staticmethod
+    def stage(thread: threading.Thread) -> str:
+        if isinstance(thread, paramiko.Transport):
+            return 'ssh'
+        if thread.name.startswith('dumper'):
+            return 'pump'
+        return thread.name.split('.')[0]
+
+    def sample(self):
+        ticks = os.sysconf('SC_CLK_TCK')
+        for thread in threading.enumerate():
+            if thread in (self, threading.main_thread()) or thread.native_id is None:
+                continue
+            try:
+                stat = Path(f'/proc/self/task/{thread.native_id}/stat').read_text(encoding='ascii')
+            except OSError:
+                continue
+            fields = stat.rsplit(')', 1)[1].split()
+            self.cpu[thread.native_id] = (self.stage(thread),
+                                          (int(fields[11]) + int(fields[12])) / ticks)
+
+    def run(self):
+        while not self._need_stop.wait(self.interval):
+            self.sample()
+
+    def stop(self) -> Dict[str, float]:
+        self._need_stop.set()
+        self.sample()
+        stages: Dict[str, float] = {}
+        for native_id, (stage, cpu) in self.cpu.items():
+            stages[stage] = stages.get(stage, 0.0) + cpu - self.baseline.get(native_id, 0.0)
+        return stages
+
+
+def mode_available(mode: str) -> Optional[str]:
+    # Returns reason to skip mode
+    transport, _, compression, _ = MODES[mode]
+    if transport == 'sshdump' and not os.path.exists(
+            SSHDumpRunner('sshdump', '', '', 0, '', '', password='-').args[0]):
+        return 'sshdump is not installed'
+    if compression != 'none':
+        if compression not in local_decompressors() or \
+                subprocess.run(['sh', '-c', f'command -v {compression}'], capture_output=True,
+                               check=False).returncode:
+            return f'{compression} is not available'
+    return None
+
+
+def start_server(workdir: str, host_key: str, rate: float, sizes: str) \
+        -> Tuple[subprocess.Popen, int]:
+    environment = dict(os.environ, BENCH_RATE=str(rate), BENCH_SIZES=sizes)
+    # pylint: disable-next=consider-using-with
+    server = subprocess.Popen([sys.executable, __file__, '--serve', workdir, host_key],
+                              stdout=subprocess.PIPE, env=environment, text=True)
+    assert server.stdout is not None
+    return server, int(server.stdout.readline())
+
+
+def stop_server(server: subprocess.Popen) -> Dict[str, float]:
+    server.send_signal(signal.SIGTERM)
+    assert server.stdout is not None
+    usage = json.loads(server.stdout.readline() or '{}')
+    server.wait()
+    return usage
+
+
+# pylint: disable-next=too-many-locals
+def run_mode(mode: str, workdir: str, host_key: str, args) -> Dict[str, Any]:
+    transport, analyzers, compression, write_file = MODES[mode]
+    server, port = start_server(workdir, host_key, args.rate, args.sizes)
+    client = connect_client('127.0.0.1', port, USER, PASSWORD, None)
+    outputs = [os.path.join(workdir, 'capture.pcap')] if write_file else []
+    runner = BenchRunner('runner', workdir, hostname='127.0.0.1', port=port, user=USER,
+                         password=PASSWORD, identityfile=None, interface='eth0',
+                         analyzer=analyzers, tcpdump_path=os.path.join(workdir, 'tcpdump'),
+                         capture_options=CaptureOptions(compression=compression),
+                         transport=transport, client=client, outputs=outputs)
+    sampler = ThreadSampler()
+    started_cpu = process_time()
+    sampler.start()
+    started = monotonic()
+    runner.start()
+    sleep(args.duration)
+
+    stages = sampler.stop()
+    local_cpu = process_time() - started_cpu
+    stop_started = monotonic()
+    runner.stop()
+    runner.join()
+    for analyzer in runner.analyzers:
+        analyzer.exited.wait(10)
+    shutdown = monotonic() - stop_started
+    client.close()
+    stages.update(stop_server(server))
+
+    received = [json.loads(Path(workdir, f'{analyzer}.json').read_text(encoding='utf-8'))
+                for analyzer in analyzers]
+    consumer = received[0]
+    elapsed = (consumer['last'] or started) - (consumer['first'] or started)
+    stages['analyzer'] = sum(result['cpu'] for result in received)
+    stages['local'] = local_cpu
+    capture_seconds = stop_started - started
+    return {
+        'mode': mode,
+        'bytes': consumer['bytes'],
+        'packets': consumer['packets'],
+        'mbit_per_second': consumer['bytes'] * 8 / elapsed / 1e6 if elapsed else 0.0,
+        'packets_per_second': consumer['packets'] / elapsed if elapsed else 0.0,
+        'first_packet_ms': ((consumer['first'] or stop_started) - started) * 1000,
+        'shutdown_ms': shutdown * 1000,
+        'cpu': {stage: cpu / capture_seconds for stage, cpu in sorted(stages.items())},
+    }
+
+
+def prepare_workdir(workdir: str) -> str:
+    tcpdump = Path(workdir, 'tcpdump')
+    tcpdump.write_text(f'#!/bin/sh\nexec {shlex.quote(sys.executable)} {shlex.quote(STAND_INS)} '
+                       f'generate "$BENCH_RATE" "$BENCH_SIZES"\n')
+    sudo = Path(workdir, 'sudo')
+    sudo.write_text('#!/bin/sh\nwhile [ "${1#-}" != "$1" ]; do shift; done\nexec "$@"\n')
+    tcpdump.chmod(0o755)
+    sudo.chmod(0o755)
+    host_key = os.path.join(workdir, 'host_key')
+    paramiko.RSAKey.generate(2048).write_private_key_file(host_key)
+    return host_key
+
+
+def print_results(results: List[Dict[str, Any]]):
+    print(f'{"MODE":<10} {"MBIT/S":>9} {"PACKETS/S":>11} {"FIRST MS":>9} {"STOP MS":>8}  '
+          f'CPU S/S')
+    for result in results:
+        cpu = ' '.join(f'{stage}={value:.2f}' for stage, value in result['cpu'].items()
+                       if value >= 0.005)
+        print(f'{result["mode"]:<10} {result["mbit_per_second"]:>9,.1f} '
+              f'{result["packets_per_second"]:>11,.0f} {result["first_packet_ms"]:>9.1f} '
+              f'{result["shutdown_ms"]:>8.1f}  {cpu}')
+
+
+def main():
+    parser = ArgumentParser(description='End-to-end benchmark of capture path')
+    parser.add_argument('--duration', type=float, default=5.0, help='Seconds of each mode')
+    parser.add_argument('--rate', type=float, default=0.0,
+                        help='Stream rate in Mbit/s, 0 for as fast as possible')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='Packet sizes with weights')
+    parser.add_argument('--modes', default=','.join(MODES), help='Comma separated modes')
+    parser.add_argument('--json', type=str, help='Write results to JSON file')
+    parser.add_argument('--serve', nargs=2, help=SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(*args.serve)
+
+    logging.basicConfig(level=logging.WARNING)
+    results = []
+    with tempfile.TemporaryDirectory(prefix='bench_end_to_end') as workdir:
+        host_key = prepare_workdir(workdir)
+        for mode in args.modes.split(','):
+            if reason := mode_available(mode):
+                print(f'{mode}: skipped, {reason}')
+                continue
+            results.append(run_mode(mode, workdir, host_key, args))
+    print(f'{args.duration:.0f} s per mode, rate {args.rate or "unlimited"} Mbit/s, '
+          f'sizes {args.sizes}')
+    print_results(results)
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2), encoding='utf-8')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""Micro-benchmark of wireshark/sshdump log line handling.
+
+Compares line handling before single-pass parser (regex per field on sliced copies,
+localtime() and mktime() per line) with current WiresharkRunner/SSHDumpRunner.
+
+    python benchmarks/bench_log_parser.py [--repeat N] [--level LEVEL]
+"""
+import logging
+import re
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+from time import localtime, mktime, perf_counter, struct_time
+from typing import Callable, Dict, List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# pylint: disable-next=wrong-import-position
+from remote_pcap.log_parser import LOG_LEVELS  # noqa: E402
+# pylint: disable-next=wrong-import-position
+from remote_pcap.sshdump_runner import SSHDumpRunner  # noqa: E402
+# pylint: disable-next=wrong-import-position
+from remote_pcap.wireshark_runner import WiresharkRunner  # noqa: E402
+
+DATA_DIR = Path(__file__).resolve().parent / 'data'
+
+process_timestamp = re.compile(r'\*\* \((?P<process>\w+):(?P<pid>\d+)\) '
+                               r'(?P<hour>\d\d):(?P<mins>\d\d):(?P<secs>\d\d)\.'
+                               r'(?P<microsecs>\d{6}) ')
+subsystem_level = re.compile(r'\[(?P<subsystem>\w+) (?P<level>\w+)\] ')
+level_without_subsystem = re.compile(r'\[\(none\) (?P<level>\w+)\] ')
+filename_lineno_func_msg = re.compile(r'(?P<filename>[^:]+):(?P<lineno>\d+) -- '
+                                      r'(?P<function>\w+\(\)): (?P<message>.+)')
+only_message = re.compile(r'-- (?P<message>.+)')
+
+
+class LegacyParseError(Exception):
+    pass
+
+
+class LegacyHandler():
+    """Line handling as it was done before single-pass parser."""
+
+    def __init__(self, logger: logging.Logger, allow_no_subsystem: bool):
+        self.logger = logger
+        self.allow_no_subsystem = allow_no_subsystem
+
+    def parse_message(self, data: str) -> Dict:
+        parsed_message = {}
+        starpos = 0
+        endpos = len(data)
+
+        if match_obj := process_timestamp.match(data[starpos:endpos]):
+            parsed_message.update(match_obj.groupdict())
+            starpos += match_obj.end()
+        else:
+            raise LegacyParseError(f'Failed to parse log message: "{data}"')
+
+        if match_obj := subsystem_level.match(data[starpos:endpos]):
+            parsed_message.update(match_obj.groupdict())
+            starpos += match_obj.end()
+        elif self.allow_no_subsystem and \
+                (match_obj := level_without_subsystem.match(data[starpos:endpos])):
+            parsed_message.update(match_obj.groupdict())
+            parsed_message['subsystem'] = 'wireshark'
+            starpos += match_obj.end()
+        else:
+            raise LegacyParseError(f'Failed to parse log message: "{data}"')
+
+        if match_obj := filename_lineno_func_msg.match(data[starpos:endpos]):
+            parsed_message.update(match_obj.groupdict())
+        elif match_obj := only_message.match(data[starpos:endpos]):
+            parsed_message.update(match_obj.groupdict())
+            parsed_message.update({'filename': parsed_message['subsystem'],
+                                   'lineno': 0,
+                                   'function': parsed_message['subsystem']})
+        else:
+            raise LegacyParseError(f'Failed to parse log message: "{data}"')
+        return parsed_message
+
+    def message_to_logrecord(self, data: str) -> logging.LogRecord:
+        current = localtime()
+        details = self.parse_message(data)
+        record = self.logger.makeRecord(name=self.logger.name,
+                                        level=LOG_LEVELS[details['level']],
+                                        fn=details['filename'],
+                                        lno=int(details['lineno']),
+                                        msg=f'{details["subsystem"]} -- {details["message"]}',
+                                        args=(),
+                                        exc_info=None,
+                                        func=details['function'])
+        record.created = mktime(struct_time((current.tm_year, current.tm_mon, current.tm_mday,
+                                             int(details['hour']), int(details['mins']),
+                                             int(details['secs']), current.tm_wday,
+                                             current.tm_yday, current.tm_isdst)))
+        record.msecs = int(details['microsecs']) // 1000
+        return record
+
+    def handle_stdout(self, data: str):
+        try:
+            self.logger.handle(self.message_to_logrecord(data))
+        except LegacyParseError:
+            self.logger.debug(data)
+
+
+def make_logger(name: str, level: int) -> logging.Logger:
+    logger = logging.getLogger(f'bench.{name}')
+    logger.propagate = False
+    logger.handlers = [logging.NullHandler()]
+    logger.setLevel(level)
+    return logger
+
+
+def measure(handler: Callable[[str], None], lines: List[str], repeat: int) -> float:
+    started = perf_counter()
+    for _ in range(repeat):
+        for line in lines:
+            handler(line)
+    return len(lines) * repeat / (perf_counter() - started)
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark of analyzer log line handling')
+    parser.add_argument('--repeat', type=int, default=200, help='Passes over each log file')
+    parser.add_argument('--level', type=str, default='INFO',
+                        help='Effective logger level for filtered run')
+    args = parser.parse_args()
+    level = logging.getLevelName(args.level)
+
+    for log_name, runner_class in (('wireshark', WiresharkRunner), ('sshdump', SSHDumpRunner)):
+        lines = (DATA_DIR / f'{log_name}.log').read_text(encoding='utf-8').splitlines()
+        legacy = LegacyHandler(make_logger(f'{log_name}.legacy', logging.DEBUG),
+                               allow_no_subsystem=runner_class is WiresharkRunner)
+        if runner_class is WiresharkRunner:
+            runner = WiresharkRunner(log_name, pipename='/dev/null')
+        else:
+            runner = SSHDumpRunner(log_name, pipename='/dev/null', hostname='localhost',
+                                   port=22, interface='any', user='user', password='password')
+
+        results = []
+        runner.logger = make_logger(f'{log_name}.new', logging.DEBUG)
+        results.append(('before, all lines', measure(legacy.handle_stdout, lines, args.repeat)))
+        results.append(('after, all lines', measure(runner.handle_stdout, lines, args.repeat)))
+        legacy.logger.setLevel(level)
+        runner.logger.setLevel(level)
+        results.append((f'before, {args.level} level',
+                        measure(legacy.handle_stdout, lines, args.repeat)))
+        results.append((f'after, {args.level} level',
+                        measure(runner.handle_stdout, lines, args.repeat)))
+
+        print(f'{log_name}.log: {len(lines)} lines x {args.repeat}')
+        for title, rate in results:
+            print(f'  {title:<24} {rate:>12,.0f} lines/s  x{rate / results[0][1]:.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""Micro-benchmark of capture stream indexing.
+
+Compares PcapStream with tracked records (struct.unpack and PcapRecord per packet, no
+5-tuple) with vectorized PacketIndexReader on generated Ethernet/IPv4/UDP capture.
+
+    python benchmarks/bench_packet_index.py [--packets N] [--size BYTES] [--chunk BYTES]
+"""
+import struct
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+from time import perf_counter
+from typing import Callable
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# pylint: disable-next=wrong-import-position
+from remote_pcap.packet_index import PacketIndexReader  # noqa: E402
+# pylint: disable-next=wrong-import-position
+from remote_pcap.pcap_stream import PcapStream  # noqa: E402
+
+
+def make_capture(packets: int, size: int) -> bytes:
+    chunks = [struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1)]
+    for number in range(packets):
+        udp = struct.pack('>HHHH', 5060, 10000 + number % 1000, size - 42, 0)
+        ipv4 = struct.pack('>BBHHHBBH4s4s', 0x45, 0, size - 14, 0, 0, 64, 17, 0,
+                           bytes([10, 0, 0, number % 250 + 1]), bytes([10, 0, 1, 1]))
+        frame = bytes(12) + b'\x08\x00' + ipv4 + udp + bytes(size - 42)
+        chunks.append(struct.pack('<IIII', 1_700_000_000 + number // 1000,
+                                  number % 1000 * 1000, size, size))
+        chunks.append(frame)
+    return b''.join(chunks)
+
+
+def measure(feed: Callable[[bytes], None], data: bytes, chunk: int) -> float:
+    started = perf_counter()
+    for pos in range(0, len(data), chunk):
+        feed(data[pos:pos + chunk])
+    return perf_counter() - started
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark of capture stream indexing')
+    parser.add_argument('--packets', type=int, default=500_000, help='Packets in capture')
+    parser.add_argument('--size', type=int, default=200, help='Size of each packet')
+    parser.add_argument('--chunk', type=int, default=1024 * 1024, help='Bytes per feed call')
+    args = parser.parse_args()
+    data = make_capture(args.packets, args.size)
+
+    stream = PcapStream(track=True)
+    reader = PacketIndexReader()
+    results = [('PcapStream(track=True)', measure(stream.feed, data, args.chunk)),
+               ('PacketIndexReader', measure(reader.feed, data, args.chunk))]
+    reader.flush()
+
+    print(f'{args.packets} packets x {args.size} bytes, {args.chunk} bytes per feed')
+    for title, elapsed in results:
+        print(f'  {title:<24} {args.packets / elapsed:>12,.0f} packets/s '
+              f'{len(data) / elapsed / 1e6:>8,.0f} MB/s  x{results[0][1] / elapsed:.2f}')
+
+
+if __name__ == '__main__':
+    main()
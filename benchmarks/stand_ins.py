@@ -0,0 +1,91 @@
+"""Stand-ins for remote tcpdump and local packet analyzer of end-to-end benchmark.
+
+Only standard library is imported, so startup of stand-in does not add to measured time to
+first packet.
+
+    python benchmarks/stand_ins.py generate RATE SIZE:WEIGHT,...
+    python benchmarks/stand_ins.py consume FIFO RESULT
+"""
+import json
+import os
+import signal
+import struct
+import sys
+from pathlib import Path
+from time import monotonic, process_time, sleep
+from typing import Any, Dict, List, Tuple
+
+RECORD_HEADER = struct.Struct('<IIII')
+
+
+def parse_sizes(sizes: str) -> List[Tuple[int, int]]:
+    result = []
+    for item in sizes.split(','):
+        size, _, weight = item.partition(':')
+        result.append((max(int(size), 42), int(weight or 1)))
+    return result
+
+
+def generate(rate: float, sizes: str):
+    # Stand-in for remote tcpdump, writes blocks of UDP packets with given size mix
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    sys.stderr.write('tcpdump: listening on eth0, link-type EN10MB (Ethernet), '
+                     'snapshot length 262144 bytes\n')
+    sys.stderr.flush()
+    records = []
+    for number in range(256):
+        for size, weight in parse_sizes(sizes):
+            for _ in range(weight):
+                udp = struct.pack('>HHHH', 5060, 10000 + number, size - 42, 0)
+                ipv4 = struct.pack('>BBHHHBBH4s4s', 0x45, 0, size - 14, 0, 0, 64, 17, 0,
+                                   bytes([10, 0, 0, number % 250 + 1]), bytes([10, 0, 1, 1]))
+                records.append(RECORD_HEADER.pack(0, 0, size, size) + bytes(12) + b'\x08\x00' +
+                               ipv4 + udp + bytes(size - 42))
+    block = b''.join(records)
+    output = sys.stdout.buffer
+    output.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 262144, 1))
+    started = monotonic()
+    sent = 0
+    while True:
+        output.write(block)
+        output.flush()
+        sent += len(block)
+        if rate and (ahead := sent * 8 / (rate * 1e6) - (monotonic() - started)) > 0:
+            sleep(ahead)
+
+
+def consume(fifo_path: str, result_path: str):
+    # Stand-in for packet analyzer, counts bytes and pcap records read from FIFO
+    result: Dict[str, Any] = {'bytes': 0, 'packets': 0, 'first': None, 'last': None}
+
+    def finish(*_args):
+        result['cpu'] = process_time()
+        Path(result_path).write_text(json.dumps(result), encoding='utf-8')
+        os._exit(0)  # pylint: disable=protected-access
+    signal.signal(signal.SIGUSR1, finish)
+    signal.signal(signal.SIGTERM, finish)
+
+    with open(fifo_path, 'rb', buffering=0) as fifo:
+        pending = b''
+        position = 24
+        while chunk := fifo.read(1024 * 1024):
+            now = monotonic()
+            if result['first'] is None:
+                result['first'] = now
+            result['last'] = now
+            result['bytes'] += len(chunk)
+            data = pending + chunk
+            while position + RECORD_HEADER.size <= len(data):
+                position += RECORD_HEADER.size + RECORD_HEADER.unpack_from(data, position)[2]
+                result['packets'] += 1
+            keep = min(position, len(data))
+            pending = data[keep:]
+            position -= keep
+    finish()
+
+
+if __name__ == '__main__':
+    if sys.argv[1] == 'generate':
+        generate(float(sys.argv[2]), sys.argv[3])
+    else:
+        consume(sys.argv[2], sys.argv[3])
@@ -1,148 +1,406 @@
-import json
+import importlib
 import logging
-from argparse import ArgumentParser
-from contextlib import contextmanager
-from pathlib import Path
-from typing import Generator, List, Union
-
-from paramiko import AutoAddPolicy, SSHClient
-from paramiko.config import SSHConfig
-
-from remote_pcap.tool_runner import ToolRunner
-
-
-@contextmanager
-def ssh_connection(hostname: str, port: Union[str, int],
-                   user: str, password: str,
-                   identityfile: str, **_kwargs) -> Generator[SSHClient, None, None]:
-    client = SSHClient()
-    client.set_missing_host_key_policy(AutoAddPolicy())
-    if password is not None:
-        client.connect(hostname=hostname, port=int(port),
-                       username=user, password=password)
-    else:
-        assert identityfile is not None
-        client.connect(hostname=hostname, port=int(port),
-                       username=user, key_filename=str(identityfile))
-
-    yield client
-
-    client.close()
-
+import os
+import signal
+import sys
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from threading import Event
+from typing import TYPE_CHECKING, Any, Dict, List, Tuple
 
-def get_tcpdump_path(connected_client: SSHClient) -> str:
-    for path in ('/usr/bin/tcpdump', '/usr/sbin/tcpdump'):
-        # Check FILE exists and the user has execute (or search) access
-        _, stdout, _ = connected_client.exec_command(f'test -x {path}')
-        if stdout.channel.recv_exit_status() == 0:
-            return path
-    raise LookupError('tcpdump not found in remote host')
+from remote_pcap.compression import COMPRESSION_METHODS, local_decompressors
+from remote_pcap.exceptions import CaptureFailedError
+from remote_pcap.log_pipeline import setup_logging
+from remote_pcap.remote_command import CaptureOptions
+from remote_pcap.startup import StartupProfile, startup_phase
+from remote_pcap.units import parse_rate, parse_size
 
+if TYPE_CHECKING:
+    from remote_pcap.tool_runner import ToolRunner
 
-def get_remote_interfaces(connected_client: SSHClient) -> List[str]:
-    _, stdout, _ = connected_client.exec_command('ip -json link')
-    exitcode = stdout.channel.recv_exit_status()
-    if exitcode != 0:
-        raise RuntimeError(f'Failed to get interfaces: {exitcode=}')
-    links_info = json.loads(stdout.read().decode(encoding='utf-8'))
-    return [link['ifname'] for link in links_info]
+# Capture modules pull in paramiko and NumPy, they are imported on first use so that
+# --help and argument errors do not wait for them
+LAZY_ATTRIBUTES = {
+    'capture': 'remote_pcap.async_capture',
+    'PacketBatch': 'remote_pcap.async_capture',
+    'CaptureSource': 'remote_pcap.tool_runner',
+    'ToolRunner': 'remote_pcap.tool_runner'
+}
 
 
-def sudoers_config_is_work(connected_client: SSHClient) -> bool:
-    _, stdout, _ = connected_client.exec_command('sudo tcpdump --version')
-    version_info = stdout.read().decode(encoding='utf-8')
-    if version_info != '' and 'tcpdump version' in version_info:
-        logging.debug(f'tcpdump version in remote host: \n{version_info}')
-        return True
+def __getattr__(name: str) -> Any:
+    if name not in LAZY_ATTRIBUTES:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    return getattr(importlib.import_module(LAZY_ATTRIBUTES[name]), name)
 
-    logging.critical('Cannot run "sudo tcpdump" without password.')
-    logging.info('Please run this command in remote host: '
-                 '"echo -e "${USER}\tALL=NOPASSWD: $(which tcpdump)" '
-                 '| sudo tee /etc/sudoers.d/tcpdump"')
-    return False
 
-
-def run_tool_runner():
-    logging.basicConfig(level=logging.DEBUG, format=('%(asctime)s %(name)s %(levelname)s '
-                                                     '%(filename)s:%(lineno)d %(message)s'))
-    parser = ArgumentParser(description='Remote capture network trafic')
-    parser.add_argument('remote', type=str, metavar='REMOTE HOST', help='Capture in host address')
-    parser.add_argument('-i', '--interface', type=str, required=True, help='Capture in interface')
+def create_parser(fleet: bool = False) -> ArgumentParser:  # pylint: disable=too-many-statements
+    # Fleet capture writes file per host, it has no analyzers and additional sources
+    if fleet:
+        # pylint: disable-next=import-outside-toplevel
+        from remote_pcap.fleet import DEFAULT_OUTPUT
+        parser = ArgumentParser(prog='remote_pcap fleet',
+                                description='Remote capture network trafic in many hosts at once')
+        parser.add_argument('hosts', type=str, nargs='+', metavar='HOSTS',
+                            help='TOML or YAML host list file, SSH config host pattern or host')
+        parser.add_argument('-i', '--interface', type=str,
+                            help='Capture in interface, unless set for host in host list')
+        parser.set_defaults(source=[], analyzer=['none'], transport='pump', memory_buffer=0,
+                            spill_size=0, flow_stats=None, flow_top=0, flow_workers=0)
+    else:
+        parser = ArgumentParser(description='Remote capture network trafic')
+        parser.add_argument('remote', type=str, metavar='REMOTE HOST',
+                            help='Capture in host address')
+        parser.add_argument('-i', '--interface', type=str, required=True,
+                            help='Capture in interface')
+        parser.add_argument('-s', '--source', type=str, action='append', default=[],
+                            metavar='HOST[:PORT]/INTERFACE',
+                            help='Additional capture source merged by timestamp')
     parser.add_argument('-u', '--user', type=str, help='Username for login')
     parser.add_argument('-p', '--password', type=str, help='Password for login')
     parser.add_argument('-k', '--identityfile', type=str, help='File with custom private key')
-    parser.add_argument('-a', '--analyzer', type=str, default='wireshark',
-                        choices=['wireshark', 'sngrep'], help='Packet analyzer')
-    prog_args = parser.parse_args()
+    if fleet:
+        parser.add_argument('-w', '--write', type=str, default=DEFAULT_OUTPUT, metavar='TEMPLATE',
+                            help='Output file of each host, {host} and {interface} are replaced, '
+                                 f'default "{DEFAULT_OUTPUT}"')
+        parser.add_argument('-j', '--jobs', type=int, default=16, metavar='COUNT',
+                            help='Hosts connected and checked at once')
+        parser.add_argument('--connect-timeout', type=float, default=10.0, metavar='SECONDS',
+                            help='SSH connection timeout of each host')
+    else:
+        parser.add_argument('-a', '--analyzer', type=str, action='append',
+                            choices=['wireshark', 'sngrep', 'none'], help='Packet analyzer')
+        parser.add_argument('-w', '--write', type=str, action='append', default=[],
+                            metavar='FILE', help='Write captured stream to file')
+    parser.add_argument('-C', '--file-size', type=parse_size, default=0, metavar='SIZE',
+                        help='Start new output file when current is larger than SIZE')
+    parser.add_argument('-G', '--rotate-seconds', type=float, default=0, metavar='SECONDS',
+                        help='Start new output file every SECONDS of capture')
+    parser.add_argument('-W', '--file-count', type=int, default=0, metavar='COUNT',
+                        help='Keep only COUNT last output files')
+    parser.add_argument('--preallocate', action='store_true',
+                        help='Preallocate disk space for output files of -C size')
+    parser.add_argument('-f', '--filter', type=str, default='', metavar='EXPRESSION',
+                        help='Capture filter in pcap-filter syntax, applied in remote host')
+    parser.add_argument('--snaplen', type=int, default=0, metavar='BYTES',
+                        help='Capture only first BYTES of each packet')
+    parser.add_argument('-B', '--buffer-size', type=parse_size, default=0, metavar='SIZE',
+                        help='Kernel capture buffer size in remote host')
+    parser.add_argument('-z', '--compress', type=str, default='none',
+                        choices=['none', 'auto'] + list(COMPRESSION_METHODS),
+                        help='Compress capture stream in remote host, "auto" selects fastest '
+                             'available, adds latency at low packet rates')
+    if not fleet:
+        parser.add_argument('-t', '--transport', type=str, default='pump',
+                            choices=['pump', 'sshdump'],
+                            help='Capture transport')
+        parser.add_argument('--memory-buffer', type=parse_size, default='32M', metavar='SIZE',
+                            help='In-memory buffer before each analyzer')
+        parser.add_argument('--spill-size', type=parse_size, default='1G', metavar='SIZE',
+                            help='Temporary file buffer used when analyzer stalls, 0 to disable')
+    parser.add_argument('--preflight-ttl', type=float, default=3600, metavar='SECONDS',
+                        help='Reuse remote host checks cached for SECONDS, 0 to disable')
+    parser.add_argument('--stats-file', type=str, metavar='FILE',
+                        help='Periodically write capture statistics to FILE as JSON')
+    parser.add_argument('--metrics-listen', type=str, metavar='[HOST:]PORT|unix:PATH',
+                        help='Serve statistics in Prometheus text format on loopback port or '
+                             'Unix socket')
+    parser.add_argument('--stats-interval', type=float, default=5.0, metavar='SECONDS',
+                        help='Statistics update interval')
+    parser.add_argument('--sip-index', action='store_true',
+                        help='Write Call-ID and RTP index of SIP calls next to output files, '
+                             'for "remote_pcap export-call"')
+    parser.add_argument('--sip-port', type=int, action='append', metavar='PORT',
+                        help='SIP signaling port for --sip-index, default 5060')
+    parser.add_argument('--max-rate', type=parse_rate, default=0, metavar='RATE',
+                        help='Capture budget like 50Mbit, analyzers and output files get stream '
+                             'degraded by --degrade while measured rate is over it')
+    parser.add_argument('--degrade', type=str, default='sample',
+                        choices=['sample', 'flows', 'snaplen'],
+                        help='Keep 1 in N packets, first --flow-packets of each flow or shorter '
+                             'snapshot of packets over --max-rate, TCP SYN/FIN/RST and SIP '
+                             'packets are always kept')
+    parser.add_argument('--flow-packets', type=int, default=100, metavar='COUNT',
+                        help='Packets of each flow kept by "--degrade flows"')
+    if not fleet:
+        parser.add_argument('--flow-stats', type=str, nargs='?', const='-', metavar='FILE',
+                            help='Show top flows with rates and RTP loss and jitter in terminal '
+                                 'or write them to FILE as JSON every --stats-interval')
+        parser.add_argument('--flow-top', type=int, default=20, metavar='COUNT',
+                            help='Flows shown by --flow-stats')
+        parser.add_argument('--flow-workers', type=int, default=min(os.cpu_count() or 1, 4),
+                            metavar='COUNT', help='Processes which keep flow statistics')
+    parser.add_argument('--reconnect', action='store_true',
+                        help='Connect again and restart capture when SSH session is lost, '
+                             'analyzers and output files stay open')
+    parser.add_argument('--reconnect-max-delay', type=float, default=60.0, metavar='SECONDS',
+                        help='Longest delay between reconnect attempts, delay starts at 1 s and '
+                             'doubles after each failed attempt')
+    parser.add_argument('--reconnect-attempts', type=int, default=0, metavar='COUNT',
+                        help='Give up after COUNT failed attempts in a row, 0 for no limit')
+    parser.add_argument('--stop-timeout', type=float, default=1.0, metavar='SECONDS',
+                        help='Time after which child process is killed on stop, SIGTERM is '
+                             'sent at half of it')
+    if not fleet:
+        parser.add_argument('--profile-startup', action='store_true',
+                            help='Print time of each startup phase, from start of interpreter '
+                                 'to first captured packet')
+    return parser
+
+
+def parse_sources(parser: ArgumentParser, prog_args: Namespace) -> List[Tuple[str, str]]:
+    sources = []
+    for source in prog_args.source:
+        remote, _, interface = source.rpartition('/')
+        if not remote or not interface:
+            parser.error(f'argument -s/--source: invalid value: {source!r}')
+        sources.append((remote, interface))
+    return sources
 
+
+def check_arguments(parser: ArgumentParser, prog_args: Namespace,
+                    sources: List[Tuple[str, str]]) -> List[str]:
+    # Returns analyzers to run
     if prog_args.password is not None and prog_args.identityfile is not None:
         parser.error('argument -k/--identityfile: not allowed with argument -p/--password')
 
-    # Prepare values from arguments
-    arg_vals = {}
-    if ':' in prog_args.remote:
-        arg_vals['hostname'], arg_vals['port'] = prog_args.remote.split(':')
-    else:
-        arg_vals['hostname'] = prog_args.remote
-    arg_vals['user'] = prog_args.user
-    arg_vals['password'] = prog_args.password
-    arg_vals['identityfile'] = prog_args.identityfile
-
-    ssh_dir = Path('~/.ssh/').expanduser()
-
-    # Prepare values from ssh config
-    cfg_vals = {}
-    ssh_config = SSHConfig.from_path(ssh_dir.joinpath('config'))
-    if prog_args.remote in ssh_config.get_hostnames():
-        logging.info('Found host in user SSH config file')
-        host_config = ssh_config.lookup(prog_args.remote)
-        for key in ('hostname', 'port', 'user', 'identityfile'):
-            cfg_vals[key] = host_config.get(key)
-        if isinstance(cfg_vals['identityfile'], list):
-            cfg_vals['identityfile'] = cfg_vals['identityfile'][0]
-
-    # Prepare default values
-    default_vals = {
-        'port': 22,
-        'identityfile': next(filter(lambda fp: fp.name in ('id_rsa', 'id_dsa',
-                                                           'id_ecdsa', 'id_ed25519'),
-                                    ssh_dir.iterdir()), None)
-    }
+    analyzers = prog_args.analyzer or ['wireshark']
+    if 'none' in analyzers:
+        if len(analyzers) > 1:
+            parser.error('argument -a/--analyzer: "none" not allowed with other analyzers')
+        if not prog_args.write and not prog_args.flow_stats:
+            parser.error('argument -a/--analyzer: "none" requires -w/--write or --flow-stats')
+        analyzers = []
+    if (len(analyzers) != 1 or prog_args.write or prog_args.flow_stats) and \
+            prog_args.transport != 'pump':
+        parser.error('several analyzers, files or flow statistics allowed only with pump '
+                     'transport')
+    if prog_args.compress not in ('none', 'auto', *local_decompressors()):
+        parser.error(f'argument -z/--compress: Python module for {prog_args.compress} '
+                     'decompression is not installed')
+    if analyzers and prog_args.transport == 'pump':
+        check_buffer_sizes(parser, prog_args)
+    if prog_args.sip_index and not prog_args.write:
+        parser.error('argument --sip-index: requires -w/--write')
+    for option, value in (('-s/--source', sources),
+                          ('-z/--compress', prog_args.compress != 'none'),
+                          ('--max-rate', prog_args.max_rate),
+                          ('--reconnect', prog_args.reconnect)):
+        if value and prog_args.transport != 'pump':
+            parser.error(f'argument {option}: allowed only with pump transport')
+    for option, value in (('--sip-index', prog_args.sip_index),
+                          ('--flow-stats', prog_args.flow_stats),
+                          ('--max-rate', prog_args.max_rate)):
+        if value and not importlib.import_module('remote_pcap.packet_index').numpy_available():
+            parser.error(f'argument {option}: NumPy is not installed')
+    return analyzers
 
-    # Prepare result values
-    result_kwargs = {
+
+def check_buffer_sizes(parser: ArgumentParser, prog_args: Namespace):
+    # Each chunk of capture stream fits into buffers before analyzers
+    pump_buffer = importlib.import_module('remote_pcap.ssh_pump').PUMP_BUFFER_SIZE
+    if prog_args.memory_buffer < pump_buffer:
+        parser.error(f'argument --memory-buffer: must be at least {pump_buffer >> 20}M')
+    if 0 < prog_args.spill_size < pump_buffer:
+        parser.error(f'argument --spill-size: must be 0 or at least {pump_buffer >> 20}M')
+
+
+def capture_kwargs(prog_args: Namespace, analyzers: List[str]) -> Dict[str, Any]:
+    # ToolRunner arguments which do not depend on remote host
+    # pylint: disable=import-outside-toplevel
+    from remote_pcap.capture_writer import RotationOptions
+    from remote_pcap.flow_stats import FlowStatsOptions
+    from remote_pcap.metrics import MetricsOptions
+    from remote_pcap.rate_budget import BudgetOptions
+    from remote_pcap.reconnect import ReconnectOptions
+    return {
         'interface': prog_args.interface,
-        'analyzer': prog_args.analyzer,
-        'hostname': cfg_vals.get('hostname') or arg_vals.get('hostname')
+        'analyzer': analyzers,
+        'outputs': prog_args.write,
+        'rotation': RotationOptions(max_size=prog_args.file_size,
+                                    max_seconds=prog_args.rotate_seconds,
+                                    max_files=prog_args.file_count,
+                                    preallocate=prog_args.preallocate),
+        'capture_options': CaptureOptions(filter=prog_args.filter,
+                                          snaplen=prog_args.snaplen,
+                                          buffer_size=prog_args.buffer_size,
+                                          compression=prog_args.compress),
+        'transport': prog_args.transport,
+        'memory_buffer_size': prog_args.memory_buffer,
+        'spill_size': prog_args.spill_size,
+        'stop_timeout': prog_args.stop_timeout,
+        'sip_ports': (prog_args.sip_port or [5060]) if prog_args.sip_index else (),
+        'metrics_options': MetricsOptions(stats_file=prog_args.stats_file,
+                                          listen=prog_args.metrics_listen,
+                                          interval=prog_args.stats_interval),
+        'flow_stats': FlowStatsOptions(output=prog_args.flow_stats,
+                                       top=prog_args.flow_top,
+                                       workers=prog_args.flow_workers,
+                                       interval=prog_args.stats_interval),
+        'budget': BudgetOptions(max_rate=prog_args.max_rate, mode=prog_args.degrade,
+                                flow_packets=prog_args.flow_packets,
+                                signalling_ports=prog_args.sip_port or [5060, 5061]),
+        'reconnect': ReconnectOptions(enabled=prog_args.reconnect,
+                                      max_delay=prog_args.reconnect_max_delay,
+                                      attempts=prog_args.reconnect_attempts)
     }
-    for key in ('port', 'user', 'password', 'identityfile'):
-        result_kwargs[key] = arg_vals.get(key) or cfg_vals.get(key) or default_vals.get(key)
 
-    if result_kwargs['user'] is None:
-        parser.error('the following arguments are required: -u/--user')
 
-    if result_kwargs['password'] is None and result_kwargs['identityfile'] is None:
-        parser.error('the following arguments are required: -p/--password or -k/--identityfile')
+def run_tool_runner():
+    # Output of child processes is queued, slow terminal never stalls their pipes
+    setup_logging(logging.DEBUG)
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        module, function = SUBCOMMANDS[sys.argv[1]]
+        getattr(importlib.import_module(module), function)(sys.argv[2:])
+        return
+
+    parser = create_parser()
+    prog_args = parser.parse_args()
+    if prog_args.profile_startup:
+        StartupProfile.install()
+    try:
+        run_remote_capture(parser, prog_args)
+    finally:
+        # Capture which stopped before first packet reports phases it reached
+        if StartupProfile.installed is not None:
+            StartupProfile.installed.report()
+
+
+def run_remote_capture(parser: ArgumentParser, prog_args: Namespace):
+    # pylint: disable=import-outside-toplevel,too-many-locals
+    with startup_phase('import ssh'):
+        from remote_pcap.connection import (SSHConnectionPool, prepare_source,
+                                            resolve_compression,
+                                            resolve_connection)
+        from remote_pcap.preflight import PreflightCache
+    with startup_phase('config'):
+        sources = parse_sources(parser, prog_args)
+        analyzers = check_arguments(parser, prog_args, sources)
+        connection = resolve_connection(parser, prog_args, prog_args.remote)
 
-    logging.info(f'Result values: {result_kwargs}')
+    # Checked hosts are not probed again until cache expires or capture fails
+    preflight_cache = PreflightCache(ttl=prog_args.preflight_ttl)
+    connections = {prog_args.remote: connection}
+    try:
+        with ExitStack() as stack:
+            pool = SSHConnectionPool()
+            stack.callback(pool.close)
+            executor = stack.enter_context(ThreadPoolExecutor(
+                max_workers=len(sources) + 1, thread_name_prefix='connect'))
+            # Login and remote checks of all sources run while capture modules are imported.
+            # Several interfaces of one host share the same connection
+            primary = executor.submit(prepare_source, pool, connection, prog_args.interface,
+                                      preflight_cache)
+            pending = []
+            with startup_phase('config sources'):
+                for remote, interface in sources:
+                    if remote not in connections:
+                        connections[remote] = resolve_connection(parser, prog_args, remote)
+                    pending.append((remote, interface, executor.submit(
+                        prepare_source, pool, connections[remote], interface, preflight_cache)))
+            with startup_phase('import capture'):
+                from remote_pcap.tool_runner import CaptureSource, ToolRunner
+                result_kwargs = dict(capture_kwargs(prog_args, analyzers), **connection)
+            logging.info(f'Result values: {result_kwargs}')
 
-    with ssh_connection(**result_kwargs) as connected_client:
-        result_kwargs['tcpdump_path'] = get_tcpdump_path(connected_client)
+            result_kwargs['client'], preflight = primary.result()
+            stack.callback(pool.release, result_kwargs['client'], **connection)
+            result_kwargs['tcpdump_path'] = preflight.tcpdump_path
+            result_kwargs['capture_options'] = resolve_compression(
+                result_kwargs['capture_options'], preflight)
 
-        if not sudoers_config_is_work(connected_client):
-            raise RuntimeError('Cannot run "sudo tcpdump" without password')
+            capture_sources = []
+            for remote, interface, future in pending:
+                client, preflight = future.result()
+                stack.callback(pool.release, client, **connections[remote])
+                assert preflight.tcpdump_path is not None
+                capture_sources.append(CaptureSource(
+                    f'{remote}/{interface}', client, preflight.tcpdump_path, interface,
+                    resolve_compression(result_kwargs['capture_options'], preflight),
+                    connections[remote]))
 
-        remote_interface = result_kwargs['interface']
-        available_interfaces = get_remote_interfaces(connected_client)
-        if remote_interface not in available_interfaces:
-            raise RuntimeError(f'Interface "{remote_interface}" not found '
-                               f'in remote host, {available_interfaces=}')
+            if StartupProfile.installed is not None:
+                StartupProfile.installed.expected_packets = len(capture_sources) + 1
+            logging.debug(f'Result kwargs: {result_kwargs}')
+            run_capture(ToolRunner('main_runner', sources=capture_sources, **result_kwargs))
+    except CaptureFailedError:
+        for resolved in connections.values():
+            preflight_cache.invalidate(**resolved)
+        sys.exit(1)
 
-    logging.debug(f'Result kwargs: {result_kwargs}')
 
-    runner = ToolRunner('main_runner', **result_kwargs)
+def run_capture(runner: 'ToolRunner'):
+    # Long-lived headless capture must close output files on termination
+    signal.signal(signal.SIGTERM, lambda _signum, _frame: runner.stop())
     runner.start()
-    runner.join()
+    try:
+        while runner.is_alive():
+            runner.join(1)
+    except KeyboardInterrupt:
+        runner.stop()
+        runner.join()
+    if runner.capture_failed:
+        raise CaptureFailedError('Capture was terminated by remote side with error')
+
+
+def run_fleet(argv: List[str]):
+    # pylint: disable=import-outside-toplevel,too-many-locals
+    from remote_pcap.connection import resolve_connection
+    from remote_pcap.fleet import (FleetCapture, HostCapture, load_hosts,
+                                   output_path)
+    from remote_pcap.metrics import MetricsOptions, MetricsPublisher
+    from remote_pcap.preflight import PreflightCache
+    parser = create_parser(fleet=True)
+    prog_args = parser.parse_args(argv)
+    analyzers = check_arguments(parser, prog_args, [])
+    try:
+        hosts = load_hosts(prog_args.hosts, {'interface': prog_args.interface,
+                                             'filter': prog_args.filter})
+    except (OSError, ValueError, ImportError) as error:
+        parser.error(f'argument HOSTS: {error}')
+
+    # Statistics of all hosts are published together
+    runner_kwargs = dict(capture_kwargs(prog_args, analyzers), metrics_options=MetricsOptions())
+    captures = []
+    for host in hosts:
+        host_args = Namespace(**dict(vars(prog_args), **host.login()))
+        captures.append(HostCapture(host, resolve_connection(parser, host_args, host.remote),
+                                    output_path(prog_args.write, host)))
+    logging.info(f'Fleet capture in {len(captures)} hosts, {prog_args.jobs} at once')
+
+    fleet = FleetCapture(captures, runner_kwargs, jobs=prog_args.jobs,
+                         preflight_cache=PreflightCache(ttl=prog_args.preflight_ttl),
+                         connect_timeout=prog_args.connect_timeout)
+    # Status view is shown on each statistics update, also when it is not published
+    publisher = MetricsPublisher('metrics', fleet.registry, interval=prog_args.stats_interval,
+                                 stats_file=prog_args.stats_file,
+                                 listen=prog_args.metrics_listen, on_publish=fleet.show_status)
+    need_stop = Event()
+    signal.signal(signal.SIGTERM, lambda _signum, _frame: need_stop.set())
+    fleet.start()
+    publisher.start()
+    try:
+        while fleet.update() and not need_stop.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+    fleet.stop()
+    publisher.stop()
+    if fleet.failed:
+        logging.error(f'Capture failed in {len(fleet.failed)} hosts: '
+                      f'{", ".join(host.name for host in fleet.failed)}')
+        sys.exit(1)
+
+
+# Commands selected by first argument instead of remote host, module and function
+SUBCOMMANDS = {
+    'slice': ('remote_pcap.capture_slice', 'run_slice'),
+    'export-call': ('remote_pcap.capture_slice', 'run_export_call'),
+    'fleet': (__name__, 'run_fleet'),
+    'ring': ('remote_pcap.ring_buffer', 'run_ring'),
+    'pull': ('remote_pcap.ring_buffer', 'run_pull')
+}
 
 
 if __name__ == '__main__':
@@ -0,0 +1,250 @@
+import asyncio
+import logging
+from queue import Queue
+from threading import Lock
+from time import monotonic
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from paramiko import SSHClient
+
+from .compression import StreamDecompressor
+from .connection import (SSHConnectionPool, check_remote_host,
+                         lookup_connection, resolve_compression)
+from .exceptions import CaptureFailedError, ParsePcapError
+from .metrics import Stats
+from .packet_index import PacketIndexReader
+from .pcap_stream import PCAP_RECORD_HEADER_SIZE
+from .preflight import PreflightCache
+from .remote_command import CaptureOptions, capture_command
+from .ssh_pump import SSHPump
+
+
+class PacketBatch(NamedTuple):
+    # Complete pcap records, valid until next batch is requested from stream. Rows of
+    # headers are PACKET_INDEX_FIELDS with offset of record header in data
+    data: memoryview
+    headers: Any
+    linktype: int
+
+    def packet(self, number: int) -> memoryview:
+        offset = int(self.headers['offset'][number]) + PCAP_RECORD_HEADER_SIZE
+        return self.data[offset:offset + int(self.headers['caplen'][number])]
+
+
+class BatchSink():
+    # Capture stream is copied once into one of reusable buffers, complete records of buffer are
+    # passed to event loop as batch, buffer returns to pump when consumer requests next batch.
+    # Pump waits for free buffer when consumer is slow, so backpressure reaches SSH window
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, name: str, loop: asyncio.AbstractEventLoop, queue: asyncio.Queue,
+                 buffer_size: int = 4 * 1024 * 1024, queue_size: int = 4):
+        self.name = name
+        self.logger = logging.getLogger(self.name)
+        self.loop = loop
+        self.queue = queue
+        self.buffers = [bytearray(buffer_size) for _ in range(queue_size + 2)]
+        self.reader = PacketIndexReader(batch_size=1 << 62)
+        self.batches = 0
+        self.queued = 0
+        self.wait_seconds = 0.0
+        self.closing = False
+        self._free: Queue = Queue()
+        for number in range(1, len(self.buffers)):
+            self._free.put(number)
+        self._lock = Lock()
+        self._current = 0
+        self._filled = 0
+        # Stream offset of first byte of current buffer
+        self._base = 0
+        self._emitted = 0
+
+    def open(self):
+        pass
+
+    def write(self, data: memoryview):
+        size = len(self.buffers[0])
+        while data:
+            take = min(size - self._filled, len(data))
+            self.buffers[self._current][self._filled:self._filled + take] = data[:take]
+            self._filled += take
+            data = data[take:]
+            if self._filled == size:
+                self._emit()
+                if self._filled == size:
+                    raise ParsePcapError(f'Capture record is larger than batch buffer of '
+                                         f'{size} bytes')
+        # Consumer waiting for data gets it at once, busy consumer gets larger batches
+        if self.queued == 0:
+            self._emit()
+
+    def _emit(self, final: bool = False):
+        buffer = self.buffers[self._current]
+        end = self._base + self._filled
+        self.reader.feed(memoryview(buffer)[self._emitted - self._base:self._filled])
+        self._emitted = end
+        index = self.reader.flush()
+        if not index:
+            return
+        headers = index[0]
+        first = int(headers['offset'][0])
+        last = int(headers['offset'][-1]) + PCAP_RECORD_HEADER_SIZE + int(headers['caplen'][-1])
+        headers['offset'] -= first
+        batch = PacketBatch(memoryview(buffer)[first - self._base:last - self._base], headers,
+                            self.reader.interfaces[0].linktype)
+        with self._lock:
+            self.queued += 1
+        self.batches += 1
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (self._current, batch))
+        if final:
+            return
+
+        # Incomplete last record is moved to start of next buffer
+        started = monotonic()
+        number = self._free.get()
+        self.wait_seconds += monotonic() - started
+        if self.closing:
+            raise BrokenPipeError('Capture stream is closed')
+        tail = self._filled - (last - self._base)
+        self.buffers[number][:tail] = buffer[last - self._base:self._filled]
+        self._current, self._filled, self._base = number, tail, last
+
+    def release(self, number: int):
+        # Called from event loop when consumer is done with batch
+        with self._lock:
+            self.queued -= 1
+        self._free.put(number)
+
+    def close(self):
+        # Records of current buffer are passed before end of stream, end of stream needs no
+        # free buffer, so it is not waited for. Aborted stream drops them
+        if not self.closing:
+            self._emit(final=True)
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+
+    def abort(self):
+        # Pump waiting for free buffer is woken up and stops
+        self.closing = True
+        self._free.put(0)
+
+    def stats(self) -> Stats:
+        return {'batches': self.batches, 'queued_batches': self.queued,
+                'wait_seconds': self.wait_seconds}
+
+
+class CaptureStream():
+    # Async context manager and iterator of packet batches captured in remote host
+    # pylint: disable=too-many-instance-attributes
+
+    # pylint: disable-next=too-many-arguments
+    def __init__(self, host: str, interface: str, capture_filter: str = '', *,
+                 user: Optional[str] = None, password: Optional[str] = None,
+                 identityfile: Optional[str] = None, options: Optional[CaptureOptions] = None,
+                 buffer_size: int = 4 * 1024 * 1024, queue_size: int = 4,
+                 pool: Optional[SSHConnectionPool] = None,
+                 preflight_cache: Optional[PreflightCache] = None):
+        self.logger = logging.getLogger(f'capture.{host}/{interface}')
+        self.connection = lookup_connection(host, user, password, identityfile)
+        if self.connection['user'] is None:
+            raise ValueError('User for login is not set')
+        if self.connection['password'] is None and self.connection['identityfile'] is None:
+            raise ValueError('Password or private key for login is not set')
+        self.interface = interface
+        self.options = (options or CaptureOptions())._replace(filter=capture_filter)
+        self.buffer_size = buffer_size
+        self.queue_size = queue_size
+        self.pool = pool or SSHConnectionPool()
+        self._own_pool = pool is None
+        self.preflight_cache = preflight_cache
+        self.sink: Optional[BatchSink] = None
+        self.pump: Optional[SSHPump] = None
+        self._client: Optional[SSHClient] = None
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._released: List[int] = []
+        self._finished = False
+
+    async def __aenter__(self) -> 'CaptureStream':
+        loop = asyncio.get_running_loop()
+        self.sink = BatchSink(f'{self.logger.name}.batches', loop, self._queue,
+                              buffer_size=self.buffer_size, queue_size=self.queue_size)
+        try:
+            await loop.run_in_executor(None, self._start)
+        except BaseException:
+            await self._stop()
+            raise
+        return self
+
+    def _start(self):
+        # Connection, remote checks and start of remote command block, run outside event loop
+        client = self._client = self.pool.acquire(**self.connection)
+        preflight = check_remote_host(client, self.interface, self.preflight_cache,
+                                      self.connection)
+        assert preflight.tcpdump_path is not None
+        options = resolve_compression(self.options, preflight)
+        decompressor = None
+        if options.compression != 'none':
+            decompressor = StreamDecompressor(options.compression)
+        self.pump = SSHPump(f'{self.logger.name}.pump', client=client,
+                            command=capture_command(preflight.tcpdump_path, self.interface,
+                                                    options),
+                            sink=self.sink, decompressor=decompressor)
+        self.pump.run()
+
+    async def __aexit__(self, *_exc_info):
+        await self._stop()
+
+    async def _stop(self):
+        if self.sink is not None:
+            self.sink.abort()
+        if self.pump is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.pump.stop)
+        if self._client is not None:
+            self.pool.release(self._client, **self.connection)
+            self._client = None
+        if self._own_pool:
+            self.pool.close()
+
+    def __aiter__(self) -> 'CaptureStream':
+        return self
+
+    async def __anext__(self) -> PacketBatch:
+        assert self.sink is not None
+        # Buffer of previous batch is reused from now on
+        while self._released:
+            self.sink.release(self._released.pop())
+        if self._finished:
+            raise StopAsyncIteration
+        item = await self._queue.get()
+        if item is None:
+            self._finished = True
+            if self.pump is not None and self.pump.returncode:
+                raise CaptureFailedError(f'Remote capture exited with {self.pump.returncode}')
+            raise StopAsyncIteration
+        number, batch = item
+        self._released.append(number)
+        return batch
+
+    def stats(self) -> Stats:
+        stats: Dict[str, float] = {}
+        if self.pump is not None:
+            stats.update(self.pump.stats())
+        if self.sink is not None:
+            stats.update(self.sink.stats())
+        return stats
+
+
+def capture(host: str, interface: str, capture_filter: str = '', **kwargs) -> CaptureStream:
+    """Capture traffic of interface in remote host as async iterator of packet batches.
+
+    Usage::
+
+        async with remote_pcap.capture('sbc-1', 'eth0', 'udp port 5060') as stream:
+            async for batch in stream:
+                for number in range(len(batch.headers)):
+                    process(batch.headers[number], batch.packet(number))
+
+    Host may be HOST[:PORT] or host of user SSH config, login values are looked up like in
+    command line tool. Batch data is reused when next batch is requested, it must be copied to
+    be kept. Requires NumPy for header arrays.
+    """
+    return CaptureStream(host, interface, capture_filter, **kwargs)
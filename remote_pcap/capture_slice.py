@@ -0,0 +1,323 @@
+import ipaddress
+import json
+import logging
+import mmap
+import re
+import struct
+import sys
+from argparse import ArgumentParser
+from bisect import bisect_right
+from datetime import datetime, tzinfo
+from pathlib import Path
+from typing import (BinaryIO, Callable, Dict, Iterable, Iterator, List,
+                    Optional, Tuple)
+
+from .capture_writer import FLOW_INDEX_FIELDS, INDEX_SUFFIX
+from .packet_index import (IPV4_MAPPED_PREFIX, FlowKey, PacketIndexReader,
+                           flow_key_array, format_address, select_flow)
+from .pcap_stream import PCAP_RECORD_HEADER_SIZE, PcapStream
+from .sip_index import call_offsets, load_calls
+
+# Records are read from mapped file in chunks of this size
+READ_CHUNK = 1024 * 1024
+
+PROTOCOL_NUMBERS = {'icmp': 1, 'tcp': 6, 'udp': 17, 'icmpv6': 58, 'sctp': 132}
+
+endpoint_pattern = re.compile(r'^\[?(?P<address>[^\]]+?)\]?(?::(?P<port>\d+))?$')
+
+
+def parse_time(value: str, reference: Optional[int] = None,
+               timezone: Optional[tzinfo] = None) -> int:
+    # Epoch seconds, ISO date and time or time of day at date of reference timestamp,
+    # returned as nanoseconds. Time without zone is in given zone, local one by default
+    try:
+        return round(float(value) * 1_000_000_000)
+    except ValueError:
+        pass
+    try:
+        when = datetime.fromisoformat(value)
+    except ValueError:
+        if reference is None:
+            raise
+        day = datetime.fromtimestamp(reference / 1_000_000_000, timezone).date()
+        when = datetime.combine(day, datetime.strptime(value, '%H:%M:%S.%f' if '.' in value
+                                                       else '%H:%M:%S').time())
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone)
+    return round(when.timestamp() * 1_000_000_000)
+
+
+def parse_endpoint(value: str) -> Tuple[bytes, int]:
+    # ADDRESS, ADDRESS:PORT or [IPV6]:PORT as IPv4-mapped address and port
+    try:
+        address = ipaddress.ip_address(value)
+        port = 0
+    except ValueError:
+        if not (match_obj := endpoint_pattern.match(value)):
+            raise
+        address = ipaddress.ip_address(match_obj['address'])
+        port = int(match_obj['port'] or 0)
+    if isinstance(address, ipaddress.IPv4Address):
+        address = ipaddress.IPv6Address(IPV4_MAPPED_PREFIX + address.packed)
+    return address.packed, port
+
+
+def parse_flow(value: str) -> FlowKey:
+    # "PROTOCOL ENDPOINT ENDPOINT", e.g. "udp 10.0.0.1:5060 10.0.0.2:5060"
+    protocol, *endpoints = value.split()
+    if len(endpoints) != 2:
+        raise ValueError(f'Invalid flow: {value!r}')
+    number = PROTOCOL_NUMBERS[protocol] if protocol in PROTOCOL_NUMBERS else int(protocol)
+    # Same order of endpoints as in flow_keys()
+    a, b = sorted(parse_endpoint(endpoint) for endpoint in endpoints)
+    return number, format_address(a[0]), a[1], format_address(b[0]), b[1]
+
+
+def load_index(path: Path) -> Optional[Dict]:
+    try:
+        with open(f'{path}{INDEX_SUFFIX}', encoding='utf-8') as index_file:
+            return json.load(index_file)
+    except (OSError, ValueError) as error:
+        logging.warning(f'No usable index of {path}, whole file is read: {error}')
+        return None
+
+
+class CaptureSlicer():
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.logger = logging.getLogger(f'slice.{path.name}')
+        self.index = load_index(path)
+        self._file = open(path, 'rb')  # pylint: disable=consider-using-with
+        self.view = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.header = PcapStream()
+        self.first_timestamp: Optional[int] = None
+        self.header_size = self._read_header()
+
+    def close(self):
+        self.view.close()
+        self._file.close()
+
+    def _read_header(self) -> int:
+        # Everything before first packet record is copied into each slice
+        if self.index and self.index.get('first_offset'):
+            self.header.feed(self.view[:self.index['first_offset']])
+            self.first_timestamp = self.index['first_timestamp']
+            return self.index['first_offset']
+        stream = PcapStream(track=True)
+        for position in range(0, len(self.view), READ_CHUNK):
+            if records := stream.feed(self.view[position:position + READ_CHUNK]):
+                self.header.feed(self.view[:records[0].offset])
+                self.first_timestamp = records[0].timestamp
+                return records[0].offset
+        return len(self.view)
+
+    def overlaps(self, start: Optional[int], end: Optional[int]) -> bool:
+        if not self.index or self.index.get('first_timestamp') is None:
+            return True
+        return (start is None or self.index['last_timestamp'] >= start) and \
+            (end is None or self.index['first_timestamp'] <= end)
+
+    def record_length(self, offset: int) -> int:
+        if self.header.format == 'pcap':
+            caplen, = struct.unpack_from(self.header.byteorder + 'I', self.view, offset + 8)
+            return PCAP_RECORD_HEADER_SIZE + caplen
+        return struct.unpack_from(self.header.byteorder + 'I', self.view, offset + 4)[0]
+
+    def time_range(self, start: Optional[int], end: Optional[int]) -> Tuple[int, int]:
+        # Sparse index entries around window, file is written in capture order
+        entries = self.index.get('timestamps') if self.index else None
+        if not entries:
+            return self.header_size, len(self.view)
+        timestamps = [timestamp for timestamp, _ in entries]
+        first = bisect_right(timestamps, start) - 1 if start is not None else 0
+        last = bisect_right(timestamps, end) if end is not None else len(entries)
+        return (entries[max(first, 0)][1],
+                entries[last][1] if last < len(entries) else len(self.view))
+
+    def records(self, begin: int, end: int) -> Iterator[Tuple[int, int, int]]:
+        # Yields offset, length and timestamp of records between offsets
+        stream = PcapStream(track=True)
+        stream.feed(self.view[:self.header_size])
+        for position in range(begin, end, READ_CHUNK):
+            chunk_end = min(position + READ_CHUNK, end)
+            for record in stream.feed(self.view[position:chunk_end]):
+                offset = record.offset - self.header_size + begin
+                yield offset, self.record_length(offset), record.timestamp
+
+    def slice_time(self, start: Optional[int], end: Optional[int]) -> Iterator[Tuple[int, int]]:
+        begin, stop = self.time_range(start, end)
+        self.logger.debug(f'Reading {stop - begin} of {len(self.view)} bytes')
+        for offset, length, timestamp in self.records(begin, stop):
+            if (start is None or timestamp >= start) and (end is None or timestamp <= end):
+                yield offset, length
+
+    def flow_range(self, key: FlowKey) -> Tuple[int, int]:
+        if not self.index or 'flows' not in self.index:
+            return self.header_size, len(self.view)
+        fields = self.index.get('flow_fields', FLOW_INDEX_FIELDS)
+        for flow in self.index['flows']:
+            values = dict(zip(fields, flow))
+            if key == tuple(values[field] for field in FLOW_INDEX_FIELDS[:5]):
+                last = values['last_offset']
+                return values['first_offset'], last + self.record_length(last)
+        return 0, 0
+
+    def slice_flow(self, key: FlowKey, start: Optional[int],
+                   end: Optional[int]) -> Iterator[Tuple[int, int]]:
+        begin, stop = self.flow_range(key)
+        if start is not None or end is not None:
+            time_begin, time_stop = self.time_range(start, end)
+            begin, stop = max(begin, time_begin), min(stop, time_stop)
+        if begin >= stop:
+            return
+        self.logger.debug(f'Reading {stop - begin} of {len(self.view)} bytes')
+        target = flow_key_array(key)
+        reader = PacketIndexReader()
+        reader.feed(self.view[:self.header_size])
+        for position in range(begin, stop, READ_CHUNK):
+            batches = reader.feed(self.view[position:min(position + READ_CHUNK, stop)])
+            if position + READ_CHUNK >= stop:
+                batches += reader.flush()
+            for batch in batches:
+                for stream_offset in select_flow(batch, target, start, end).tolist():
+                    offset = stream_offset - self.header_size + begin
+                    yield offset, self.record_length(offset)
+
+
+def write_slice(output: BinaryIO, slicers: List[CaptureSlicer],
+                select: Callable[[CaptureSlicer], Iterable[Tuple[int, int]]]) -> int:
+    # select returns offset and length of records to copy from file
+    written = 0
+    previous: Optional[CaptureSlicer] = None
+    for slicer in slicers:
+        for offset, length in select(slicer):
+            if previous is not slicer:
+                # pcapng file may start new section, pcap header is written only once
+                if previous is None or slicer.header.format == 'pcapng':
+                    output.write(slicer.view[:slicer.header_size])
+                elif previous.header.linktype != slicer.header.linktype:
+                    raise ValueError(f'Link type of {slicer.path} differs from '
+                                     f'{previous.path}')
+                previous = slicer
+            output.write(slicer.view[offset:offset + length])
+            written += 1
+    if previous is None and slicers:
+        # Nothing selected, output is still valid capture file without packets
+        output.write(slicers[0].view[:slicers[0].header_size])
+    return written
+
+
+def write_output(path: str, slicers: List[CaptureSlicer],
+                 select: Callable[[CaptureSlicer], Iterable[Tuple[int, int]]]):
+    try:
+        if path == '-':
+            written = write_slice(sys.stdout.buffer, slicers, select)
+        else:
+            with open(path, 'wb') as output:
+                written = write_slice(output, slicers, select)
+    finally:
+        for slicer in slicers:
+            slicer.close()
+    logging.info(f'Written {written} packets into {path}')
+
+
+def create_slice_parser() -> ArgumentParser:
+    parser = ArgumentParser(prog='remote_pcap slice',
+                            description='Copy time window or flow out of written capture files')
+    parser.add_argument('files', type=Path, nargs='+', metavar='FILE',
+                        help='Capture files written by remote_pcap -w')
+    parser.add_argument('-w', '--write', type=str, required=True, metavar='FILE',
+                        help='Output file, "-" for stdout')
+    parser.add_argument('--start', type=str, metavar='TIME',
+                        help='Start of window: epoch seconds, ISO date and time or '
+                             'HH:MM:SS at date of capture')
+    parser.add_argument('--end', type=str, metavar='TIME', help='End of window')
+    parser.add_argument('--around', type=str, metavar='TIME', help='Middle of window')
+    parser.add_argument('--window', type=float, default=30.0, metavar='SECONDS',
+                        help='Length of window set by --around')
+    parser.add_argument('--flow', type=str, metavar='"PROTOCOL ADDRESS[:PORT] ADDRESS[:PORT]"',
+                        help='Copy only packets of conversation, in both directions')
+    return parser
+
+
+def run_slice(argv: List[str]):
+    parser = create_slice_parser()
+    prog_args = parser.parse_args(argv)
+    if prog_args.around and (prog_args.start or prog_args.end):
+        parser.error('argument --around: not allowed with argument --start or --end')
+    if prog_args.flow:
+        try:
+            prog_args.flow = parse_flow(prog_args.flow)
+        except (ValueError, KeyError):
+            parser.error(f'argument --flow: invalid value: {prog_args.flow!r}')
+
+    slicers = [CaptureSlicer(path) for path in prog_args.files]
+    reference = next((slicer.first_timestamp for slicer in slicers
+                      if slicer.first_timestamp is not None), None)
+    try:
+        start, end = (parse_time(value, reference) if value else None
+                      for value in (prog_args.start, prog_args.end))
+        if prog_args.around:
+            middle = parse_time(prog_args.around, reference)
+            start = middle - round(prog_args.window * 500_000_000)
+            end = middle + round(prog_args.window * 500_000_000)
+    except ValueError as error:
+        parser.error(f'invalid time: {error}')
+
+    def select(slicer: CaptureSlicer) -> Iterable[Tuple[int, int]]:
+        if not slicer.overlaps(start, end):
+            return ()
+        if prog_args.flow:
+            return slicer.slice_flow(prog_args.flow, start, end)
+        return slicer.slice_time(start, end)
+
+    write_output(prog_args.write, slicers, select)
+
+
+def create_export_parser() -> ArgumentParser:
+    parser = ArgumentParser(prog='remote_pcap export-call',
+                            description='Copy SIP and RTP packets of one call out of capture '
+                                        'files written with --sip-index')
+    parser.add_argument('files', type=Path, nargs='+', metavar='FILE',
+                        help='Capture files written by remote_pcap -w')
+    parser.add_argument('-c', '--call-id', type=str, help='Call-ID of exported call')
+    parser.add_argument('-w', '--write', type=str, metavar='FILE',
+                        help='Output file, "-" for stdout')
+    parser.add_argument('-l', '--list', action='store_true',
+                        help='List Call-ID with SIP and RTP packet counts of indexed calls')
+    return parser
+
+
+def list_calls(paths: List[Path]):
+    totals: Dict[str, List[int]] = {}
+    for path in paths:
+        calls = load_calls(path) or {}
+        for call_id, call in calls.items():
+            total = totals.setdefault(call_id, [0, 0])
+            total[0] += len(call['sip'])
+            total[1] += call['rtp'][1]
+    for call_id, (sip, rtp) in totals.items():
+        print(f'{call_id}\t{sip}\t{rtp}')
+
+
+def run_export_call(argv: List[str]):
+    parser = create_export_parser()
+    prog_args = parser.parse_args(argv)
+    if prog_args.list:
+        list_calls(prog_args.files)
+        return
+    if not prog_args.call_id or not prog_args.write:
+        parser.error('the following arguments are required: -c/--call-id, -w/--write')
+
+    def select(slicer: CaptureSlicer) -> Iterable[Tuple[int, int]]:
+        calls = load_calls(slicer.path)
+        if calls is None:
+            slicer.logger.warning(f'No SIP index of {slicer.path}')
+            return ()
+        if (call := calls.get(prog_args.call_id)) is None:
+            return ()
+        return ((offset, slicer.record_length(offset))
+                for offset in call_offsets(slicer.path, call))
+
+    write_output(prog_args.write, [CaptureSlicer(path) for path in prog_args.files], select)
@@ -0,0 +1,224 @@
+import json
+import logging
+import os
+from collections import deque
+from pathlib import Path
+from time import localtime, strftime
+from typing import Deque, Dict, List, NamedTuple, Optional, Sequence
+
+from .packet_index import FlowKey, PacketIndexReader, summarize_flows
+from .pcap_stream import PcapStream
+from .sip_index import CALLS_SUFFIX, RTP_OFFSETS_SUFFIX, SipIndexer
+
+INDEX_SUFFIX = '.idx'
+
+# Distance in bytes between sparse timestamp index entries, bounds data read on lookup
+INDEX_STEP = 1024 * 1024
+
+# Data is passed to flow indexer in large chunks, NumPy has fixed cost per call
+FLOW_INDEX_CHUNK = 4 * 1024 * 1024
+
+FLOW_INDEX_FIELDS = ('protocol', 'a', 'a_port', 'b', 'b_port', 'first_offset', 'last_offset',
+                     'packets')
+
+
+class RotationOptions(NamedTuple):
+    max_size: int = 0
+    max_seconds: float = 0
+    max_files: int = 0
+    preallocate: bool = False
+
+
+class CaptureWriter():  # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, name: str, path: str, max_size: int = 0, max_seconds: float = 0,
+                 max_files: int = 0, preallocate: bool = False,
+                 buffer_size: int = 4 * 1024 * 1024, sip_ports: Sequence[int] = ()):
+        self.name = name
+        self.logger = logging.getLogger(self.name)
+        self.path = Path(path)
+        self.max_size = max_size
+        self.max_seconds = max_seconds
+        self.max_files = max_files
+        self.preallocate = preallocate
+        self.buffer_size = buffer_size
+        self.stream = PcapStream(track=True)
+        self.file_path: Optional[Path] = None
+        self.files_written = 0
+        self._files: Deque[Path] = deque()
+        self._fd: Optional[int] = None
+        self._buffer = bytearray()
+        self._file_size = 0
+        self._file_index: Dict = {}
+        self._flows: Dict[FlowKey, List[int]] = {}
+        # Flow and SIP index need optional NumPy, timestamp index is always written
+        self._sip_indexer = SipIndexer() if sip_ports else None
+        try:
+            self._flow_indexer: Optional[PacketIndexReader] = PacketIndexReader(
+                payload_ports=sip_ports)
+        except ImportError:
+            self._flow_indexer = None
+        self._flow_pending = bytearray()
+        # Difference between file offset and stream offset of records in current file
+        self._stream_delta = 0
+
+    @property
+    def rotation_enabled(self) -> bool:
+        return bool(self.max_size or self.max_seconds)
+
+    def make_file_path(self, timestamp: Optional[int]) -> Path:
+        if not self.rotation_enabled:
+            return self.path
+        seconds = (timestamp or 0) // 1_000_000_000 or None
+        when = strftime('%Y%m%d%H%M%S', localtime(seconds))
+        return self.path.with_name(f'{self.path.stem}_{self.files_written:05d}_{when}'
+                                   f'{self.path.suffix}')
+
+    def stats(self) -> Dict[str, float]:
+        stats: Dict[str, float] = {'bytes': self.stream.bytes,
+                                   'packets': self.stream.packets,
+                                   'files': self.files_written}
+        if self._sip_indexer is not None:
+            stats['sip_calls'] = len(self._sip_indexer.call_ids)
+        return stats
+
+    def open(self):
+        self._open_file(None)
+
+    def _open_file(self, timestamp: Optional[int]):
+        self.file_path = self.make_file_path(timestamp)
+        self.logger.info(f'Writing capture to {self.file_path}')
+        self._fd = os.open(self.file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        if self.preallocate and self.max_size:
+            # Contiguous extents for long captures, file is truncated to real size on close
+            os.posix_fallocate(self._fd, 0, self.max_size)
+        self.files_written += 1
+        self._file_size = 0
+        self._file_index = {'packets': 0, 'first_timestamp': None, 'last_timestamp': None,
+                            'index_step': INDEX_STEP, 'timestamps': []}
+        self._flows = {}
+        if self._sip_indexer is not None:
+            self._sip_indexer.reset()
+        self._files.append(self.file_path)
+        while self.max_files and len(self._files) > self.max_files:
+            self._remove_file(self._files.popleft())
+
+    def _remove_file(self, file_path: Path):
+        self.logger.info(f'Removing old capture file {file_path}')
+        for suffix in ('', INDEX_SUFFIX, CALLS_SUFFIX, RTP_OFFSETS_SUFFIX):
+            path = Path(f'{file_path}{suffix}')
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def write(self, data: memoryview):
+        chunk_start = self.stream.bytes
+        position = 0
+        for record in self.stream.feed(data):
+            offset = record.offset - chunk_start
+            file_offset = self._file_size + len(self._buffer) + offset - position
+            # Files are switched only on record boundary inside of current chunk
+            if offset >= position and self._rotation_due(file_offset, record.timestamp):
+                self._append(data[position:offset])
+                self._index_flows(data[position:offset], final=True)
+                position = offset
+                self._rotate(record.timestamp)
+                file_offset = self._file_size + len(self._buffer)
+                self._stream_delta = file_offset - record.offset
+            self._on_record(file_offset, record.timestamp)
+        self._append(data[position:])
+        self._index_flows(data[position:], final=False)
+
+    def _rotation_due(self, file_size: int, timestamp: int) -> bool:
+        if self._file_index['packets'] == 0:
+            return False
+        if self.max_size and file_size >= self.max_size:
+            return True
+        first_timestamp = self._file_index['first_timestamp']
+        return bool(self.max_seconds and
+                    timestamp - first_timestamp >= self.max_seconds * 1_000_000_000)
+
+    def _on_record(self, file_offset: int, timestamp: int):
+        index = self._file_index
+        index['packets'] += 1
+        if index['first_timestamp'] is None:
+            index['first_timestamp'] = timestamp
+            index['first_offset'] = file_offset
+        index['last_timestamp'] = timestamp
+        timestamps = index['timestamps']
+        if not timestamps or file_offset - timestamps[-1][1] >= INDEX_STEP:
+            timestamps.append((timestamp, file_offset))
+
+    def _index_flows(self, data: memoryview, final: bool):
+        if self._flow_indexer is None:
+            return
+        self._flow_pending += data
+        if len(self._flow_pending) < FLOW_INDEX_CHUNK and not final:
+            return
+        batches = self._flow_indexer.feed(self._flow_pending)
+        self._flow_pending.clear()
+        if final:
+            # Rest of records must be counted before file of them is closed
+            batches += self._flow_indexer.flush()
+        for batch in batches:
+            for key, first_offset, last_offset, packets in summarize_flows(batch):
+                flow = self._flows.get(key)
+                if flow is None:
+                    self._flows[key] = [first_offset + self._stream_delta,
+                                        last_offset + self._stream_delta, packets]
+                else:
+                    flow[1] = last_offset + self._stream_delta
+                    flow[2] += packets
+            if self._sip_indexer is not None:
+                self._sip_indexer.add_batch(batch, self._flow_indexer.payloads,
+                                            self._stream_delta)
+
+    def _append(self, data: memoryview):
+        if not data:
+            return
+        self._buffer += data
+        if len(self._buffer) >= self.buffer_size:
+            self._flush()
+
+    def _flush(self):
+        assert self._fd is not None
+        with memoryview(self._buffer) as view:
+            written = 0
+            while written < len(view):
+                written += os.write(self._fd, view[written:])
+        self._file_size += len(self._buffer)
+        self._buffer.clear()
+
+    def _rotate(self, timestamp: int):
+        self._close_file()
+        self._open_file(timestamp)
+        self._append(memoryview(self.stream.header))
+
+    def _close_file(self):
+        if self._fd is None:
+            return
+        self._index_flows(memoryview(b''), final=True)
+        self._flush()
+        if self.preallocate:
+            os.ftruncate(self._fd, self._file_size)
+        os.close(self._fd)
+        self._fd = None
+        self.write_index()
+
+    def write_index(self):
+        assert self.file_path is not None
+        index = dict(self._file_index, file=self.file_path.name, format=self.stream.format,
+                     linktype=self.stream.linktype, bytes=self._file_size)
+        if self._flow_indexer is not None:
+            index['flow_fields'] = FLOW_INDEX_FIELDS
+            index['flows'] = [key + tuple(flow) for key, flow in self._flows.items()]
+        with open(f'{self.file_path}{INDEX_SUFFIX}', 'w', encoding='utf-8') as index_file:
+            json.dump(index, index_file)
+        if self._sip_indexer is not None:
+            self._sip_indexer.write(self.file_path)
+
+    def close(self):
+        self._close_file()
+        self.logger.info(f'Written {self.stream.packets} packets, {self.stream.bytes} bytes '
+                         f'into {self.files_written} files')
@@ -0,0 +1,84 @@
+import zlib
+from typing import Any, Callable, Dict, List, Tuple, Type
+
+from .exceptions import DecompressError
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # type: ignore
+
+try:
+    import lz4.frame as lz4_frame  # type: ignore
+except ImportError:
+    lz4_frame = None  # type: ignore
+
+# Preferred order for automatic selection
+COMPRESSION_METHODS = ('zstd', 'lz4', 'gzip')
+
+# Raised by decompressors for corrupt stream, lz4 reports it as RuntimeError
+DECOMPRESSOR_ERRORS: Tuple[Type[Exception], ...] = (zlib.error, RuntimeError) + \
+    ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+def _gzip_decompressor():
+    return zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+
+
+def _zstd_decompressor():
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def _lz4_decompressor():
+    return lz4_frame.LZ4FrameDecompressor()
+
+
+def local_decompressors() -> Dict[str, Callable[[], Any]]:
+    factories: Dict[str, Callable[[], Any]] = {'gzip': _gzip_decompressor}
+    if zstandard is not None:
+        factories['zstd'] = _zstd_decompressor
+    if lz4_frame is not None:
+        factories['lz4'] = _lz4_decompressor
+    return factories
+
+
+def select_compression(requested: str, remote_compressors: List[str]) -> str:
+    if requested == 'none':
+        return 'none'
+    local = local_decompressors()
+    candidates = COMPRESSION_METHODS if requested == 'auto' else (requested,)
+    for method in candidates:
+        if method in local and method in remote_compressors:
+            return method
+    if requested == 'auto':
+        return 'none'
+    if requested not in local:
+        raise LookupError(f'Python module for {requested} decompression is not installed')
+    raise LookupError(f'{requested} not found in remote host')
+
+
+class StreamDecompressor():
+
+    def __init__(self, method: str):
+        self.method = method
+        self._factory = local_decompressors()[method]
+        self._decompressor = self._factory()
+        self.input_bytes = 0
+        self.output_bytes = 0
+
+    @property
+    def ratio(self) -> float:
+        return self.output_bytes / self.input_bytes if self.input_bytes else 0.0
+
+    def decompress(self, data: memoryview) -> bytes:
+        self.input_bytes += len(data)
+        try:
+            output = self._decompressor.decompress(data)
+            # Compressor may start new frame, e.g. gzip member or zstd frame after flush
+            while self._decompressor.eof and (unused := self._decompressor.unused_data):
+                self._decompressor = self._factory()
+                output += self._decompressor.decompress(unused)
+        except DECOMPRESSOR_ERRORS as error:
+            raise DecompressError(f'Corrupt {self.method} stream: {error}') from error
+        self.output_bytes += len(output)
+        return output
@@ -0,0 +1,286 @@
+import logging
+import socket
+from argparse import ArgumentParser, Namespace
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Any, Dict, Generator, Optional, Tuple, Union
+
+from paramiko import AutoAddPolicy, SSHClient
+from paramiko.config import SSHConfig
+
+from .compression import select_compression
+from .preflight import PreflightCache, PreflightResult, run_preflight
+from .remote_command import CaptureOptions
+from .startup import startup_phase
+
+# Host, port, user and key file of pooled connection, password is not part of it
+ConnectionKey = Tuple[str, int, str, Optional[str]]
+
+# Keys in ~/.ssh used when neither argument nor SSH config gives one, in order of preference
+DEFAULT_IDENTITY_FILES = ('id_rsa', 'id_dsa', 'id_ecdsa', 'id_ed25519')
+
+
+def connect_client(hostname: str, port: Union[str, int], user: str, password: Optional[str],
+                   identityfile: Optional[str], timeout: Optional[float] = None,
+                   **_kwargs) -> SSHClient:
+    client = SSHClient()
+    client.set_missing_host_key_policy(AutoAddPolicy())
+    with startup_phase(f'connect {hostname}'):
+        sock = socket.create_connection((hostname, int(port)), timeout)
+    try:
+        with startup_phase(f'auth {user}@{hostname}'):
+            if password is not None:
+                # Keys of agent and ~/.ssh are not offered before password, each costs round trip
+                client.connect(hostname=hostname, port=int(port), username=user,
+                               password=password, timeout=timeout, sock=sock,
+                               allow_agent=False, look_for_keys=False)
+            else:
+                assert identityfile is not None
+                client.connect(hostname=hostname, port=int(port), username=user,
+                               key_filename=str(identityfile), timeout=timeout, sock=sock)
+    except BaseException:
+        sock.close()
+        raise
+    return client
+
+
+@contextmanager
+def ssh_connection(**connection) -> Generator[SSHClient, None, None]:
+    client = connect_client(**connection)
+
+    yield client
+
+    client.close()
+
+
+class PooledConnection():  # pylint: disable=too-few-public-methods
+
+    def __init__(self) -> None:
+        self.client: Optional[SSHClient] = None
+        # Users holding or waiting for connection, changed under pool lock
+        self.users = 0
+        self.idle_since = monotonic()
+        # Held while connecting, concurrent users of the same host wait for one login
+        self.lock = Lock()
+
+    @property
+    def active(self) -> bool:
+        transport = self.client.get_transport() if self.client is not None else None
+        return transport is not None and transport.is_active()
+
+
+class SSHConnectionPool():
+    # Connected clients shared by captures and remote commands of the same host and login,
+    # each of them opens its own channel on the same transport
+
+    def __init__(self, idle_timeout: float = 300.0, keepalive: int = 30):
+        self.logger = logging.getLogger('ssh_pool')
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self._connections: Dict[ConnectionKey, PooledConnection] = {}
+        self._lock = Lock()
+        self._closed = Event()
+        self._reaper: Optional[Thread] = None
+
+    @staticmethod
+    def make_key(hostname: str, port: Union[str, int], user: str,
+                 identityfile: Optional[str] = None, **_kwargs) -> ConnectionKey:
+        return hostname, int(port), user, str(identityfile) if identityfile else None
+
+    def acquire(self, **connection) -> SSHClient:
+        key = self.make_key(**connection)
+        with self._lock:
+            if self._closed.is_set():
+                raise RuntimeError('SSH connection pool is closed')
+            pooled = self._connections.setdefault(key, PooledConnection())
+            pooled.users += 1
+            if self._reaper is None:
+                self._reaper = Thread(target=self._reap, name='ssh_pool.reaper', daemon=True)
+                self._reaper.start()
+        try:
+            with pooled.lock:
+                if pooled.active:
+                    self.logger.debug(f'Reusing connection to {self.describe(key)}')
+                else:
+                    self._connect(pooled, key, connection)
+                client = pooled.client
+        except BaseException:
+            self.release(None, **connection)
+            raise
+        assert client is not None
+        return client
+
+    def _connect(self, pooled: PooledConnection, key: ConnectionKey, connection: Dict):
+        # Dead transport is replaced, its users have already lost their channels
+        if pooled.client is not None:
+            self.logger.info(f'Reconnecting to {self.describe(key)}')
+            pooled.client.close()
+        started = monotonic()
+        pooled.client = connect_client(**connection)
+        transport = pooled.client.get_transport()
+        assert transport is not None
+        # Idle pooled connection is kept alive through NAT and its death is noticed
+        transport.set_keepalive(self.keepalive)
+        self.logger.info(f'Connected to {self.describe(key)} in '
+                         f'{(monotonic() - started) * 1000:.0f} ms')
+
+    def release(self, client: Optional[SSHClient], /, **connection):
+        key = self.make_key(**connection)
+        with self._lock:
+            pooled = self._connections.get(key)
+            if pooled is not None:
+                pooled.users -= 1
+                if pooled.users == 0:
+                    pooled.idle_since = monotonic()
+        # Client replaced after reconnect or left after pool was closed
+        if client is not None and (pooled is None or pooled.client is not client):
+            client.close()
+
+    @contextmanager
+    def connection(self, **connection) -> Generator[SSHClient, None, None]:
+        client = self.acquire(**connection)
+        try:
+            yield client
+        finally:
+            self.release(client, **connection)
+
+    def expire(self, idle_timeout: Optional[float] = None):
+        idle_timeout = self.idle_timeout if idle_timeout is None else idle_timeout
+        now = monotonic()
+        with self._lock:
+            expired = {key: pooled for key, pooled in self._connections.items()
+                       if pooled.users == 0 and (now - pooled.idle_since >= idle_timeout or
+                                                 not pooled.active)}
+            for key in expired:
+                del self._connections[key]
+        for key, pooled in expired.items():
+            if pooled.client is not None:
+                self.logger.info(f'Closing idle connection to {self.describe(key)}')
+                pooled.client.close()
+
+    def _reap(self):
+        while not self._closed.wait(min(self.idle_timeout, 60.0)):
+            self.expire()
+
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for pooled in connections:
+            if pooled.client is not None:
+                pooled.client.close()
+
+    @staticmethod
+    def describe(key: ConnectionKey) -> str:
+        hostname, port, user, _identityfile = key
+        return f'{user}@{hostname}:{port}'
+
+
+def lookup_connection(remote: str, user: Optional[str] = None, password: Optional[str] = None,
+                      identityfile: Optional[str] = None) -> Dict:
+    # Given values take precedence over user SSH config, missing login values stay None
+    # Prepare values from arguments
+    arg_vals: Dict[str, Any] = {}
+    if ':' in remote:
+        arg_vals['hostname'], arg_vals['port'] = remote.split(':')
+    else:
+        arg_vals['hostname'] = remote
+    arg_vals['user'] = user
+    arg_vals['password'] = password
+    arg_vals['identityfile'] = identityfile
+
+    ssh_dir = Path('~/.ssh/').expanduser()
+
+    # Prepare values from ssh config
+    cfg_vals: Dict[str, Any] = {}
+    config_path = ssh_dir.joinpath('config')
+    ssh_config = SSHConfig.from_path(str(config_path)) if config_path.is_file() else SSHConfig()
+    if remote in ssh_config.get_hostnames():
+        logging.info(f'Found host {remote} in user SSH config file')
+        host_config = ssh_config.lookup(remote)
+        for key in ('hostname', 'port', 'user', 'identityfile'):
+            cfg_vals[key] = host_config.get(key)
+        if isinstance(cfg_vals['identityfile'], list):
+            cfg_vals['identityfile'] = cfg_vals['identityfile'][0]
+
+    # Prepare default values
+    default_vals = {
+        'port': 22,
+        'identityfile': next(filter(Path.is_file, (ssh_dir.joinpath(name)
+                                                   for name in DEFAULT_IDENTITY_FILES)), None)
+    }
+
+    # Prepare result values
+    result_kwargs: Dict[str, Any] = {
+        'hostname': cfg_vals.get('hostname') or arg_vals.get('hostname')
+    }
+    for key in ('port', 'user', 'password', 'identityfile'):
+        result_kwargs[key] = arg_vals.get(key) or cfg_vals.get(key) or default_vals.get(key)
+    return result_kwargs
+
+
+def resolve_connection(parser: ArgumentParser, prog_args: Namespace, remote: str) -> Dict:
+    result_kwargs = lookup_connection(remote, prog_args.user, prog_args.password,
+                                      prog_args.identityfile)
+    if result_kwargs['user'] is None:
+        parser.error('the following arguments are required: -u/--user')
+
+    if result_kwargs['password'] is None and result_kwargs['identityfile'] is None:
+        parser.error('the following arguments are required: -p/--password or -k/--identityfile')
+
+    return result_kwargs
+
+
+def check_remote_host(connected_client: SSHClient, remote_interface: str,
+                      cache: Optional[PreflightCache] = None,
+                      connection: Optional[Dict] = None) -> PreflightResult:
+    result = cache.load(**connection) if cache and connection else None
+    # Interface may appear after result was cached, check again before failing
+    if result is None or remote_interface not in result.interfaces:
+        result = run_preflight(connected_client)
+        fresh = True
+    else:
+        fresh = False
+
+    if result.tcpdump_path is None:
+        raise LookupError('tcpdump not found in remote host')
+
+    if not result.sudo:
+        logging.critical('Cannot run "sudo tcpdump" without password.')
+        logging.info('Please run this command in remote host: '
+                     '"echo -e "${USER}\tALL=NOPASSWD: $(which tcpdump)" '
+                     '| sudo tee /etc/sudoers.d/tcpdump"')
+        raise RuntimeError('Cannot run "sudo tcpdump" without password')
+    logging.debug(f'tcpdump version in remote host: {result.tcpdump_version}')
+
+    if remote_interface not in result.interfaces:
+        raise RuntimeError(f'Interface "{remote_interface}" not found '
+                           f'in remote host, available_interfaces={result.interfaces}')
+    if fresh and cache and connection:
+        cache.store(result, **connection)
+    return result
+
+
+def prepare_source(pool: SSHConnectionPool, connection: Dict, interface: str,
+                   cache: Optional[PreflightCache] = None) -> Tuple[SSHClient, PreflightResult]:
+    # Connects and checks remote host in worker thread while startup goes on, connection is
+    # released by caller after capture
+    client = pool.acquire(**connection)
+    try:
+        with startup_phase(f'preflight {connection["hostname"]}/{interface}'):
+            preflight = check_remote_host(client, interface, cache, connection)
+    except BaseException:
+        pool.release(client, **connection)
+        raise
+    return client, preflight
+
+
+def resolve_compression(options: CaptureOptions, preflight: PreflightResult) -> CaptureOptions:
+    compression = select_compression(options.compression, list(preflight.compressors))
+    if options.compression != 'none':
+        logging.info(f'Compressed transport: {compression}, remote host has '
+                     f'{", ".join(preflight.compressors) or "no compressors"}')
+    return options._replace(compression=compression)
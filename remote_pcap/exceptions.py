@@ -1,15 +1,19 @@
 
-class ParseMessageError(Exception):
+class StopError(Exception):
     pass
 
 
-class StopError(Exception):
+class ParseProcFSError(Exception):
     pass
 
 
-class ParseProcFSError(Exception):
+class ParsePcapError(Exception):
+    pass
+
+
+class CaptureFailedError(Exception):
     pass
 
 
-class ConvertLogLevelError(Exception):
+class DecompressError(Exception):
     pass
@@ -0,0 +1,113 @@
+import logging
+from collections import deque
+from threading import Condition, Thread
+from typing import Deque, Dict, List, Optional
+
+
+class FanoutConsumer(Thread):
+
+    def __init__(self, name: str, sink):
+        Thread.__init__(self, name=name, daemon=True)
+        self.logger = logging.getLogger(self.name)
+        self.sink = sink
+        self.queued_bytes = 0
+        self.written_bytes = 0
+        self.opened = False
+        self.detached = False
+        self._chunks: Deque[Optional[bytes]] = deque()
+        self._condition = Condition()
+
+    def put(self, chunk: Optional[bytes]):
+        with self._condition:
+            if self.detached:
+                return
+            if chunk is not None:
+                self.queued_bytes += len(chunk)
+            self._chunks.append(chunk)
+            self._condition.notify_all()
+
+    def detach(self):
+        with self._condition:
+            self.logger.warning(f'Consumer is too slow, {self.queued_bytes} bytes queued, '
+                                'detaching it')
+            self.detached = True
+            self._chunks.clear()
+            self._chunks.append(None)
+            self._condition.notify_all()
+
+    def stats(self) -> Dict[str, float]:
+        return {'bytes': self.written_bytes, 'queued_bytes': self.queued_bytes,
+                'detached': int(self.detached)}
+
+    def wait_queue_below(self, limit: int):
+        with self._condition:
+            while self.queued_bytes > limit and not self.detached:
+                self._condition.wait()
+
+    def run(self):
+        try:
+            self.sink.open()
+            self.opened = True
+            while True:
+                with self._condition:
+                    while not self._chunks:
+                        self._condition.wait()
+                    chunk = self._chunks.popleft()
+                if chunk is None:
+                    break
+                with memoryview(chunk) as view:
+                    self.sink.write(view)
+                self.written_bytes += len(chunk)
+                with self._condition:
+                    self.queued_bytes -= len(chunk)
+                    self._condition.notify_all()
+        except BrokenPipeError:
+            self.logger.info('Consumer closed the pipe')
+        except OSError as error:
+            self.logger.error(f'Failed to write to consumer: {error}')
+        finally:
+            with self._condition:
+                self.detached = True
+                self._chunks.clear()
+                self._condition.notify_all()
+            self.sink.close()
+
+
+class TeeSink():
+
+    def __init__(self, name: str, sinks: List, max_queue_bytes: int = 64 * 1024 * 1024):
+        self.name = name
+        self.logger = logging.getLogger(self.name)
+        self.max_queue_bytes = max_queue_bytes
+        self.consumers = [FanoutConsumer(f'{name}.{index}', sink)
+                          for index, sink in enumerate(sinks)]
+
+    def open(self):
+        for consumer in self.consumers:
+            consumer.start()
+
+    def write(self, data: memoryview):
+        active = [consumer for consumer in self.consumers if not consumer.detached]
+        if not active:
+            raise BrokenPipeError('All consumers are detached')
+        # One immutable copy of the reusable pump buffer is shared by all consumers
+        chunk = bytes(data)
+        for consumer in active:
+            consumer.put(chunk)
+
+        fastest = min(active, key=lambda consumer: consumer.queued_bytes)
+        if len(active) > 1 and fastest.queued_bytes < self.max_queue_bytes // 2:
+            # Slow consumer is dropped only while others keep up with the stream
+            # Analyzer which is still starting get more room before it is dropped
+            for consumer in active:
+                limit = self.max_queue_bytes if consumer.opened else self.max_queue_bytes * 4
+                if consumer.queued_bytes > limit:
+                    consumer.detach()
+        # All consumers are slow, push back to remote side through SSH window
+        fastest.wait_queue_below(self.max_queue_bytes)
+
+    def close(self):
+        for consumer in self.consumers:
+            consumer.put(None)
+        for consumer in self.consumers:
+            consumer.join(timeout=1)
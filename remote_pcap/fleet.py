@@ -0,0 +1,307 @@
+import logging
+import re
+import sys
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack
+from fnmatch import fnmatchcase
+from pathlib import Path
+from threading import Event, Lock
+from time import monotonic
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, TextIO
+
+from paramiko.config import SSHConfig
+
+from .capture_writer import CaptureWriter
+from .connection import (SSHConnectionPool, check_remote_host,
+                         resolve_compression)
+from .metrics import MetricsRegistry, Stats
+from .preflight import PreflightCache
+from .remote_command import CaptureOptions
+from .tool_runner import ToolRunner
+
+try:
+    import tomllib
+except ImportError:
+    try:
+        import tomli as tomllib  # type: ignore
+    except ImportError:
+        tomllib = None  # type: ignore
+
+try:
+    import yaml  # type: ignore
+except ImportError:
+    yaml = None  # type: ignore
+
+# Settings which host entry or host list file may set, others come from command line
+HOST_SETTINGS = ('interface', 'user', 'password', 'identityfile', 'filter')
+
+# Output file name template fields
+DEFAULT_OUTPUT = '{host}_{interface}.pcap'
+
+STATE_NAMES = ('pending', 'connecting', 'checking', 'running', 'stopped', 'failed', 'cancelled')
+
+
+class FleetHost(NamedTuple):
+    name: str
+    remote: str
+    interface: str
+    user: Optional[str] = None
+    password: Optional[str] = None
+    identityfile: Optional[str] = None
+    filter: Optional[str] = None
+
+    @property
+    def label(self) -> str:
+        return f'{self.name}/{self.interface}'
+
+    def login(self) -> Dict[str, str]:
+        # Values overriding command line arguments of the same name
+        return {key: value for key, value in (('user', self.user), ('password', self.password),
+                                              ('identityfile', self.identityfile))
+                if value is not None}
+
+
+def read_hosts_file(path: Path) -> Dict[str, Any]:
+    if path.suffix == '.toml':
+        if tomllib is None:
+            raise ImportError('tomli is required for TOML host list before Python 3.11')
+        with open(path, 'rb') as hosts_file:
+            content = tomllib.load(hosts_file)
+    else:
+        if yaml is None:
+            raise ImportError('PyYAML is required for YAML host list, '
+                              'install remote_pcap[yaml]')
+        with open(path, encoding='utf-8') as hosts_file:
+            content = yaml.safe_load(hosts_file) or {}
+    if isinstance(content, list):
+        content = {'hosts': content}
+    if not isinstance(content, dict) or not isinstance(content.get('hosts', []), list):
+        raise ValueError(f'{path}: expected list of hosts or table with "hosts" list')
+    return content
+
+
+def config_hosts(pattern: str, config_path: Optional[Path] = None) -> List[str]:
+    # Concrete host names of SSH config matching shell-style pattern
+    config_path = config_path or Path('~/.ssh/config').expanduser()
+    if not config_path.exists():
+        return []
+    hostnames = SSHConfig.from_path(str(config_path)).get_hostnames()
+    return sorted(hostname for hostname in hostnames
+                  if not re.search(r'[*?!]', hostname) and fnmatchcase(hostname, pattern))
+
+
+def make_host(entry: Any, defaults: Dict[str, Any]) -> FleetHost:
+    if isinstance(entry, str):
+        entry = {'host': entry}
+    if not isinstance(entry, dict) or not entry.get('host'):
+        raise ValueError(f'host entry without "host" value: {entry!r}')
+    unknown = set(entry) - {'host', 'name', *HOST_SETTINGS}
+    if unknown:
+        raise ValueError(f'unknown settings of host {entry["host"]}: {", ".join(sorted(unknown))}')
+    settings = {key: entry.get(key, defaults.get(key)) for key in HOST_SETTINGS}
+    if not (interface := settings.pop('interface')):
+        raise ValueError(f'capture interface of host {entry["host"]} is not set')
+    remote = str(entry['host'])
+    return FleetHost(name=str(entry.get('name') or remote), remote=remote,
+                     interface=str(interface),
+                     **{key: None if value is None else str(value)
+                        for key, value in settings.items()})
+
+
+def load_hosts(specs: Sequence[str], defaults: Dict[str, Any],
+               config_path: Optional[Path] = None) -> List[FleetHost]:
+    # Each spec is TOML or YAML host list file, SSH config host pattern or host name
+    hosts: List[FleetHost] = []
+    for spec in specs:
+        path = Path(spec)
+        if path.suffix in ('.toml', '.yaml', '.yml') and path.is_file():
+            content = read_hosts_file(path)
+            file_defaults = dict(defaults, **{key: content[key] for key in HOST_SETTINGS
+                                              if key in content})
+            hosts.extend(make_host(entry, file_defaults) for entry in content.get('hosts', []))
+        elif re.search(r'[*?\[]', spec):
+            matched = config_hosts(spec, config_path)
+            if not matched:
+                raise ValueError(f'no hosts of SSH config match {spec!r}')
+            hosts.extend(make_host(hostname, defaults) for hostname in matched)
+        else:
+            hosts.append(make_host(spec, defaults))
+
+    labels = [host.label for host in hosts]
+    if duplicates := sorted({label for label in labels if labels.count(label) > 1}):
+        raise ValueError(f'duplicate hosts: {", ".join(duplicates)}')
+    return hosts
+
+
+def output_path(template: str, host: FleetHost) -> str:
+    def safe(value: str) -> str:
+        return re.sub(r'[^\w.@-]', '_', value)
+    return template.format(host=safe(host.name), interface=safe(host.interface))
+
+
+class HostCapture():
+
+    def __init__(self, host: FleetHost, connection: Dict[str, Any], output: str):
+        self.host = host
+        self.name = host.label
+        self.connection = connection
+        self.output = output
+        self.state = 'pending'
+        self.error = ''
+        self.runner: Optional[ToolRunner] = None
+        self.started_at: Optional[float] = None
+        # SSH client of host, released after its capture is stopped
+        self.stack = ExitStack()
+
+    def fail(self, error: str):
+        self.state = 'failed'
+        self.error = error
+
+    def stats(self) -> Stats:
+        stats: Stats = {'state': STATE_NAMES.index(self.state)}
+        if (runner := self.runner) is None or runner.dumper is None:
+            return stats
+        stats.update(runner.dumper.stats())
+        for sink in runner.sinks:
+            if isinstance(sink, CaptureWriter):
+                stats['files'] = sink.files_written
+        return stats
+
+
+class FleetCapture():
+    # pylint: disable=too-many-instance-attributes
+
+    # pylint: disable-next=too-many-arguments,too-many-positional-arguments
+    def __init__(self, hosts: List[HostCapture], runner_kwargs: Dict[str, Any], jobs: int = 16,
+                 preflight_cache: Optional[PreflightCache] = None,
+                 connect_timeout: Optional[float] = 10.0):
+        self.logger = logging.getLogger('fleet')
+        self.hosts = hosts
+        self.runner_kwargs = runner_kwargs
+        self.jobs = jobs
+        self.preflight_cache = preflight_cache
+        self.connect_timeout = connect_timeout
+        # Entries of the same host and login share one SSH connection
+        self.pool = SSHConnectionPool()
+        self.registry = MetricsRegistry('fleet.metrics')
+        for host in hosts:
+            self.registry.register(host.name, host.stats)
+        self.started_at = 0.0
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._futures: List[Future] = []
+        self._need_stop = Event()
+        self._lock = Lock()
+        self._start_reported = False
+
+    @property
+    def failed(self) -> List[HostCapture]:
+        return [host for host in self.hosts if host.state == 'failed']
+
+    def start(self):
+        # Preflight of slow host does not delay others, each capture starts once its host is
+        # checked
+        self.started_at = monotonic()
+        self._executor = ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix='fleet')
+        self._futures = [self._executor.submit(self.start_host, host) for host in self.hosts]
+
+    def start_host(self, host: HostCapture):
+        if self._need_stop.is_set():
+            host.state = 'cancelled'
+            return
+        try:
+            host.state = 'connecting'
+            client = host.stack.enter_context(self.pool.connection(timeout=self.connect_timeout,
+                                                                   **host.connection))
+            host.state = 'checking'
+            preflight = check_remote_host(client, host.host.interface, self.preflight_cache,
+                                          host.connection)
+            options: CaptureOptions = self.runner_kwargs['capture_options']
+            if host.host.filter is not None:
+                options = options._replace(filter=host.host.filter)
+            options = resolve_compression(options, preflight)
+            Path(host.output).parent.mkdir(parents=True, exist_ok=True)
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            self.logger.error(f'Failed to prepare capture in {host.name}: {error}')
+            host.fail(str(error) or type(error).__name__)
+            return
+
+        with self._lock:
+            if self._need_stop.is_set():
+                host.state = 'cancelled'
+                return
+            kwargs = dict(self.runner_kwargs, **host.connection, interface=host.host.interface,
+                          analyzer=[], outputs=[host.output], capture_options=options,
+                          tcpdump_path=preflight.tcpdump_path)
+            host.runner = ToolRunner(f'runner.{host.name}', client=client, **kwargs)
+            host.runner.start()
+            host.started_at = monotonic()
+            host.state = 'running'
+        self.logger.info(f'Capture started in {host.name} after '
+                         f'{host.started_at - self.started_at:.2f} s')
+
+    def update(self) -> bool:
+        # Returns whether any host is still starting or capturing
+        for host in self.hosts:
+            if host.state != 'running' or host.runner is None or host.runner.is_alive():
+                continue
+            if host.runner.capture_failed:
+                host.fail('capture was terminated by remote side with error')
+                if self.preflight_cache is not None:
+                    self.preflight_cache.invalidate(**host.connection)
+            else:
+                host.state = 'stopped'
+
+        starting = not all(future.done() for future in self._futures)
+        if not starting and not self._start_reported:
+            self._start_reported = True
+            running = sum(host.started_at is not None for host in self.hosts)
+            self.logger.info(f'Capture started in {running} of {len(self.hosts)} hosts in '
+                             f'{monotonic() - self.started_at:.2f} s')
+        return starting or any(host.state == 'running' for host in self.hosts)
+
+    def stop(self):
+        self.logger.info('Stoping ...')
+        with self._lock:
+            self._need_stop.set()
+        for future in self._futures:
+            future.cancel()
+        runners = [host.runner for host in self.hosts if host.runner is not None]
+        # All captures are stopped at once, then waited for
+        for runner in runners:
+            runner.stop()
+        for runner in runners:
+            runner.join()
+        if self._executor is not None:
+            # Host being connected is bounded by connect timeout
+            self._executor.shutdown(wait=True)
+        for host in self.hosts:
+            if host.state in ('pending', 'connecting', 'checking'):
+                host.state = 'cancelled'
+            host.stack.close()
+        self.pool.close()
+        self.update()
+
+    def show_status(self, snapshot: Dict[str, Stats], output: TextIO = sys.stdout):
+        output.write(render_status(self.hosts, snapshot, monotonic() - self.started_at))
+        output.flush()
+
+
+def render_status(hosts: List[HostCapture], snapshot: Dict[str, Stats], elapsed: float) -> str:
+    width = max([len(host.name) for host in hosts] + [4])
+    lines = [f'--- fleet capture, {elapsed:.0f} s',
+             f'{"HOST":<{width}}  {"STATE":<10} {"PACKETS":>12} {"MBIT/S":>8} {"FILES":>5}']
+    totals = {'packets': 0.0, 'rate': 0.0}
+    for host in hosts:
+        stats = snapshot.get(host.name, {})
+        packets = stats.get('packets', 0)
+        rate = stats.get('bytes_per_second', 0) * 8 / 1e6
+        totals['packets'] += packets
+        totals['rate'] += rate
+        line = (f'{host.name:<{width}}  {host.state:<10} {packets:>12,.0f} {rate:>8.1f} '
+                f'{stats.get("files", 0):>5.0f}')
+        lines.append(f'{line}  {host.error}' if host.error else line)
+    counts = {state: sum(host.state == state for host in hosts) for state in STATE_NAMES}
+    summary = ', '.join(f'{count} {state}' for state, count in counts.items() if count)
+    lines.append(f'{len(hosts)} hosts: {summary}; {totals["packets"]:,.0f} packets, '
+                 f'{totals["rate"]:.1f} Mbit/s')
+    return '\n'.join(lines) + '\n'
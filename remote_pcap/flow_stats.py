@@ -0,0 +1,401 @@
+import json
+import logging
+import multiprocessing
+import queue
+import sys
+from pathlib import Path
+from threading import Event, Lock, Thread
+from time import monotonic, time
+from typing import Any, Dict, List, NamedTuple, Optional, TextIO, Tuple
+
+from .metrics import Stats
+from .packet_index import PacketIndexReader, format_address
+
+try:
+    import numpy
+    from numpy.lib.recfunctions import repack_fields
+except ImportError:
+    numpy = None  # type: ignore
+
+# Directional 5-tuple, media streams of call are separate flows
+FLOW_FIELDS = ('protocol', 'src', 'dst', 'sport', 'dport')
+
+# Fields of packet index sent to workers
+WORKER_FIELDS = ('timestamp', 'origlen', 'ip_version', *FLOW_FIELDS, 'rtp', 'rtp_payload_type',
+                 'rtp_sequence', 'rtp_timestamp', 'rtp_ssrc')
+
+# Clock rates of static RTP payload types, dynamic types are assumed to be 8 kHz audio
+RTP_CLOCK_RATES = {0: 8000, 3: 8000, 4: 8000, 5: 8000, 7: 8000, 8: 8000, 9: 8000, 12: 8000,
+                   13: 8000, 15: 8000, 18: 8000, 10: 44100, 11: 44100, 14: 90000, 25: 90000,
+                   26: 90000, 28: 90000, 31: 90000, 32: 90000, 33: 90000, 34: 90000}
+DEFAULT_RTP_CLOCK_RATE = 8000
+
+# Sequence number step larger than this is restart of stream, not loss
+MAX_RTP_DROPOUT = 3000
+
+PROTOCOL_NAMES = {1: 'icmp', 6: 'tcp', 17: 'udp', 58: 'icmp6', 132: 'sctp'}
+
+
+class FlowStatsOptions(NamedTuple):
+    output: Optional[str] = None
+    top: int = 20
+    workers: int = 2
+    interval: float = 5.0
+    idle_timeout: float = 60.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.output is not None
+
+
+class RtpState():
+    # Loss and interarrival jitter of one SSRC as in RFC 3550 A.1 and A.8
+    # pylint: disable=too-few-public-methods,too-many-instance-attributes
+
+    def __init__(self, ssrc: int, payload_type: int, sequence: int):
+        self.ssrc = ssrc
+        self.payload_type = payload_type
+        self.clock_rate = RTP_CLOCK_RATES.get(payload_type, DEFAULT_RTP_CLOCK_RATE)
+        self.base_sequence = sequence
+        self.max_sequence = sequence - 1
+        self.received = 0
+        self.misordered = 0
+        self.jitter = 0.0
+        self._transit: Optional[float] = None
+
+    def update(self, arrivals: List[int], sequences: List[int], timestamps: List[int]):
+        max_sequence = self.max_sequence
+        jitter = self.jitter
+        transit_before = self._transit
+        clock = self.clock_rate / 1e9
+        for arrival, sequence, timestamp in zip(arrivals, sequences, timestamps):
+            step = (sequence - max_sequence) & 0xffff
+            if 0 < step < MAX_RTP_DROPOUT:
+                max_sequence += step
+            elif step >= 0x8000 or step == 0:
+                # Late or duplicated packet
+                self.misordered += 1
+            else:
+                # Large jump is restart of sender, counting starts again
+                self.base_sequence = max_sequence = sequence
+                self.received = 0
+            transit = arrival * clock - timestamp
+            if transit_before is not None:
+                # Difference of 32-bit RTP timestamps is kept in range around zero
+                difference = (transit - transit_before + 2 ** 31) % 2 ** 32 - 2 ** 31
+                jitter += (abs(difference) - jitter) / 16
+            transit_before = transit
+        self.received += len(sequences)
+        self.max_sequence = max_sequence
+        self.jitter = jitter
+        self._transit = transit_before
+
+    @property
+    def expected(self) -> int:
+        return self.max_sequence - self.base_sequence + 1
+
+    @property
+    def lost(self) -> int:
+        # Duplicates may make received larger than expected
+        return max(self.expected - self.received, 0)
+
+    def stats(self) -> Dict[str, Any]:
+        expected = self.expected
+        return {'ssrc': f'0x{self.ssrc:08x}', 'payload_type': self.payload_type,
+                'lost': self.lost, 'loss': self.lost / expected if expected > 0 else 0.0,
+                'misordered': self.misordered,
+                'jitter_ms': self.jitter / self.clock_rate * 1000}
+
+
+class FlowState():
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, key: Tuple, first_seen: int):
+        self.key = key
+        self.packets = 0
+        self.bytes = 0
+        self.first_seen = first_seen
+        self.last_seen = first_seen
+        self.reported_bytes = 0
+        self.reported_packets = 0
+        self.last_active = monotonic()
+        self.rtp: Optional[RtpState] = None
+
+
+class FlowTable():
+    # Flows of one shard, each packet of flow comes to the same table in capture order
+
+    def __init__(self, idle_timeout: float = 60.0):
+        self.idle_timeout = idle_timeout
+        self.flows: Dict[bytes, FlowState] = {}
+        self.packets = 0
+        self.bytes = 0
+        self._reported_at = monotonic()
+        self._reported_bytes = 0
+        self._reported_packets = 0
+
+    def update(self, rows: 'numpy.ndarray'):
+        rows = rows[rows['ip_version'] != 0]
+        if len(rows) == 0:
+            return
+        keys = numpy.zeros(len(rows), dtype=[(field, rows.dtype[field]) for field in FLOW_FIELDS])
+        for field in FLOW_FIELDS:
+            keys[field] = rows[field]
+        flows, first, inverse = numpy.unique(keys.view(f'V{keys.dtype.itemsize}'),
+                                             return_index=True, return_inverse=True)
+        inverse = inverse.ravel()
+        packets = numpy.bincount(inverse, minlength=len(flows))
+        sizes = numpy.bincount(inverse, weights=rows['origlen'], minlength=len(flows))
+        last = numpy.zeros(len(flows), dtype=numpy.int64)
+        numpy.maximum.at(last, inverse, rows['timestamp'])
+        now = monotonic()
+        flow_ids = flows.tolist()
+        for number, flow in enumerate(flow_ids):
+            state = self.flows.get(flow)
+            if state is None:
+                state = self.flows[flow] = FlowState(flow_tuple(keys[first[number]]),
+                                                     int(rows['timestamp'][first[number]]))
+            state.packets += int(packets[number])
+            state.bytes += int(sizes[number])
+            state.last_seen = max(state.last_seen, int(last[number]))
+            state.last_active = now
+        if rows['rtp'].any():
+            self.update_rtp_flows(rows, inverse, flow_ids)
+        self.packets += len(rows)
+        self.bytes += int(rows['origlen'].sum())
+
+    def update_rtp_flows(self, rows: 'numpy.ndarray', inverse: 'numpy.ndarray',
+                         flow_ids: List[bytes]):
+        # RTP packets grouped by flow keep capture order inside of each flow
+        is_rtp = rows['rtp']
+        order = numpy.argsort(inverse[is_rtp], kind='stable')
+        numbers, starts = numpy.unique(inverse[is_rtp][order], return_index=True)
+        for number, group in zip(numbers.tolist(), numpy.split(rows[is_rtp][order], starts[1:])):
+            self.update_rtp(self.flows[flow_ids[number]], group)
+
+    @staticmethod
+    def update_rtp(state: FlowState, rows: 'numpy.ndarray'):
+        # Packets of other SSRC than first one of flow are ignored until stream changes
+        # for good, i.e. until whole batch has new SSRC
+        ssrc = state.rtp.ssrc if state.rtp is not None else int(rows['rtp_ssrc'][0])
+        selected = rows[rows['rtp_ssrc'] == ssrc]
+        if len(selected) == 0:
+            ssrc = int(rows['rtp_ssrc'][-1])
+            selected = rows[rows['rtp_ssrc'] == ssrc]
+            state.rtp = None
+        if state.rtp is None:
+            state.rtp = RtpState(ssrc, int(selected['rtp_payload_type'][0]),
+                                 int(selected['rtp_sequence'][0]))
+        state.rtp.update(selected['timestamp'].tolist(), selected['rtp_sequence'].tolist(),
+                         selected['rtp_timestamp'].tolist())
+
+    def report(self, top: int) -> Dict[str, Any]:
+        # Top flows by rate since previous report, idle flows are forgotten
+        now = monotonic()
+        elapsed = max(now - self._reported_at, 1e-6)
+        self._reported_at = now
+        rows = []
+        for flow, state in list(self.flows.items()):
+            if now - state.last_active > self.idle_timeout:
+                del self.flows[flow]
+                continue
+            rows.append((state.bytes - state.reported_bytes,
+                         state.packets - state.reported_packets, state))
+            state.reported_bytes, state.reported_packets = state.bytes, state.packets
+        rows.sort(key=lambda row: (row[0], row[2].bytes), reverse=True)
+        bytes_per_second = (self.bytes - self._reported_bytes) / elapsed
+        packets_per_second = (self.packets - self._reported_packets) / elapsed
+        self._reported_bytes, self._reported_packets = self.bytes, self.packets
+        return {'flows': len(self.flows), 'packets': self.packets, 'bytes': self.bytes,
+                'bits_per_second': bytes_per_second * 8,
+                'packets_per_second': packets_per_second,
+                'top': [flow_row(state, interval_bytes / elapsed, interval_packets / elapsed)
+                        for interval_bytes, interval_packets, state in rows[:top]]}
+
+
+def flow_tuple(key) -> Tuple:
+    return (int(key['protocol']), format_address(key['src']), int(key['sport']),
+            format_address(key['dst']), int(key['dport']))
+
+
+def flow_row(state: FlowState, bytes_per_second: float, packets_per_second: float
+             ) -> Dict[str, Any]:
+    protocol, src, sport, dst, dport = state.key
+    row = {'protocol': PROTOCOL_NAMES.get(protocol, str(protocol)),
+           'src': src, 'sport': sport, 'dst': dst, 'dport': dport,
+           'packets': state.packets, 'bytes': state.bytes,
+           'bits_per_second': bytes_per_second * 8, 'packets_per_second': packets_per_second,
+           'first_seen': state.first_seen / 1e9, 'last_seen': state.last_seen / 1e9}
+    # Flow which is mostly RTP-like is reported as media stream
+    if state.rtp is not None and state.rtp.received * 2 > state.packets:
+        row['rtp'] = state.rtp.stats()
+    return row
+
+
+def flow_worker(inbox: 'multiprocessing.Queue', outbox: 'multiprocessing.Queue',
+                number: int, idle_timeout: float):
+    table = FlowTable(idle_timeout)
+    while (message := inbox.get()) is not None:
+        kind, value = message
+        if kind == 'rows':
+            table.update(value)
+        else:
+            outbox.put((number, value, table.report(top=value[1])))
+
+
+def shard_numbers(index: 'numpy.ndarray', shards: int) -> 'numpy.ndarray':
+    # Hash of 5-tuple, the same in every process
+    hashed = index['protocol'].astype(numpy.uint64) * numpy.uint64(0x9e3779b97f4a7c15)
+    for field in ('src', 'dst'):
+        words = numpy.ascontiguousarray(index[field]).view(numpy.uint64)
+        for column in range(words.shape[1]):
+            hashed = (hashed ^ words[:, column]) * numpy.uint64(0x100000001b3)
+    for field in ('sport', 'dport'):
+        hashed = (hashed ^ index[field].astype(numpy.uint64)) * numpy.uint64(0x100000001b3)
+    return (hashed >> numpy.uint64(33)) % numpy.uint64(shards)
+
+
+def merge_reports(reports: List[Dict[str, Any]], top: int) -> Dict[str, Any]:
+    # Shards have disjoint flows, so global top is among top of each shard
+    flows = [row for report in reports for row in report['top']]
+    flows.sort(key=lambda row: (row['bits_per_second'], row['bytes']), reverse=True)
+    return {'timestamp': time(),
+            'flows': sum(report['flows'] for report in reports),
+            'packets': sum(report['packets'] for report in reports),
+            'bytes': sum(report['bytes'] for report in reports),
+            'bits_per_second': sum(report['bits_per_second'] for report in reports),
+            'packets_per_second': sum(report['packets_per_second'] for report in reports),
+            'top': flows[:top]}
+
+
+def render_flows(view: Dict[str, Any]) -> str:
+    endpoints = [(f'{row["src"]}:{row["sport"]}', f'{row["dst"]}:{row["dport"]}')
+                 for row in view['top']]
+    width = max([len(endpoint) for pair in endpoints for endpoint in pair] + [11])
+    lines = [f'--- {view["flows"]} flows, {view["packets"]:,} packets, '
+             f'{view["bytes"] / 1e6:,.1f} MB, {view["bits_per_second"] / 1e6:.1f} Mbit/s, '
+             f'{view["packets_per_second"]:,.0f} packets/s',
+             f'{"PROTO":<5} {"SOURCE":<{width}} {"DESTINATION":<{width}} {"MBIT/S":>8} '
+             f'{"PPS":>8} {"PACKETS":>12}  RTP']
+    for row, (source, destination) in zip(view['top'], endpoints):
+        line = (f'{row["protocol"]:<5} {source:<{width}} {destination:<{width}} '
+                f'{row["bits_per_second"] / 1e6:>8.2f} {row["packets_per_second"]:>8.0f} '
+                f'{row["packets"]:>12,}')
+        if rtp := row.get('rtp'):
+            line += (f'  pt {rtp["payload_type"]} lost {rtp["lost"]} ({rtp["loss"]:.1%}) '
+                     f'jitter {rtp["jitter_ms"]:.1f} ms')
+        lines.append(line)
+    return '\n'.join(lines) + '\n'
+
+
+class FlowStatsSink():
+    # Capture stream consumer, packets are parsed here and sharded by 5-tuple to worker
+    # processes which keep per-flow counters, merged top flows are published periodically
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, name: str, options: FlowStatsOptions, output: TextIO = sys.stdout):
+        if numpy is None:
+            raise ImportError('NumPy is required for flow statistics, '
+                              'install remote_pcap[numpy]')
+        self.name = name
+        self.logger = logging.getLogger(self.name)
+        self.options = options
+        self.output = output
+        self.reader = PacketIndexReader(batch_size=1 << 62, rtp=True)
+        self.latest: Dict[str, Any] = {}
+        self._context = multiprocessing.get_context('spawn')
+        self._inboxes: List[multiprocessing.Queue] = []
+        self._outbox: Optional[multiprocessing.Queue] = None
+        self._workers: List[Any] = []
+        self._publisher: Optional[Thread] = None
+        self._need_stop = Event()
+        self._lock = Lock()
+        self._requests = 0
+
+    def open(self):
+        # Workers are not forked, parent has SSH and reactor threads
+        self._outbox = self._context.Queue()
+        for number in range(self.options.workers):
+            # Bounded queue pushes back to capture stream, flow stats never grow without limit
+            inbox = self._context.Queue(maxsize=64)
+            worker = self._context.Process(target=flow_worker, name=f'{self.name}.{number}',
+                                           args=(inbox, self._outbox, number,
+                                                 self.options.idle_timeout), daemon=True)
+            worker.start()
+            self._inboxes.append(inbox)
+            self._workers.append(worker)
+        self._publisher = Thread(target=self._publish_loop, name=f'{self.name}.publisher',
+                                 daemon=True)
+        self._publisher.start()
+        self.logger.info(f'Started {len(self._workers)} flow statistics workers')
+
+    def write(self, data: memoryview):
+        self.reader.feed(data)
+        for index in self.reader.flush():
+            rows = repack_fields(index[list(WORKER_FIELDS)])
+            shards = shard_numbers(rows, len(self._inboxes))
+            for number, inbox in enumerate(self._inboxes):
+                selected = rows[shards == number]
+                if len(selected):
+                    inbox.put(('rows', selected))
+
+    def _publish_loop(self):
+        while not self._need_stop.wait(self.options.interval):
+            self.publish()
+
+    def publish(self):
+        with self._lock:
+            self._requests += 1
+            request = (self._requests, self.options.top)
+            for inbox in self._inboxes:
+                inbox.put(('report', request))
+            reports = self._collect(request)
+        if reports is None:
+            return
+        self.latest = merge_reports(reports, self.options.top)
+        if self.options.output == '-':
+            self.output.write(render_flows(self.latest))
+            self.output.flush()
+            return
+        # Readers never see partially written file
+        path = Path(str(self.options.output))
+        temporary_path = path.with_name(f'.{path.name}.tmp')
+        try:
+            with open(temporary_path, 'w', encoding='utf-8') as output_file:
+                json.dump(self.latest, output_file, indent=1)
+            temporary_path.replace(path)
+        except OSError as error:
+            self.logger.error(f'Failed to write flow statistics file: {error}')
+
+    def _collect(self, request: Tuple[int, int]) -> Optional[List[Dict[str, Any]]]:
+        assert self._outbox is not None
+        reports: Dict[int, Dict[str, Any]] = {}
+        deadline = monotonic() + self.options.interval
+        while len(reports) < len(self._inboxes):
+            try:
+                number, answered, report = self._outbox.get(
+                    timeout=max(deadline - monotonic(), 0.01))
+            except queue.Empty:
+                self.logger.warning('Flow statistics workers are behind the capture stream')
+                return None
+            # Answer to request which timed out earlier is dropped
+            if answered == request:
+                reports[number] = report
+        return list(reports.values())
+
+    def close(self):
+        self._need_stop.set()
+        if self._publisher is not None:
+            self._publisher.join()
+        if self._workers:
+            self.publish()
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for worker in self._workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+
+    def stats(self) -> Stats:
+        return {'packets': self.reader.packets, 'bytes': self.reader.bytes,
+                'flows': self.latest.get('flows', 0)}
@@ -0,0 +1,96 @@
+import logging
+from time import localtime, mktime, struct_time, time
+from typing import NamedTuple, Optional, Tuple
+
+from .log_patterns import (filename_lineno_func, only_message,
+                           process_timestamp_level)
+
+LOG_LEVELS = {
+    'NONE': logging.NOTSET,
+    'CRITICAL': logging.CRITICAL,
+    'ERROR': logging.ERROR,
+    'WARNING': logging.WARNING,
+    'INFO': logging.INFO,
+    'DEBUG': logging.DEBUG,
+    'MESSAGE': logging.DEBUG,
+    'NOISY': logging.DEBUG
+}
+
+
+class LogLine(NamedTuple):
+    process: str
+    pid: int
+    clock: str
+    microsecs: int
+    subsystem: str
+    level: int
+    filename: str
+    lineno: int
+    function: str
+    message: str
+
+
+# Returned instead of parsed line when its level is below requested one
+SKIPPED_LINE = LogLine('', 0, '', 0, '', logging.NOTSET, '', 0, '', '')
+
+
+class LogLineParser():  # pylint: disable=too-few-public-methods
+
+    def __init__(self, no_subsystem_name: Optional[str] = None):
+        self.no_subsystem_name = no_subsystem_name
+
+    def parse(self, data: str, min_level: int = logging.NOTSET) -> Optional[LogLine]:
+        # Line is scanned once by position, None is returned for unknown format
+        header = process_timestamp_level.match(data)
+        if header is None:
+            return None
+        process, pid, clock, microsecs, subsystem, level_name = header.groups()
+        if (level := LOG_LEVELS.get(level_name)) is None:
+            return None
+        if level < min_level:
+            return SKIPPED_LINE
+        subsystem = subsystem or self.no_subsystem_name
+        if subsystem is None or (body := self._parse_body(data, header.end(), subsystem)) is None:
+            return None
+        return LogLine(process, int(pid), clock, int(microsecs), subsystem, level, *body)
+
+    @staticmethod
+    def _parse_body(data: str, position: int,
+                    subsystem: str) -> Optional[Tuple[str, int, str, str]]:
+        if location := filename_lineno_func.match(data, position):
+            filename, lineno, function = location.groups()
+            position = location.end()
+        elif prefix := only_message.match(data, position):
+            filename, lineno, function = subsystem, 0, subsystem
+            position = prefix.end()
+        else:
+            return None
+        if position == len(data):
+            return None
+        return filename, int(lineno), function, data[position:]
+
+
+class LocalClock():  # pylint: disable=too-few-public-methods
+
+    def __init__(self):
+        self._day_end = 0.0
+        self._today = localtime(0)
+        self._clock = ''
+        self._seconds = 0.0
+
+    def timestamp(self, clock: str) -> float:
+        # Log lines carry only time of day, epoch is computed once per distinct second
+        now = time()
+        if now >= self._day_end:
+            today = self._today = localtime(now)
+            self._day_end = mktime((today.tm_year, today.tm_mon, today.tm_mday + 1,
+                                    0, 0, 0, 0, 0, -1))
+            self._clock = ''
+        if clock != self._clock:
+            today = self._today
+            self._seconds = mktime(struct_time((today.tm_year, today.tm_mon, today.tm_mday,
+                                                int(clock[0:2]), int(clock[3:5]),
+                                                int(clock[6:8]), today.tm_wday,
+                                                today.tm_yday, today.tm_isdst)))
+            self._clock = clock
+        return self._seconds
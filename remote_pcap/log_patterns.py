@@ -1,10 +1,12 @@
 import re
 
-process_timestamp = re.compile(r'\*\* \((?P<process>\w+):(?P<pid>\d+)\) '
-                               r'(?P<hour>\d\d):(?P<mins>\d\d):(?P<secs>\d\d)\.'
-                               r'(?P<microsecs>\d{6}) ')
-subsystem_level = re.compile(r'\[(?P<subsystem>\w+) (?P<level>\w+)\] ')
-level_without_subsystem = re.compile(r'\[\(none\) (?P<level>\w+)\] ')
-filename_lineno_func_msg = re.compile(r'(?P<filename>[^:]+):(?P<lineno>\d+) -- '
-                                      r'(?P<function>\w+\(\)): (?P<message>.+)')
-only_message = re.compile(r'-- (?P<message>.+)')
+# Process, timestamp, subsystem and level are parsed by one match, "(none)" subsystem
+# is reported by wireshark for messages without it
+process_timestamp_level = re.compile(r'\*\* \((?P<process>\w+):(?P<pid>\d+)\) '
+                                     r'(?P<clock>\d\d:\d\d:\d\d)\.(?P<microsecs>\d{6}) '
+                                     r'\[(?:\(none\)|(?P<subsystem>\w+)) (?P<level>\w+)\] ')
+filename_lineno_func = re.compile(r'(?P<filename>[^:]+):(?P<lineno>\d+) -- '
+                                  r'(?P<function>\w+\(\)): ')
+only_message = re.compile(r'-- ')
+tcpdump_summary = re.compile(r'(?P<count>\d+) packets? (?P<counter>captured|received by filter|'
+                             r'dropped by kernel|dropped by interface)')
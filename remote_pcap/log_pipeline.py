@@ -0,0 +1,204 @@
+import atexit
+import io
+import logging
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from threading import Lock
+from time import monotonic
+from typing import Dict, List, Optional, TextIO, Tuple
+
+DEFAULT_FORMAT = '%(asctime)s %(name)s %(levelname)s %(filename)s:%(lineno)d %(message)s'
+
+# Records written between two flushes of output stream
+WRITE_BATCH = 256
+
+
+class SubsystemState():
+    # Token bucket and last message of one logger and child subsystem
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, burst: float, now: float):
+        self.tokens = burst
+        self.updated = now
+        self.rate_limited = 0
+        self.last_message: Optional[Tuple[int, str]] = None
+        self.repeated = 0
+        self.repeat_reported = now
+        self.limit_reported = now
+
+
+class PipelineHandler(QueueHandler):
+    # Producer side, never blocks: duplicates and lines above rate of subsystem are counted
+    # and summarized instead of queued, record which does not fit into queue is dropped
+
+    # pylint: disable-next=too-many-arguments,too-many-positional-arguments
+    def __init__(self, log_queue: queue.Queue, rate: float = 100.0, burst: float = 500.0,
+                 repeat_interval: float = 10.0, subsystems_limit: int = 1024):
+        super().__init__(log_queue)
+        self.rate = rate
+        self.burst = burst
+        self.repeat_interval = repeat_interval
+        self.subsystems_limit = subsystems_limit
+        self.subsystems: Dict[Tuple[str, str], SubsystemState] = {}
+        self.rate_limited = 0
+        self.duplicates = 0
+        self.queue_full = 0
+        self._queue_full_reported = 0
+        self._lock = Lock()
+
+    def handle(self, record: logging.LogRecord) -> bool:  # type: ignore[override]
+        if not self.filter(record):
+            return False
+        with self._lock:
+            records = self.admit(record)
+        for admitted in records:
+            self.emit(admitted)
+        return bool(records)
+
+    def admit(self, record: logging.LogRecord) -> List[logging.LogRecord]:
+        # Returns summaries of suppressed lines followed by record itself if it passes
+        now = monotonic()
+        key = (record.name, getattr(record, 'subsystem', ''))
+        if (state := self.subsystems.get(key)) is None:
+            if len(self.subsystems) >= self.subsystems_limit:
+                self.subsystems.clear()
+            state = self.subsystems[key] = SubsystemState(self.burst, now)
+        records = []
+        message = (record.levelno, record.getMessage())
+        if message == state.last_message:
+            state.repeated += 1
+            self.duplicates += 1
+            if now - state.repeat_reported < self.repeat_interval:
+                return []
+            records.append(self.summary(record, f'last message repeated {state.repeated} times'))
+            state.repeated, state.repeat_reported = 0, now
+            return records
+        if state.repeated:
+            records.append(self.summary(record, f'last message repeated {state.repeated} times'))
+            state.repeated = 0
+        state.last_message, state.repeat_reported = message, now
+
+        state.tokens = min(state.tokens + (now - state.updated) * self.rate, self.burst)
+        state.updated = now
+        if state.tokens < 1 and record.levelno < logging.CRITICAL:
+            state.rate_limited += 1
+            self.rate_limited += 1
+            return records
+        state.tokens -= 1
+        # Summary of long overload is written once per interval
+        if state.rate_limited and now - state.limit_reported >= self.repeat_interval:
+            records.append(self.summary(record, f'{state.rate_limited} lines dropped by rate '
+                                                'limit'))
+            state.rate_limited, state.limit_reported = 0, now
+        records.append(record)
+        return records
+
+    @staticmethod
+    def summary(record: logging.LogRecord, message: str) -> logging.LogRecord:
+        summary = logging.makeLogRecord(dict(record.__dict__, msg=message, args=(),
+                                             exc_info=None, exc_text=None))
+        summary.levelno, summary.levelname = logging.WARNING, 'WARNING'
+        return summary
+
+    def enqueue(self, record: logging.LogRecord):
+        log_queue: queue.Queue = self.queue  # type: ignore[assignment]
+        try:
+            # Drops are reported once listener caught up, not between every two records
+            if self.queue_full > self._queue_full_reported and \
+                    log_queue.qsize() < log_queue.maxsize // 2:
+                dropped = self.queue_full - self._queue_full_reported
+                self.queue.put_nowait(self.summary(record, f'{dropped} log lines dropped, '
+                                                           'log output is too slow'))
+                self._queue_full_reported = self.queue_full
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.queue_full += 1
+
+
+class BatchStreamHandler(logging.StreamHandler):
+    # Stream is flushed by listener once queued records are written
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:  # pylint: disable=broad-exception-caught
+            self.handleError(record)
+
+
+class BatchQueueListener(QueueListener):
+
+    def __init__(self, log_queue: queue.Queue, *handlers: logging.Handler):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.log_queue = log_queue
+        self.written = 0
+        self._batched = 0
+
+    def enqueue_sentinel(self):
+        # Waits for room instead of failing when queue is full on stop
+        self.log_queue.put(self._sentinel)  # type: ignore[attr-defined]
+
+    def handle(self, record: logging.LogRecord):
+        super().handle(record)
+        self.written += 1
+        self._batched += 1
+        if self._batched >= WRITE_BATCH or self.log_queue.empty():
+            for handler in self.handlers:
+                handler.flush()
+            self._batched = 0
+
+
+class LogPipeline():
+    # Root logger hands records to queue, output is written by listener thread
+
+    installed: Optional['LogPipeline'] = None
+
+    # pylint: disable-next=too-many-arguments,too-many-positional-arguments
+    def __init__(self, level: int = logging.DEBUG, fmt: str = DEFAULT_FORMAT,
+                 stream: Optional[TextIO] = None, queue_size: int = 10000,
+                 rate: float = 100.0, burst: float = 500.0):
+        self.level = level
+        self.queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.handler = PipelineHandler(self.queue, rate=rate, burst=burst)
+        if stream is None:
+            # Own buffer lets batch of lines reach terminal in one write
+            stream = io.TextIOWrapper(io.FileIO(sys.stderr.fileno(), 'w', closefd=False),
+                                      encoding='utf-8', errors='replace', write_through=False)
+        self.output = BatchStreamHandler(stream)
+        self.output.setFormatter(logging.Formatter(fmt))
+        self.listener = BatchQueueListener(self.queue, self.output)
+
+    def start(self):
+        root = logging.getLogger()
+        root.setLevel(self.level)
+        root.addHandler(self.handler)
+        self.listener.start()
+
+    def stop(self):
+        # Queued records are written before return
+        logging.getLogger().removeHandler(self.handler)
+        self.listener.stop()
+        self.output.flush()
+
+    def stats(self) -> Dict[str, float]:
+        return {'queued': self.queue.qsize(), 'written': self.listener.written,
+                'dropped_queue_full': self.handler.queue_full,
+                'dropped_rate_limit': self.handler.rate_limited,
+                'suppressed_duplicates': self.handler.duplicates}
+
+
+def setup_logging(level: int = logging.DEBUG, **kwargs) -> LogPipeline:
+    if LogPipeline.installed is not None:
+        LogPipeline.installed.stop()
+    else:
+        # Records queued before sys.exit() are not lost
+        atexit.register(shutdown_logging)
+    LogPipeline.installed = LogPipeline(level, **kwargs)
+    LogPipeline.installed.start()
+    return LogPipeline.installed
+
+
+def shutdown_logging():
+    if LogPipeline.installed is not None:
+        LogPipeline.installed.stop()
+        LogPipeline.installed = None
@@ -0,0 +1,218 @@
+import json
+import logging
+import os
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from socketserver import ThreadingMixIn, UnixStreamServer
+from threading import Event, Lock, Thread
+from time import monotonic, time
+from typing import Callable, Dict, NamedTuple, Optional, Union
+
+from paramiko import SSHClient, SSHException
+
+from .log_patterns import tcpdump_summary
+
+Stats = Dict[str, float]
+
+# Counters for which per second rate is computed between two collections
+RATE_METRICS = ('bytes', 'packets', 'wire_bytes')
+
+TCPDUMP_SUMMARY_METRICS = {
+    'captured': 'remote_captured',
+    'received by filter': 'remote_received_by_filter',
+    'dropped by kernel': 'remote_dropped_by_kernel',
+    'dropped by interface': 'remote_dropped_by_interface'
+}
+
+INTERFACE_COUNTERS = ('rx_packets', 'rx_bytes', 'rx_dropped', 'rx_missed_errors',
+                      'rx_fifo_errors')
+
+
+class MetricsOptions(NamedTuple):
+    stats_file: Optional[str] = None
+    listen: Optional[str] = None
+    interval: float = 5.0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.stats_file or self.listen)
+
+
+def parse_tcpdump_summary(line: str, stats: Stats) -> bool:
+    # tcpdump prints statistics to stderr on exit, e.g. "12 packets dropped by kernel"
+    if 'packet' in line and (match_obj := tcpdump_summary.search(line)):
+        stats[TCPDUMP_SUMMARY_METRICS[match_obj['counter']]] = int(match_obj['count'])
+        return True
+    return False
+
+
+class RemoteInterfaceStats():  # pylint: disable=too-few-public-methods
+
+    def __init__(self, name: str, get_client: Callable[[], SSHClient], interface: str,
+                 timeout: float = 5.0):
+        self.name = name
+        self.logger = logging.getLogger(self.name)
+        # Capture may move to new connection after reconnect, current one is asked each time
+        self.get_client = get_client
+        self.interface = interface
+        self.timeout = timeout
+        paths = ' '.join(f'/sys/class/net/{interface}/statistics/{counter}'
+                         for counter in INTERFACE_COUNTERS)
+        self.command = f'cat {paths} 2>/dev/null'
+
+    def stats(self) -> Stats:
+        # Read over the same SSH connection which carries capture
+        try:
+            _, stdout, _ = self.get_client().exec_command(self.command, timeout=self.timeout)
+            values = stdout.read().split()
+        except (OSError, SSHException) as error:
+            self.logger.warning(f'Failed to read interface statistics: {error}')
+            return {}
+        return {counter: int(value) for counter, value in zip(INTERFACE_COUNTERS, values)}
+
+
+class MetricsRegistry():
+
+    def __init__(self, name: str = 'metrics'):
+        self.name = name
+        self.logger = logging.getLogger(self.name)
+        self._stages: Dict[str, Callable[[], Stats]] = {}
+        self._previous: Dict[str, Stats] = {}
+        self._previous_time = 0.0
+        self._lock = Lock()
+
+    def register(self, name: str, stats: Callable[[], Stats]):
+        with self._lock:
+            self._stages[name] = stats
+
+    def collect(self) -> Dict[str, Stats]:
+        with self._lock:
+            stages = list(self._stages.items())
+        now = monotonic()
+        elapsed = now - self._previous_time
+        snapshot = {}
+        for name, stats in stages:
+            try:
+                values = dict(stats())
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                self.logger.warning(f'Failed to collect statistics of {name}: {error}')
+                continue
+            previous = self._previous.get(name, {})
+            for metric in RATE_METRICS:
+                if metric in values and metric in previous and elapsed > 0:
+                    values[f'{metric}_per_second'] = (values[metric] - previous[metric]) / elapsed
+            # Time needed to drain data queued before stage at current rate
+            if values.get('queued_bytes') and values.get('bytes_per_second'):
+                values['lag_seconds'] = values['queued_bytes'] / values['bytes_per_second']
+            snapshot[name] = values
+        self._previous = snapshot
+        self._previous_time = now
+        return snapshot
+
+
+def render_prometheus(snapshot: Dict[str, Stats]) -> str:
+    metrics: Dict[str, Dict[str, float]] = {}
+    for stage, values in snapshot.items():
+        for metric, value in values.items():
+            metrics.setdefault(metric, {})[stage] = value
+    lines = []
+    for metric, stages in sorted(metrics.items()):
+        lines.append(f'# TYPE remote_pcap_{metric} gauge')
+        for stage, value in sorted(stages.items()):
+            stage_label = stage.replace('\\', '\\\\').replace('"', '\\"')
+            value = int(value) if float(value).is_integer() else float(value)
+            lines.append(f'remote_pcap_{metric}{{stage="{stage_label}"}} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def __init__(self, publisher: 'MetricsPublisher', *args, **kwargs):
+        self.publisher = publisher
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        body = render_prometheus(self.publisher.latest).encode(encoding='utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self) -> str:
+        # Client address of Unix socket is empty string
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+class UnixMetricsServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+class MetricsPublisher(Thread):
+
+    def __init__(self, name: str, registry: MetricsRegistry, interval: float = 5.0,
+                 stats_file: Optional[Union[Path, str]] = None, listen: Optional[str] = None,
+                 on_publish: Optional[Callable[[Dict[str, Stats]], None]] = None):
+        Thread.__init__(self, name=name, daemon=True)
+        self.logger = logging.getLogger(self.name)
+        self.registry = registry
+        self.interval = interval
+        self.stats_file = Path(stats_file) if stats_file else None
+        self.listen = listen
+        self.on_publish = on_publish
+        self.latest: Dict[str, Stats] = {}
+        self._server: Optional[Union[ThreadingHTTPServer, UnixMetricsServer]] = None
+        self._need_stop = Event()
+
+    def create_server(self, listen: str) -> Union[ThreadingHTTPServer, UnixMetricsServer]:
+        handler = partial(MetricsRequestHandler, self)
+        if listen.startswith('unix:'):
+            path = listen[len('unix:'):]
+            if os.path.exists(path):
+                os.remove(path)
+            return UnixMetricsServer(path, handler)
+        host, _, port = listen.rpartition(':')
+        return ThreadingHTTPServer((host or '127.0.0.1', int(port)), handler)
+
+    def start(self):
+        # Error of listening socket is reported to caller, not lost in thread
+        if self.listen:
+            self._server = self.create_server(self.listen)
+            self.logger.info(f'Serving Prometheus metrics on {self.listen}')
+            Thread(target=self._server.serve_forever, name=f'{self.name}.server',
+                   daemon=True).start()
+        super().start()
+
+    def run(self):
+        self.publish()
+        while not self._need_stop.wait(self.interval):
+            self.publish()
+        self.publish()
+
+    def publish(self):
+        self.latest = self.registry.collect()
+        if self.on_publish is not None:
+            self.on_publish(self.latest)
+        if self.stats_file is None:
+            return
+        # Readers never see partially written file
+        temporary_path = self.stats_file.with_name(f'.{self.stats_file.name}.tmp')
+        try:
+            with open(temporary_path, 'w', encoding='utf-8') as stats_file:
+                json.dump({'timestamp': time(), 'stages': self.latest}, stats_file, indent=1)
+            temporary_path.replace(self.stats_file)
+        except OSError as error:
+            self.logger.error(f'Failed to write statistics file: {error}')
+
+    def stop(self):
+        self._need_stop.set()
+        self.join(timeout=self.interval + 1)
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            if isinstance(self._server, UnixMetricsServer):
+                os.remove(self._server.server_address)
@@ -0,0 +1,583 @@
+import ipaddress
+import struct
+from typing import (BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple,
+                    Union)
+
+try:
+    import numpy
+    from numpy.lib.stride_tricks import sliding_window_view
+except ImportError:
+    numpy = None  # type: ignore
+
+from .exceptions import ParsePcapError
+from .pcap_stream import (PCAP_GLOBAL_HEADER_SIZE, PCAP_MAGIC_MICROSECONDS,
+                          PCAP_MAGIC_NANOSECONDS, PCAP_RECORD_HEADER_SIZE,
+                          PCAPNG_BYTE_ORDER_MAGIC, PCAPNG_ENHANCED_PACKET,
+                          PCAPNG_INTERFACE_DESCRIPTION, PCAPNG_PACKET,
+                          PCAPNG_SECTION_HEADER, PCAPNG_SIMPLE_PACKET,
+                          PcapInterface, parse_interface_block)
+
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+
+# Offsets of protocol type field and of network header for link layers with such field
+LINK_LAYERS = {
+    LINKTYPE_ETHERNET: (12, 14),
+    LINKTYPE_LINUX_SLL: (14, 16),
+    LINKTYPE_LINUX_SLL2: (0, 20)
+}
+RAW_LINKTYPES = (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6)
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+ETHERTYPE_VLAN = (0x8100, 0x88a8, 0x9100)
+VLAN_TAG_SIZE = 4
+MAX_VLAN_TAGS = 2
+
+# Transport protocols which carry ports in first four bytes
+PORT_PROTOCOLS = (6, 17, 132)
+
+PCAPNG_PACKET_HEADER_SIZE = 28
+PCAPNG_SIMPLE_PACKET_HEADER_SIZE = 12
+
+# Bytes of each packet copied for header parsing: link layer with two VLAN tags,
+# IPv4 header with options and ports
+HEADER_WINDOW = 96
+
+# IPv4 addresses are stored as IPv4-mapped IPv6 addresses
+IPV4_MAPPED_PREFIX = b'\x00' * 10 + b'\xff\xff'
+
+PACKET_INDEX_FIELDS: List[Tuple] = [
+    ('timestamp', 'i8'),
+    ('caplen', 'u4'),
+    ('origlen', 'u4'),
+    ('offset', 'i8'),
+    ('interface', 'u4'),
+    ('ip_version', 'u1'),
+    ('protocol', 'u1'),
+    ('src', 'u1', (16,)),
+    ('dst', 'u1', (16,)),
+    ('sport', 'u2'),
+    ('dport', 'u2')
+]
+
+# Header of UDP payload which looks like RTP, filled when reader is asked for it
+RTP_FIELDS: List[Tuple] = [
+    ('rtp', '?'),
+    ('rtp_payload_type', 'u1'),
+    ('rtp_sequence', 'u2'),
+    ('rtp_timestamp', 'u4'),
+    ('rtp_ssrc', 'u4')
+]
+# TCP flags byte, filled when reader is asked for it
+TCP_FIELDS: List[Tuple] = [('tcp_flags', 'u1')]
+TCP_FLAGS_OFFSET = 13
+
+RTP_HEADER_SIZE = 12
+UDP_HEADER_SIZE = 8
+# Payload types 72-76 with marker bit are RTCP packet types 200-204
+RTCP_PAYLOAD_TYPES = range(72, 77)
+
+# Conversation key, endpoint "a" is lower one so both directions have the same key
+ENDPOINT_FIELDS = [('address', 'u1', (16,)), ('port', '>u2')]
+FLOW_KEY_FIELDS = [('protocol', 'u1'), ('a', ENDPOINT_FIELDS), ('b', ENDPOINT_FIELDS)]
+
+FlowKey = Tuple[int, str, int, str, int]
+
+
+def numpy_available() -> bool:
+    return numpy is not None
+
+
+def format_address(address) -> str:
+    # Address field of packet index row
+    parsed = ipaddress.IPv6Address(bytes(address))
+    return str(parsed.ipv4_mapped or parsed)
+
+
+def flow_keys(index: 'numpy.ndarray') -> 'numpy.ndarray':
+    keys = numpy.zeros(len(index), dtype=FLOW_KEY_FIELDS)
+    keys['protocol'] = index['protocol']
+    keys['a']['address'], keys['a']['port'] = index['src'], index['sport']
+    keys['b']['address'], keys['b']['port'] = index['dst'], index['dport']
+    # Fixed size big-endian bytes compare as (address, port) tuples
+    size = numpy.dtype(ENDPOINT_FIELDS).itemsize
+    swap = keys['a'].view(f'S{size}') > keys['b'].view(f'S{size}')
+    keys['a'][swap], keys['b'][swap] = keys['b'][swap], keys['a'][swap].copy()
+    return keys
+
+
+def flow_key_array(key: FlowKey) -> 'numpy.ndarray':
+    # Inverse of flow_key(), for comparison with flow_keys() result
+    protocol, a, a_port, b, b_port = key
+    array = numpy.zeros(1, dtype=FLOW_KEY_FIELDS)
+    array['protocol'] = protocol
+    for endpoint, address, port in (('a', a, a_port), ('b', b, b_port)):
+        parsed = ipaddress.ip_address(address)
+        if parsed.version == 4:
+            parsed = ipaddress.IPv6Address(IPV4_MAPPED_PREFIX + parsed.packed)
+        array[endpoint]['address'] = numpy.frombuffer(parsed.packed, dtype=numpy.uint8)
+        array[endpoint]['port'] = port
+    return array[0]
+
+
+def flow_key(key) -> FlowKey:
+    # Row of flow_keys() result as plain values
+    return (int(key['protocol']), format_address(key['a']['address']), int(key['a']['port']),
+            format_address(key['b']['address']), int(key['b']['port']))
+
+
+def summarize_flows(index: 'numpy.ndarray') -> Iterator[Tuple[FlowKey, int, int, int]]:
+    # Yields key, first and last record offset and packets of each flow of batch
+    index = index[index['ip_version'] != 0]
+    if len(index) == 0:
+        return
+    keys = flow_keys(index)
+    flows, first, inverse, packets = numpy.unique(
+        keys.view(f'V{keys.dtype.itemsize}'), return_index=True, return_inverse=True,
+        return_counts=True)
+    last = numpy.zeros(len(flows), dtype=numpy.int64)
+    numpy.maximum.at(last, inverse.ravel(), index['offset'])
+    for key, first_offset, last_offset, count in zip(flows.view(FLOW_KEY_FIELDS),
+                                                     index['offset'][first], last, packets):
+        yield flow_key(key), int(first_offset), int(last_offset), int(count)
+
+
+def select_flow(batch: 'numpy.ndarray', target: 'numpy.ndarray', start: Optional[int],
+                end: Optional[int]) -> 'numpy.ndarray':
+    # Stream offsets of packets of flow inside of time window
+    selected = flow_keys(batch) == target
+    if start is not None:
+        selected &= batch['timestamp'] >= start
+    if end is not None:
+        selected &= batch['timestamp'] <= end
+    return batch['offset'][selected]
+
+
+class PacketIndexReader():
+    # Record headers are walked in Python only to follow offset chain, all fields are
+    # decoded by NumPy for whole chunk at once
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, batch_size: int = 65536, payload_ports: Iterable[int] = (),
+                 rtp: bool = False, tcp: bool = False):
+        if numpy is None:
+            raise ImportError('NumPy is required for packet index, '
+                              'install remote_pcap[numpy]')
+        self.batch_size = batch_size
+        # Transport payload of TCP and UDP packets of these ports by record offset,
+        # consumer removes payloads of returned batches
+        self.payload_ports = numpy.array(sorted(payload_ports), dtype=numpy.int64)
+        self.payloads: Dict[int, bytes] = {}
+        self.fields = PACKET_INDEX_FIELDS + (RTP_FIELDS if rtp else []) + \
+            (TCP_FIELDS if tcp else [])
+        self.format: Optional[str] = None
+        self.byteorder = '<'
+        self.interfaces: List[PcapInterface] = []
+        self.packets = 0
+        self.bytes = 0
+        self.last_timestamp = 0
+        self._buffer = bytearray()
+        self._buffer_offset = 0
+        self._need_header = True
+        self._ts_multiplier = 1000
+        self._record_length = struct.Struct('<I')
+        self._block_header = struct.Struct('<II')
+        self._batches: List['numpy.ndarray'] = []
+        self._batched = 0
+
+    def feed(self, data) -> List['numpy.ndarray']:
+        # Returns complete batches, incomplete record is kept until next call
+        self._buffer += data
+        self.bytes += len(data)
+        end = len(self._buffer)
+        # Padding keeps header window of last packet inside buffer
+        self._buffer += bytes(HEADER_WINDOW)
+        try:
+            pos = self._parse(end)
+        finally:
+            del self._buffer[end:]
+        del self._buffer[:pos]
+        self._buffer_offset += pos
+        return self._take_batches(final=False)
+
+    def flush(self) -> List['numpy.ndarray']:
+        return self._take_batches(final=True)
+
+    @property
+    def parsed_offset(self) -> int:
+        # Stream offset of first byte of incomplete record
+        return self._buffer_offset
+
+    def _parse(self, end: int) -> int:
+        pos = 0
+        while True:
+            if self._need_header:
+                header_end = self._parse_file_header(pos, end)
+                if header_end is None:
+                    return pos
+                pos = header_end
+            if self.format == 'pcap':
+                offsets: List[int] = []
+                pos = self._walk_pcap(pos, end, offsets)
+                if offsets:
+                    self._add(self._decode_pcap(offsets))
+                return pos
+            groups: Tuple[List[int], List[int], List[int]] = ([], [], [])
+            pos = self._walk_pcapng(pos, end, groups)
+            if any(groups):
+                self._add(self._decode_pcapng(*groups))
+            if not self._need_header:
+                return pos
+
+    def _parse_file_header(self, pos: int, end: int) -> Optional[int]:
+        if end - pos < 12:
+            return None
+        magic_le, = struct.unpack_from('<I', self._buffer, pos)
+        magic_be, = struct.unpack_from('>I', self._buffer, pos)
+        if magic_le == PCAPNG_SECTION_HEADER:
+            return self._parse_section_header(pos, end)
+        if end - pos < PCAP_GLOBAL_HEADER_SIZE:
+            return None
+        if PCAP_MAGIC_MICROSECONDS in (magic_le, magic_be):
+            self._ts_multiplier = 1000
+        elif PCAP_MAGIC_NANOSECONDS in (magic_le, magic_be):
+            self._ts_multiplier = 1
+        else:
+            raise ParsePcapError(f'Unknown capture file magic: '
+                                 f'{bytes(self._buffer[pos:pos + 4]).hex()}')
+        self.format = 'pcap'
+        self._set_byteorder('<' if magic_le in (PCAP_MAGIC_MICROSECONDS,
+                                                PCAP_MAGIC_NANOSECONDS) else '>')
+        snaplen, linktype = struct.unpack_from(self.byteorder + 'II', self._buffer, pos + 16)
+        self.interfaces = [PcapInterface(linktype & 0x0fffffff, snaplen,
+                                         self._ts_multiplier, 1)]
+        self._need_header = False
+        return pos + PCAP_GLOBAL_HEADER_SIZE
+
+    def _parse_section_header(self, pos: int, end: int) -> Optional[int]:
+        if struct.unpack_from('<I', self._buffer, pos + 8)[0] == PCAPNG_BYTE_ORDER_MAGIC:
+            byteorder = '<'
+        elif struct.unpack_from('>I', self._buffer, pos + 8)[0] == PCAPNG_BYTE_ORDER_MAGIC:
+            byteorder = '>'
+        else:
+            raise ParsePcapError('Invalid pcapng byte order magic')
+        total_length, = struct.unpack_from(byteorder + 'I', self._buffer, pos + 4)
+        if total_length < 28 or total_length % 4:
+            raise ParsePcapError(f'Invalid pcapng section header length {total_length}')
+        if end - pos < total_length:
+            return None
+        self.format = 'pcapng'
+        self._set_byteorder(byteorder)
+        self.interfaces = []
+        self._need_header = False
+        return pos + total_length
+
+    def _set_byteorder(self, byteorder: str):
+        self.byteorder = byteorder
+        self._record_length = struct.Struct(byteorder + 'I')
+        self._block_header = struct.Struct(byteorder + 'II')
+
+    def _walk_pcap(self, pos: int, end: int, offsets: List[int]) -> int:
+        buffer = self._buffer
+        unpack_from = self._record_length.unpack_from
+        append = offsets.append
+        while pos + PCAP_RECORD_HEADER_SIZE <= end:
+            next_pos = pos + PCAP_RECORD_HEADER_SIZE + unpack_from(buffer, pos + 8)[0]
+            if next_pos > end:
+                break
+            append(pos)
+            pos = next_pos
+        return pos
+
+    def _walk_pcapng(self, pos: int, end: int,
+                     groups: Tuple[List[int], List[int], List[int]]) -> int:
+        buffer = self._buffer
+        unpack_from = self._block_header.unpack_from
+        enhanced, simple, obsolete = groups
+        while pos + 8 <= end:
+            block_type, total_length = unpack_from(buffer, pos)
+            if block_type == PCAPNG_SECTION_HEADER:
+                # Interfaces of new section apply only to packets after it
+                self._need_header = True
+                break
+            if total_length < 12 or total_length % 4:
+                raise ParsePcapError(f'Invalid pcapng block length {total_length}')
+            if pos + total_length > end:
+                break
+            if block_type == PCAPNG_ENHANCED_PACKET:
+                enhanced.append(pos)
+            elif block_type == PCAPNG_SIMPLE_PACKET:
+                simple.append(pos)
+            elif block_type == PCAPNG_PACKET:
+                obsolete.append(pos)
+            elif block_type == PCAPNG_INTERFACE_DESCRIPTION:
+                body = bytes(buffer[pos + 8:pos + total_length])
+                self.interfaces.append(parse_interface_block(body, self.byteorder))
+            pos += total_length
+        return pos
+
+    def _words(self, starts: 'numpy.ndarray', size: int) -> 'numpy.ndarray':
+        # Copy of first size bytes of each record viewed as 32-bit words
+        buffer = numpy.frombuffer(self._buffer, dtype=numpy.uint8)
+        fields = sliding_window_view(buffer, size)[starts]
+        return fields.view(numpy.dtype(self.byteorder + 'u4'))
+
+    def _decode_pcap(self, offsets: List[int]) -> 'numpy.ndarray':
+        starts = numpy.array(offsets, dtype=numpy.int64)
+        words = self._words(starts, PCAP_RECORD_HEADER_SIZE).astype(numpy.int64)
+        timestamp = words[:, 0] * 1_000_000_000 + words[:, 1] * self._ts_multiplier
+        interface = numpy.zeros(len(starts), dtype=numpy.int64)
+        return self._make_index(starts, timestamp, words[:, 2], words[:, 3], interface,
+                                starts + PCAP_RECORD_HEADER_SIZE)
+
+    def _decode_pcapng(self, enhanced: List[int], simple: List[int],
+                       obsolete: List[int]) -> 'numpy.ndarray':
+        parts = []
+        for offsets, is_obsolete in ((enhanced, False), (obsolete, True)):
+            if offsets:
+                parts.append(self._decode_packet_blocks(offsets, is_obsolete))
+        if simple:
+            parts.append(self._decode_simple_packet_blocks(simple))
+        index = parts[0] if len(parts) == 1 else numpy.concatenate(parts)
+        if len(parts) > 1:
+            index = index[numpy.argsort(index['offset'], kind='stable')]
+        return index
+
+    def _decode_packet_blocks(self, offsets: List[int], obsolete: bool) -> 'numpy.ndarray':
+        starts = numpy.array(offsets, dtype=numpy.int64)
+        words = self._words(starts, PCAPNG_PACKET_HEADER_SIZE).astype(numpy.int64)
+        interface = words[:, 2]
+        if obsolete:
+            # Interface ID of obsolete packet block is 16-bit field followed by drops count
+            interface = interface & 0xffff if self.byteorder == '<' else interface >> 16
+        if len(self.interfaces) == 0 or interface.max() >= len(self.interfaces):
+            raise ParsePcapError(f'Packet refers to unknown interface {interface.max()}')
+        multipliers = numpy.array([item.ts_multiplier for item in self.interfaces],
+                                  dtype=numpy.int64)[interface]
+        divisors = numpy.array([item.ts_divisor for item in self.interfaces],
+                               dtype=numpy.int64)[interface]
+        units = words[:, 3] << 32 | words[:, 4]
+        # Split keeps binary fractions like 2^-32 seconds from overflowing int64
+        timestamp = units // divisors * multipliers + units % divisors * multipliers // divisors
+        return self._make_index(starts, timestamp, words[:, 5], words[:, 6], interface,
+                                starts + PCAPNG_PACKET_HEADER_SIZE)
+
+    def _decode_simple_packet_blocks(self, offsets: List[int]) -> 'numpy.ndarray':
+        if not self.interfaces:
+            raise ParsePcapError('Packet refers to unknown interface 0')
+        starts = numpy.array(offsets, dtype=numpy.int64)
+        words = self._words(starts, PCAPNG_SIMPLE_PACKET_HEADER_SIZE).astype(numpy.int64)
+        origlen = words[:, 2]
+        # Simple packet block has no timestamp and no captured length
+        caplen = numpy.minimum(origlen, words[:, 1] - PCAPNG_SIMPLE_PACKET_HEADER_SIZE - 4)
+        if self.interfaces[0].snaplen:
+            caplen = numpy.minimum(caplen, self.interfaces[0].snaplen)
+        timestamp = numpy.full(len(starts), self.last_timestamp, dtype=numpy.int64)
+        interface = numpy.zeros(len(starts), dtype=numpy.int64)
+        return self._make_index(starts, timestamp, caplen, origlen, interface,
+                                starts + PCAPNG_SIMPLE_PACKET_HEADER_SIZE)
+
+    # pylint: disable-next=too-many-arguments,too-many-positional-arguments
+    def _make_index(self, starts: 'numpy.ndarray', timestamp: 'numpy.ndarray',
+                    caplen: 'numpy.ndarray', origlen: 'numpy.ndarray',
+                    interface: 'numpy.ndarray', data_starts: 'numpy.ndarray'
+                    ) -> 'numpy.ndarray':
+        index = numpy.zeros(len(starts), dtype=self.fields)
+        index['timestamp'] = timestamp
+        index['caplen'] = caplen
+        index['origlen'] = origlen
+        index['offset'] = starts + self._buffer_offset
+        index['interface'] = interface
+        linktypes = numpy.array([item.linktype for item in self.interfaces],
+                                dtype=numpy.int64)[interface]
+        headers = self._header_windows(data_starts, caplen)
+        transport = parse_headers(index, headers, linktypes)
+        if 'rtp' in (index.dtype.names or ()):
+            parse_rtp_header(index, headers, transport)
+        if 'tcp_flags' in (index.dtype.names or ()):
+            parse_tcp_flags(index, headers, transport)
+        if len(self.payload_ports):
+            self._collect_payloads(index, headers, transport, data_starts)
+        self.packets += len(index)
+        self.last_timestamp = int(timestamp[-1])
+        return index
+
+    def _header_windows(self, data_starts: 'numpy.ndarray',
+                        caplen: 'numpy.ndarray') -> 'numpy.ndarray':
+        buffer = numpy.frombuffer(self._buffer, dtype=numpy.uint8)
+        headers = sliding_window_view(buffer, HEADER_WINDOW)[data_starts]
+        # Bytes behind captured length belong to next record
+        headers[numpy.arange(HEADER_WINDOW) >= caplen[:, None]] = 0
+        return headers
+
+    def _collect_payloads(self, index: 'numpy.ndarray', headers: 'numpy.ndarray',
+                          transport: 'numpy.ndarray', data_starts: 'numpy.ndarray'):
+        selected = numpy.isin(index['protocol'], (6, 17)) & \
+            (numpy.isin(index['sport'], self.payload_ports) |
+             numpy.isin(index['dport'], self.payload_ports))
+        if not selected.any():
+            return
+        rows = numpy.flatnonzero(selected)
+        transport = transport[selected]
+        # TCP header length is in upper half of 13th byte
+        header_length = numpy.where(index['protocol'][selected] == 6,
+                                    (byte_at(headers, rows, transport + 12) >> 4) * 4, 8)
+        starts = data_starts[selected] + transport + header_length
+        ends = data_starts[selected] + index['caplen'][selected]
+        for offset, start, end in zip(index['offset'][selected].tolist(), starts.tolist(),
+                                      ends.tolist()):
+            self.payloads[offset] = bytes(self._buffer[start:end])
+
+    def _add(self, index: 'numpy.ndarray'):
+        self._batches.append(index)
+        self._batched += len(index)
+
+    def _take_batches(self, final: bool) -> List['numpy.ndarray']:
+        if self._batched < self.batch_size and not (final and self._batched):
+            return []
+        merged = self._batches[0] if len(self._batches) == 1 else \
+            numpy.concatenate(self._batches)
+        split = len(merged) if final else len(merged) // self.batch_size * self.batch_size
+        batches = [merged[pos:pos + self.batch_size]
+                   for pos in range(0, split, self.batch_size)]
+        self._batches = [merged[split:]] if split < len(merged) else []
+        self._batched = len(merged) - split
+        return batches
+
+
+def byte_at(headers: 'numpy.ndarray', rows: 'numpy.ndarray',
+            columns: Union[int, 'numpy.ndarray']) -> 'numpy.ndarray':
+    return headers[rows, numpy.minimum(columns, HEADER_WINDOW - 1)].astype(numpy.int64)
+
+
+def uint16_at(headers: 'numpy.ndarray', rows: 'numpy.ndarray',
+              columns: Union[int, 'numpy.ndarray']) -> 'numpy.ndarray':
+    # Network byte order
+    return byte_at(headers, rows, columns) << 8 | byte_at(headers, rows, columns + 1)
+
+
+def bytes_at(headers: 'numpy.ndarray', rows: 'numpy.ndarray', columns: 'numpy.ndarray',
+             size: int) -> 'numpy.ndarray':
+    positions = numpy.minimum(columns[:, None] + numpy.arange(size), HEADER_WINDOW - 1)
+    return headers[rows[:, None], positions]
+
+
+def link_layer(headers: 'numpy.ndarray', rows: 'numpy.ndarray',
+               linktypes: 'numpy.ndarray') -> Tuple['numpy.ndarray', 'numpy.ndarray']:
+    # Returns protocol type and offset of network header of each packet
+    ethertype = numpy.zeros(len(rows), dtype=numpy.int64)
+    network = numpy.zeros(len(rows), dtype=numpy.int64)
+    for linktype, (type_offset, network_offset) in LINK_LAYERS.items():
+        selected = linktypes == linktype
+        if selected.any():
+            ethertype[selected] = uint16_at(headers, rows[selected], type_offset)
+            network[selected] = network_offset
+    for _ in range(MAX_VLAN_TAGS):
+        tagged = (linktypes == LINKTYPE_ETHERNET) & numpy.isin(ethertype, ETHERTYPE_VLAN)
+        if not tagged.any():
+            break
+        ethertype[tagged] = uint16_at(headers, rows[tagged], network[tagged] + 2)
+        network[tagged] += VLAN_TAG_SIZE
+    raw = numpy.isin(linktypes, RAW_LINKTYPES)
+    if raw.any():
+        version = headers[rows[raw], 0] >> 4
+        ethertype[raw] = numpy.where(version == 6, ETHERTYPE_IPV6, ETHERTYPE_IPV4)
+    return ethertype, network
+
+
+def parse_headers(index: 'numpy.ndarray', headers: 'numpy.ndarray',
+                  linktypes: 'numpy.ndarray') -> 'numpy.ndarray':
+    # Returns offset of transport header of each packet
+    rows = numpy.arange(len(index))
+    ethertype, network = link_layer(headers, rows, linktypes)
+    transport = numpy.zeros(len(index), dtype=numpy.int64)
+    has_ports = numpy.zeros(len(index), dtype=bool)
+    for ip_version, network_type, parse_network_header in (
+            (4, ETHERTYPE_IPV4, ipv4_header), (6, ETHERTYPE_IPV6, ipv6_header)):
+        selected = (ethertype == network_type) & \
+            (byte_at(headers, rows, network) >> 4 == ip_version)
+        if not selected.any():
+            continue
+        fields = parse_network_header(headers, rows[selected], network[selected])
+        index['ip_version'][selected] = ip_version
+        for field, values in zip(('protocol', 'src', 'dst'), fields):
+            index[field][selected] = values
+        transport[selected], has_ports[selected] = fields[3:]
+    if has_ports.any():
+        index['sport'][has_ports] = uint16_at(headers, rows[has_ports], transport[has_ports])
+        index['dport'][has_ports] = uint16_at(headers, rows[has_ports],
+                                              transport[has_ports] + 2)
+    return transport
+
+
+def ipv4_header(headers: 'numpy.ndarray', rows: 'numpy.ndarray',
+                network: 'numpy.ndarray') -> Tuple['numpy.ndarray', ...]:
+    # Returns protocol, addresses, offset of transport header and whether it carries ports
+    protocol = byte_at(headers, rows, network + 9)
+    prefix = numpy.frombuffer(IPV4_MAPPED_PREFIX, dtype=numpy.uint8)
+    src, dst = (numpy.concatenate((numpy.broadcast_to(prefix, (len(rows), len(prefix))),
+                                   bytes_at(headers, rows, network + offset, 4)), axis=1)
+                for offset in (12, 16))
+    fragment_offset = uint16_at(headers, rows, network + 6) & 0x1fff
+    transport = network + (byte_at(headers, rows, network) & 0x0f) * 4
+    has_ports = (fragment_offset == 0) & numpy.isin(protocol, PORT_PROTOCOLS)
+    return protocol, src, dst, transport, has_ports
+
+
+def ipv6_header(headers: 'numpy.ndarray', rows: 'numpy.ndarray',
+                network: 'numpy.ndarray') -> Tuple['numpy.ndarray', ...]:
+    # Extension headers are not followed
+    protocol = byte_at(headers, rows, network + 6)
+    return (protocol, bytes_at(headers, rows, network + 8, 16),
+            bytes_at(headers, rows, network + 24, 16), network + 40,
+            numpy.isin(protocol, PORT_PROTOCOLS))
+
+
+def uint32_at(headers: 'numpy.ndarray', rows: 'numpy.ndarray',
+              columns: 'numpy.ndarray') -> 'numpy.ndarray':
+    return uint16_at(headers, rows, columns) << 16 | uint16_at(headers, rows, columns + 2)
+
+
+def parse_rtp_header(index: 'numpy.ndarray', headers: 'numpy.ndarray',
+                     transport: 'numpy.ndarray'):
+    # RTP is recognized only by version and payload type between unprivileged ports, header
+    # must fit into header window
+    start = transport + UDP_HEADER_SIZE
+    candidates = (index['protocol'] == 17) & (index['sport'] >= 1024) & \
+        (index['dport'] >= 1024) & (start + RTP_HEADER_SIZE <= index['caplen']) & \
+        (start + RTP_HEADER_SIZE <= HEADER_WINDOW)
+    rows = numpy.flatnonzero(candidates)
+    if len(rows) == 0:
+        return
+    start = start[rows]
+    payload_type = byte_at(headers, rows, start + 1) & 0x7f
+    is_rtp = (byte_at(headers, rows, start) >> 6 == 2) & \
+        ~numpy.isin(payload_type, RTCP_PAYLOAD_TYPES)
+    rows, start, payload_type = rows[is_rtp], start[is_rtp], payload_type[is_rtp]
+    index['rtp'][rows] = True
+    index['rtp_payload_type'][rows] = payload_type
+    index['rtp_sequence'][rows] = uint16_at(headers, rows, start + 2)
+    index['rtp_timestamp'][rows] = uint32_at(headers, rows, start + 4)
+    index['rtp_ssrc'][rows] = uint32_at(headers, rows, start + 8)
+
+
+def parse_tcp_flags(index: 'numpy.ndarray', headers: 'numpy.ndarray',
+                    transport: 'numpy.ndarray'):
+    # Non-first fragments have no ports and no TCP header
+    rows = numpy.flatnonzero((index['protocol'] == 6) &
+                             ((index['sport'] | index['dport']) != 0) &
+                             (transport + TCP_FLAGS_OFFSET < index['caplen']))
+    index['tcp_flags'][rows] = byte_at(headers, rows, transport[rows] + TCP_FLAGS_OFFSET)
+
+
+def read_packet_index(stream: BinaryIO, batch_size: int = 65536,
+                      chunk_size: int = 16 * 1024 * 1024) -> Iterator['numpy.ndarray']:
+    reader = PacketIndexReader(batch_size)
+    while chunk := stream.read(chunk_size):
+        yield from reader.feed(chunk)
+    yield from reader.flush()
@@ -0,0 +1,195 @@
+import logging
+from collections import deque
+from heapq import heappop, heappush
+from threading import Condition, Thread
+from time import monotonic
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from .pcap_stream import PcapRecord, PcapStream
+from .pcapng_writer import (enhanced_packet_block, interface_description_block,
+                            section_header_block)
+
+
+class MergeSource():
+    def __init__(self, name: str, index: int, merger: 'PcapMerger'):
+        self.name = name
+        self.index = index
+        self.stream = PcapStream(collect=True)
+        # Records with local monotonic time of their arrival
+        self.records: Deque[Tuple[float, PcapRecord]] = deque()
+        self.finished = False
+        self._merger = merger
+
+    def open(self):
+        pass
+
+    def write(self, data: memoryview):
+        if records := self.stream.feed(data):
+            self._merger.push(self, records)
+
+    def close(self):
+        self._merger.finish(self)
+
+
+class PcapMerger():
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, name: str, sink, lookahead: int = 256, max_delay: float = 0.5,
+                 flush_size: int = 1024 * 1024):
+        self.name = name
+        self.logger = logging.getLogger(self.name)
+        self.sink = sink
+        self.lookahead = lookahead
+        self.max_delay = max_delay
+        self.flush_size = flush_size
+        self.sources: List[MergeSource] = []
+        self.dumpers: List = []
+        self.packets = 0
+        self.bytes = 0
+        self._condition = Condition()
+        self._thread: Optional[Thread] = None
+        self._need_stop = False
+        self._interfaces: Dict[Tuple[int, int], int] = {}
+        self._output = bytearray()
+        self._returncode: Optional[int] = None
+        self._exit_callbacks: List[Callable[[], None]] = []
+
+    def create_source(self, name: str) -> MergeSource:
+        source = MergeSource(name, len(self.sources), self)
+        self.sources.append(source)
+        return source
+
+    def add_dumper(self, dumper):
+        self.dumpers.append(dumper)
+
+    def add_exit_callback(self, callback: Callable[[], None]):
+        self._exit_callbacks.append(callback)
+
+    def push(self, source: MergeSource, records: List[PcapRecord]):
+        with self._condition:
+            # Small per-source lookahead, slow merge blocks remote side through SSH window
+            while len(source.records) >= self.lookahead and self._need_stop is False:
+                self._condition.wait()
+            arrived = monotonic()
+            source.records.extend((arrived, record) for record in records)
+            self._condition.notify_all()
+
+    def finish(self, source: MergeSource):
+        with self._condition:
+            source.finished = True
+            self._condition.notify_all()
+
+    def run(self):
+        self.logger.info(f'Starting merge of {len(self.sources)} sources ...')
+        self._thread = Thread(target=self._merge, name=f'{self.name}.merge', daemon=True)
+        self._thread.start()
+        for dumper in self.dumpers:
+            dumper.run()
+
+    def _merge(self):
+        heap = []
+        missing = set(self.sources)
+        try:
+            self.sink.open()
+            self._output += section_header_block()
+            while True:
+                with self._condition:
+                    popped = self._next_record(heap, missing)
+                if popped is None:
+                    break
+                source, record = popped
+                self._emit(source, record)
+            self._flush()
+        except BrokenPipeError:
+            self.logger.info('Packet analyzer closed the pipe')
+        finally:
+            self.sink.close()
+            with self._condition:
+                self._need_stop = True
+                self._condition.notify_all()
+            self.logger.info(f'Merged {self.packets} packets, {self.bytes} bytes')
+            self._returncode = 0
+            for callback in self._exit_callbacks:
+                callback()
+
+    def _next_record(self, heap: List[Tuple[int, int, float, PcapRecord]],
+                     missing: Set[MergeSource]) -> Optional[Tuple[MergeSource, PcapRecord]]:
+        # Heap hold only one head record per source, so each packet cost O(log N)
+        while self._need_stop is False:
+            for source in list(missing):
+                if source.records:
+                    arrived, record = source.records.popleft()
+                    heappush(heap, (record.timestamp, source.index, arrived, record))
+                    missing.discard(source)
+                    self._condition.notify_all()
+                elif source.finished:
+                    missing.discard(source)
+
+            if not missing:
+                break
+
+            # Live source may be silent: silent source gets max_delay since arrival of oldest
+            # waiting record. Arrival is measured by local clock, clocks of remote hosts which
+            # stamp packets may differ from it
+            timeout = None
+            if heap:
+                deadline = min(arrived for _, _, arrived, _ in heap) + self.max_delay
+                if (now := monotonic()) >= deadline:
+                    break
+                timeout = deadline - now
+            if self._output:
+                self._flush()
+            self._condition.wait(timeout)
+        else:
+            return None
+
+        if not heap:
+            return None
+        _, index, _, record = heappop(heap)
+        source = self.sources[index]
+        missing.add(source)
+        return source, record
+
+    def _emit(self, source: MergeSource, record: PcapRecord):
+        key = (source.index, record.interface)
+        interface_id = self._interfaces.get(key)
+        if interface_id is None:
+            interface_id = self._interfaces[key] = len(self._interfaces)
+            interface = source.stream.interfaces[record.interface]
+            self._output += interface_description_block(interface.linktype, interface.snaplen,
+                                                        name=source.name)
+            self.logger.info(f'Source {source.name} assigned to interface id {interface_id}')
+        self._output += enhanced_packet_block(interface_id, record.timestamp,
+                                              record.origlen, record.data)
+        self.packets += 1
+        if len(self._output) >= self.flush_size:
+            self._flush()
+
+    def _flush(self):
+        self.bytes += len(self._output)
+        with memoryview(self._output) as view:
+            self.sink.write(view)
+        self._output.clear()
+
+    def stats(self) -> Dict[str, float]:
+        return {'bytes': self.bytes, 'packets': self.packets}
+
+    def stop(self):
+        if self.returncode is not None:
+            return
+
+        self.logger.info('Stoping ...')
+        for dumper in self.dumpers:
+            dumper.stop()
+        with self._condition:
+            self._need_stop = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+
+    @property
+    def returncode(self) -> Optional[int]:
+        if self._returncode is None:
+            return None
+        # Sources are finished before merge ends, so failure of any of them is known
+        return next((dumper.returncode for dumper in self.dumpers if dumper.returncode), 0)
@@ -0,0 +1,301 @@
+import struct
+from typing import List, NamedTuple, Optional, Tuple
+
+from .exceptions import ParsePcapError
+
+PCAP_MAGIC_MICROSECONDS = 0xa1b2c3d4
+PCAP_MAGIC_NANOSECONDS = 0xa1b23c4d
+PCAPNG_SECTION_HEADER = 0x0a0d0d0a
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+
+PCAP_GLOBAL_HEADER_SIZE = 24
+PCAP_RECORD_HEADER_SIZE = 16
+PCAPNG_BLOCK_HEADER_SIZE = 8
+PCAPNG_PACKET_FIELDS_SIZE = 20
+
+PCAPNG_INTERFACE_DESCRIPTION = 0x00000001
+PCAPNG_PACKET = 0x00000002
+PCAPNG_SIMPLE_PACKET = 0x00000003
+PCAPNG_ENHANCED_PACKET = 0x00000006
+
+STAGE_FILE_HEADER = 0
+STAGE_RECORD_HEADER = 1
+STAGE_BLOCK_HEADER = 2
+STAGE_PACKET_FIELDS = 3
+
+STAGE_HEADER_SIZES = {
+    STAGE_FILE_HEADER: PCAP_GLOBAL_HEADER_SIZE,
+    STAGE_RECORD_HEADER: PCAP_RECORD_HEADER_SIZE,
+    STAGE_BLOCK_HEADER: PCAPNG_BLOCK_HEADER_SIZE,
+    STAGE_PACKET_FIELDS: PCAPNG_PACKET_FIELDS_SIZE
+}
+
+
+class PcapRecord(NamedTuple):
+    offset: int
+    timestamp: int
+    caplen: int
+    origlen: int
+    interface: int
+    data: bytes
+
+
+class PcapInterface(NamedTuple):
+    linktype: int
+    snaplen: int
+    ts_multiplier: int
+    ts_divisor: int
+
+
+def parse_tsresol(value: int) -> Tuple[int, int]:
+    # Convert pcapng if_tsresol option into (multiplier, divisor) for nanoseconds
+    if value & 0x80:
+        return 1_000_000_000, 1 << (value & 0x7f)
+    exponent = value - 9
+    if exponent <= 0:
+        return 10 ** -exponent, 1
+    return 1, 10 ** exponent
+
+
+def parse_interface_block(body: bytes, byteorder: str) -> PcapInterface:
+    # Body of pcapng interface description block, without block type and length
+    linktype, _, snaplen = struct.unpack_from(byteorder + 'HHI', body)
+    multiplier, divisor = parse_tsresol(6)
+    pos = 8
+    while pos + 4 <= len(body) - 4:
+        code, length = struct.unpack_from(byteorder + 'HH', body, pos)
+        if code == 0:
+            break
+        if code == 9 and length >= 1:
+            multiplier, divisor = parse_tsresol(body[pos + 4])
+        pos += 4 + (length + 3) // 4 * 4
+    return PcapInterface(linktype, snaplen, multiplier, divisor)
+
+
+class PcapStream():
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, collect: bool = False, track: bool = False):
+        # collect: return records with packet data, track: return records without data
+        self.collect = collect
+        self.track = track or collect
+        self.format: Optional[str] = None
+        self.byteorder = '<'
+        self.header = b''
+        self.interfaces: List[PcapInterface] = []
+        self.packets = 0
+        self.bytes = 0
+        self.first_timestamp: Optional[int] = None
+        self.last_timestamp: Optional[int] = None
+        self.record_end = 0
+        self._stage = STAGE_FILE_HEADER
+        self._partial = bytearray()
+        self._skip = 0
+        self._body: Optional[bytearray] = None
+        self._pending: Optional[Tuple[int, int, int, int]] = None
+        self._block_type = 0
+        self._block_length = 0
+        self._record_offset = 0
+        self._in_preamble = True
+
+    @property
+    def linktype(self) -> Optional[int]:
+        return self.interfaces[0].linktype if self.interfaces else None
+
+    @property
+    def snaplen(self) -> Optional[int]:
+        return self.interfaces[0].snaplen if self.interfaces else None
+
+    def feed(self, data) -> List[PcapRecord]:
+        view = memoryview(data).cast('B')
+        size = len(view)
+        stream_offset = self.bytes
+        self.bytes += size
+        records: List[PcapRecord] = []
+        pos = 0
+        while pos < size:
+            if self._skip:
+                take = min(self._skip, size - pos)
+                if self._body is not None:
+                    self._body += view[pos:pos + take]
+                self._skip -= take
+                pos += take
+                if self._skip == 0:
+                    self._complete(records, stream_offset + pos)
+                continue
+
+            # Fast path: whole header is inside current chunk, no copy is needed
+            header_size = STAGE_HEADER_SIZES[self._stage]
+            if not self._partial and size - pos >= header_size:
+                header = view[pos:pos + header_size]
+                if self._stage != STAGE_PACKET_FIELDS:
+                    self._record_offset = stream_offset + pos
+                pos += header_size
+            else:
+                if not self._partial and self._stage != STAGE_PACKET_FIELDS:
+                    self._record_offset = stream_offset + pos
+                take = min(header_size - len(self._partial), size - pos)
+                self._partial += view[pos:pos + take]
+                pos += take
+                if len(self._partial) < header_size:
+                    break
+                header = memoryview(bytes(self._partial))
+                self._partial.clear()
+            self._on_header(header)
+            if self._skip == 0 and not self._partial and self._stage != STAGE_PACKET_FIELDS:
+                self._complete(records, stream_offset + pos)
+        return records
+
+    def reset(self):
+        self.format = None
+        self.header = b''
+        self.interfaces = []
+        self._stage = STAGE_FILE_HEADER
+        self._partial.clear()
+        self._skip = 0
+        self._body = None
+        self._pending = None
+        self._in_preamble = True
+
+    def _complete(self, records: List[PcapRecord], end_offset: int):
+        body = self._body
+        self._body = None
+        if body is not None:
+            self._on_body(bytes(body), records)
+        elif self._pending is not None:
+            timestamp, caplen, origlen, interface_id = self._pending
+            records.append(PcapRecord(self._record_offset, timestamp, caplen, origlen,
+                                      interface_id, b''))
+        self._pending = None
+        self.record_end = end_offset
+
+    def _on_packet(self, timestamp: int):
+        self.packets += 1
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamp
+        self.last_timestamp = timestamp
+
+    def _on_header(self, header: memoryview):
+        if self._stage == STAGE_RECORD_HEADER:
+            self._on_pcap_record_header(header)
+        elif self._stage == STAGE_BLOCK_HEADER:
+            self._on_pcapng_block_header(header)
+        elif self._stage == STAGE_PACKET_FIELDS:
+            self._on_pcapng_packet_fields(header)
+        else:
+            self._on_file_header(header)
+
+    def _on_file_header(self, header: memoryview):
+        magic_le, = struct.unpack_from('<I', header, 0)
+        magic_be, = struct.unpack_from('>I', header, 0)
+        if PCAP_MAGIC_MICROSECONDS in (magic_le, magic_be):
+            multiplier = 1000
+        elif PCAP_MAGIC_NANOSECONDS in (magic_le, magic_be):
+            multiplier = 1
+        elif magic_le == PCAPNG_SECTION_HEADER:
+            self._on_pcapng_section_header(header)
+            return
+        else:
+            raise ParsePcapError(f'Unknown capture file magic: {bytes(header[:4]).hex()}')
+
+        self.format = 'pcap'
+        self.byteorder = '<' if magic_le in (PCAP_MAGIC_MICROSECONDS,
+                                             PCAP_MAGIC_NANOSECONDS) else '>'
+        snaplen, linktype = struct.unpack_from(self.byteorder + 'II', header, 16)
+        self.interfaces = [PcapInterface(linktype & 0x0fffffff, snaplen, multiplier, 1)]
+        self.header = bytes(header)
+        self._stage = STAGE_RECORD_HEADER
+
+    def _on_pcap_record_header(self, header: memoryview):
+        ts_sec, ts_frac, caplen, origlen = struct.unpack_from(self.byteorder + 'IIII', header)
+        timestamp = ts_sec * 1_000_000_000 + ts_frac * self.interfaces[0].ts_multiplier
+        self._on_packet(timestamp)
+        self._in_preamble = False
+        self._skip = caplen
+        if self.track:
+            self._pending = (timestamp, caplen, origlen, 0)
+            self._body = bytearray() if self.collect else None
+
+    def _on_pcapng_section_header(self, header: memoryview):
+        bom_le, = struct.unpack_from('<I', header, 8)
+        if bom_le == PCAPNG_BYTE_ORDER_MAGIC:
+            self.byteorder = '<'
+        elif struct.unpack_from('>I', header, 8)[0] == PCAPNG_BYTE_ORDER_MAGIC:
+            self.byteorder = '>'
+        else:
+            raise ParsePcapError('Invalid pcapng byte order magic')
+        total_length, = struct.unpack_from(self.byteorder + 'I', header, 4)
+        if total_length < 28 or total_length % 4:
+            raise ParsePcapError(f'Invalid pcapng section header length {total_length}')
+        self.format = 'pcapng'
+        self.interfaces = []
+        self.header = b''
+        self._in_preamble = True
+        self._block_type = PCAPNG_SECTION_HEADER
+        self._stage = STAGE_BLOCK_HEADER
+        self._skip = total_length - PCAP_GLOBAL_HEADER_SIZE
+        self._body = bytearray(header[PCAPNG_BLOCK_HEADER_SIZE:])
+
+    def _on_pcapng_block_header(self, header: memoryview):
+        block_type, total_length = struct.unpack_from(self.byteorder + 'II', header)
+        if block_type == PCAPNG_SECTION_HEADER:
+            self._stage = STAGE_FILE_HEADER
+            self._partial += header
+            return
+        if total_length < 12 or total_length % 4:
+            raise ParsePcapError(f'Invalid pcapng block length {total_length}')
+        self._block_type = block_type
+        self._block_length = total_length
+        if block_type in (PCAPNG_ENHANCED_PACKET, PCAPNG_PACKET):
+            if total_length < PCAPNG_BLOCK_HEADER_SIZE + PCAPNG_PACKET_FIELDS_SIZE + 4:
+                raise ParsePcapError(f'Invalid pcapng packet block length {total_length}')
+            self._stage = STAGE_PACKET_FIELDS
+            return
+        self._skip = total_length - PCAPNG_BLOCK_HEADER_SIZE
+        if block_type == PCAPNG_SIMPLE_PACKET:
+            self._on_packet(self.last_timestamp or 0)
+            self._in_preamble = False
+            # Simple packet block keep original length inside the body
+            self._body = bytearray() if self.track else None
+        else:
+            self._body = bytearray()
+
+    def _on_pcapng_packet_fields(self, fields: memoryview):
+        if self._block_type == PCAPNG_PACKET:
+            interface_id, _, ts_high, ts_low, caplen, origlen = struct.unpack_from(
+                self.byteorder + 'HHIIII', fields)
+        else:
+            interface_id, ts_high, ts_low, caplen, origlen = struct.unpack_from(
+                self.byteorder + 'IIIII', fields)
+        if interface_id >= len(self.interfaces):
+            raise ParsePcapError(f'Packet refers to unknown interface {interface_id}')
+        interface = self.interfaces[interface_id]
+        timestamp = (ts_high << 32 | ts_low) * interface.ts_multiplier // interface.ts_divisor
+        self._on_packet(timestamp)
+        self._in_preamble = False
+        self._stage = STAGE_BLOCK_HEADER
+        self._skip = self._block_length - PCAPNG_BLOCK_HEADER_SIZE - PCAPNG_PACKET_FIELDS_SIZE
+        if self.track:
+            self._pending = (timestamp, caplen, origlen, interface_id)
+            self._body = bytearray() if self.collect else None
+
+    def _on_body(self, body: bytes, records: List[PcapRecord]):
+        if self._pending is not None:
+            timestamp, caplen, origlen, interface_id = self._pending
+            records.append(PcapRecord(self._record_offset, timestamp, caplen, origlen,
+                                      interface_id, body[:caplen]))
+        elif self._block_type == PCAPNG_SECTION_HEADER:
+            self.header = struct.pack(self.byteorder + 'II', PCAPNG_SECTION_HEADER,
+                                      len(body) + 8) + body
+        elif self._block_type == PCAPNG_SIMPLE_PACKET:
+            origlen, = struct.unpack_from(self.byteorder + 'I', body)
+            snaplen = self.snaplen or origlen
+            caplen = min(origlen, snaplen)
+            records.append(PcapRecord(self._record_offset, self.last_timestamp or 0,
+                                      caplen, origlen, 0,
+                                      body[4:4 + caplen] if self.collect else b''))
+        else:
+            if self._block_type == PCAPNG_INTERFACE_DESCRIPTION:
+                self.interfaces.append(parse_interface_block(body, self.byteorder))
+            if self._in_preamble:
+                self.header += struct.pack(self.byteorder + 'II', self._block_type,
+                                           len(body) + 8) + body
@@ -0,0 +1,61 @@
+import struct
+from typing import Optional, Union
+
+from .pcap_stream import (PCAPNG_BYTE_ORDER_MAGIC, PCAPNG_ENHANCED_PACKET,
+                          PCAPNG_INTERFACE_DESCRIPTION, PCAPNG_SECTION_HEADER)
+
+OPT_ENDOFOPT = 0
+OPT_COMMENT = 1
+OPT_SHB_USERAPPL = 4
+OPT_IF_NAME = 2
+OPT_IF_DESCRIPTION = 3
+OPT_IF_TSRESOL = 9
+
+NANOSECONDS_TSRESOL = 9
+
+
+def pad4(length: int) -> int:
+    return (length + 3) & ~3
+
+
+def encode_option(code: int, value: bytes) -> bytes:
+    return struct.pack('<HH', code, len(value)) + value + bytes(pad4(len(value)) - len(value))
+
+
+def encode_options(*options) -> bytes:
+    encoded = b''.join(encode_option(code, value) for code, value in options
+                       if value is not None)
+    if encoded:
+        encoded += struct.pack('<HH', OPT_ENDOFOPT, 0)
+    return encoded
+
+
+def make_block(block_type: int, body: bytes) -> bytes:
+    total_length = 12 + len(body)
+    return struct.pack('<II', block_type, total_length) + body + struct.pack('<I', total_length)
+
+
+def section_header_block(application: str = 'remote_pcap') -> bytes:
+    body = struct.pack('<IHHq', PCAPNG_BYTE_ORDER_MAGIC, 1, 0, -1)
+    body += encode_options((OPT_SHB_USERAPPL, application.encode()))
+    return make_block(PCAPNG_SECTION_HEADER, body)
+
+
+def interface_description_block(linktype: int, snaplen: int, name: Optional[str] = None,
+                                description: Optional[str] = None) -> bytes:
+    body = struct.pack('<HHI', linktype, 0, snaplen)
+    body += encode_options((OPT_IF_NAME, name.encode() if name else None),
+                           (OPT_IF_DESCRIPTION, description.encode() if description else None),
+                           (OPT_IF_TSRESOL, bytes([NANOSECONDS_TSRESOL])))
+    return make_block(PCAPNG_INTERFACE_DESCRIPTION, body)
+
+
+def enhanced_packet_block(interface_id: int, timestamp: int, origlen: int,
+                          data: Union[bytes, bytearray], comment: Optional[str] = None) -> bytes:
+    caplen = len(data)
+    body = struct.pack('<IIIII', interface_id, timestamp >> 32, timestamp & 0xffffffff,
+                       caplen, origlen)
+    body += data + bytes(pad4(caplen) - caplen)
+    if comment is not None:
+        body += encode_options((OPT_COMMENT, comment.encode()))
+    return make_block(PCAPNG_ENHANCED_PACKET, body)
@@ -1,6 +1,11 @@
+import fcntl
+import os
+import termios
+from array import array
 from os import listdir, mkfifo, remove
 from random import choices
 from string import ascii_lowercase
+from typing import Dict, Optional
 
 
 class Pipe():
@@ -17,3 +22,39 @@ class Pipe():
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
         remove(self.fifo_path)
+
+
+class FifoSink():
+    def __init__(self, fifo_path: str, name: str = 'fifo'):
+        self.name = name
+        self.fifo_path = fifo_path
+        self.written_bytes = 0
+        self._fd: Optional[int] = None
+
+    def stats(self) -> Dict[str, float]:
+        queued_bytes = 0
+        if (fd := self._fd) is not None:
+            # Data written to FIFO but not yet read by analyzer
+            queued = array('i', [0])
+            try:
+                fcntl.ioctl(fd, termios.FIONREAD, queued)
+                queued_bytes = queued[0]
+            except OSError:
+                pass
+        return {'bytes': self.written_bytes, 'queued_bytes': queued_bytes}
+
+    def open(self):
+        # Blocks until the analyzer opens the FIFO for reading
+        self._fd = os.open(self.fifo_path, os.O_WRONLY)
+
+    def write(self, data: memoryview):
+        assert self._fd is not None
+        while data:
+            written = os.write(self._fd, data)
+            self.written_bytes += written
+            data = data[written:]
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,117 @@
+import json
+import logging
+import os
+import re
+from pathlib import Path
+from time import time
+from typing import List, NamedTuple, Optional, Tuple, Union
+
+from paramiko import SSHClient
+
+# All probes are done by one remote command, result is printed as one JSON object
+PREFLIGHT_SCRIPT = r'''
+tcpdump_path=''
+for path in /usr/bin/tcpdump /usr/sbin/tcpdump; do
+    if [ -x "$path" ]; then tcpdump_path=$path; break; fi
+done
+sudo=false
+version=''
+if [ -n "$tcpdump_path" ] && output=$(sudo -n "$tcpdump_path" --version 2>&1); then
+    version=$(printf '%s\n' "$output" | grep -m 1 'tcpdump version' | sed 's/[\\"]/\\&/g')
+    if [ -n "$version" ]; then sudo=true; fi
+fi
+interfaces=''
+for interface in $(ls /sys/class/net 2>/dev/null); do
+    interfaces="$interfaces${interfaces:+, }\"$interface\""
+done
+compressors=''
+for compressor in zstd lz4 gzip; do
+    if command -v "$compressor" >/dev/null 2>&1; then
+        compressors="$compressors${compressors:+, }\"$compressor\""
+    fi
+done
+printf '{"tcpdump_path": "%s", "sudo": %s, "tcpdump_version": "%s", "interfaces": [%s], ' \
+    "$tcpdump_path" "$sudo" "$version" "$interfaces"
+printf '"compressors": [%s]}\n' "$compressors"
+'''
+
+
+# Cached results of other version are probed again
+PREFLIGHT_VERSION = 2
+
+
+class PreflightResult(NamedTuple):
+    tcpdump_path: Optional[str]
+    sudo: bool
+    tcpdump_version: str
+    interfaces: List[str]
+    compressors: Tuple[str, ...] = ()
+
+
+def run_preflight(connected_client: SSHClient) -> PreflightResult:
+    _, stdout, _ = connected_client.exec_command(PREFLIGHT_SCRIPT)
+    output = stdout.read().decode(encoding='utf-8')
+    exitcode = stdout.channel.recv_exit_status()
+    if exitcode != 0:
+        raise RuntimeError(f'Failed to run preflight checks: {exitcode=}')
+    details = json.loads(output)
+    return PreflightResult(tcpdump_path=details['tcpdump_path'] or None,
+                           sudo=details['sudo'],
+                           tcpdump_version=details['tcpdump_version'],
+                           interfaces=details['interfaces'],
+                           compressors=tuple(details['compressors']))
+
+
+class PreflightCache():
+
+    def __init__(self, ttl: float = 3600, cache_dir: Optional[Union[Path, str]] = None):
+        self.logger = logging.getLogger('preflight_cache')
+        self.ttl = ttl
+        if cache_dir is None:
+            cache_home = os.environ.get('XDG_CACHE_HOME') or Path('~/.cache').expanduser()
+            cache_dir = Path(cache_home, 'remote_pcap', 'preflight')
+        self.cache_dir = Path(cache_dir)
+
+    def make_path(self, hostname: str, port: Union[str, int], user: str) -> Path:
+        name = re.sub(r'[^\w.@-]', '_', f'{user}@{hostname}_{port}')
+        return self.cache_dir / f'{name}.json'
+
+    def load(self, hostname: str, port: Union[str, int], user: str,
+             **_kwargs) -> Optional[PreflightResult]:
+        if self.ttl <= 0:
+            return None
+        path = self.make_path(hostname, port, user)
+        try:
+            with open(path, encoding='utf-8') as cache_file:
+                cached = json.load(cache_file)
+            if cached.get('version') != PREFLIGHT_VERSION or \
+                    time() - cached['checked_at'] > self.ttl:
+                return None
+            result = PreflightResult(**cached['result'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        self.logger.info(f'Using cached preflight result of {user}@{hostname}:{port}')
+        return result
+
+    def store(self, result: PreflightResult, hostname: str, port: Union[str, int], user: str,
+              **_kwargs):
+        if self.ttl <= 0:
+            return
+        path = self.make_path(hostname, port, user)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # Written under temporary name so concurrent run never reads partial file
+            temporary_path = path.with_name(f'{path.name}.{os.getpid()}')
+            with open(temporary_path, 'w', encoding='utf-8') as cache_file:
+                json.dump({'version': PREFLIGHT_VERSION, 'checked_at': time(),
+                           'result': result._asdict()}, cache_file)
+            temporary_path.replace(path)
+        except OSError as error:
+            self.logger.warning(f'Failed to store preflight result: {error}')
+
+    def invalidate(self, hostname: str, port: Union[str, int], user: str, **_kwargs):
+        self.logger.info(f'Invalidating cached preflight result of {user}@{hostname}:{port}')
+        try:
+            self.make_path(hostname, port, user).unlink()
+        except FileNotFoundError:
+            pass
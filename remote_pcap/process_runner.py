@@ -1,19 +1,38 @@
 import logging
+import signal
 from abc import ABC, abstractmethod
-from subprocess import DEVNULL, PIPE, Popen, TimeoutExpired
+from subprocess import DEVNULL, PIPE, Popen
+from threading import Event
+from time import monotonic
+from typing import Callable, Optional, Sequence, Tuple
 
-from .buffer_reader import BufferReader
 from .exceptions import StopError
+from .reactor import Reactor
+
+StopSchedule = Sequence[Tuple[signal.Signals, float]]
+
+
+def make_stop_schedule(stop_timeout: float = 1.0) -> StopSchedule:
+    # Signals are sent at offsets from the beginning of stop, process which exits
+    # earlier is not waited for full step and next signal does not wait previous one
+    return ((signal.SIGUSR1, 0.0),
+            (signal.SIGTERM, stop_timeout / 2),
+            (signal.SIGKILL, stop_timeout))
 
 
 class ProcessRunner(ABC):
 
-    def __init__(self, name):
+    def __init__(self, name, stop_timeout=1.0):
         self.name = name
         self.logger = logging.getLogger(self.name)
         self.process = None
         self.out_reader = None
         self.error_reader = None
+        self.stop_schedule = make_stop_schedule(stop_timeout)
+        self.stop_timeout = stop_timeout
+        self.exited = Event()
+        self._stop_started = None
+        self._exit_callbacks = []
 
     @abstractmethod
     def handle_stdout(self, data: str):
@@ -32,43 +51,62 @@ class ProcessRunner(ABC):
         self.logger.info('Starting ...')
         # pylint: disable-next=consider-using-with
         self.process = Popen(self.args, stdin=DEVNULL, stdout=PIPE, stderr=PIPE)
-        self.out_reader = BufferReader(name=f'{self.name}.stdout_reader',
-                                       buffer=self.process.stdout,
-                                       data_handler=self.handle_stdout)
-        self.out_reader.start()
-        self.error_reader = BufferReader(name=f'{self.name}.error_reader',
-                                         buffer=self.process.stderr,
-                                         data_handler=self.handle_stderr)
-        self.error_reader.start()
+        # Output of all child processes is multiplexed by one shared reactor thread
+        reactor = Reactor.instance()
+        self.out_reader = reactor.add_line_reader(f'{self.name}.stdout_reader',
+                                                  self.process.stdout.fileno(),
+                                                  data_handler=self.handle_stdout)
+        self.error_reader = reactor.add_line_reader(f'{self.name}.error_reader',
+                                                    self.process.stderr.fileno(),
+                                                    data_handler=self.handle_stderr)
+        reactor.watch_process(self.process, self._on_exit)
+
+    def add_exit_callback(self, callback: Callable[[], None]):
+        self._exit_callbacks.append(callback)
+
+    def _on_exit(self):
+        self.logger.info(f'Process with pid {self.process.pid} exited '
+                         f'with exitcode {self.process.returncode}')
+        self.exited.set()
+        for callback in self._exit_callbacks:
+            callback()
 
     def stop(self):
+        self.send_stop()
+        self.wait_stopped()
+
+    def send_stop(self):
         if self.returncode is not None:
             return
 
         self.logger.info('Stoping ...')
+        self._stop_started = monotonic()
+        self._send_signal(self.stop_schedule[0][0])
 
-        pid = self.process.pid
-        for sig_name, sig_number in (('SIGUSR1', 10), ('SIGTERM', 15), ('SIGKILL', 9)):
-            self.logger.info(f'Sending {sig_name} to process with pid {pid}')
-            self.process.send_signal(sig_number)
+    def wait_stopped(self):
+        if self.returncode is not None or self._stop_started is None:
+            return
 
-            returncode = self.process.wait(timeout=1)
-            if returncode is not None:
-                self.logger.info(f'Process with pid {pid} was stopped by exitcode {returncode}')
+        pid = self.process.pid
+        for sig, offset in self.stop_schedule[1:]:
+            if self.exited.wait(self._stop_started + offset - monotonic()):
                 break
-        else:
+            self._send_signal(sig)
+        # Last signal (SIGKILL) is given the same time to be delivered
+        if not self.exited.wait(self._stop_started + self.stop_timeout * 2 - monotonic()):
             self.logger.error(f'Failed to stop process with pid {pid}')
             raise StopError(f'Failed to stop process with pid {pid}')
+        self.logger.info(f'Process with pid {pid} was stopped by exitcode {self.returncode} '
+                         f'in {(monotonic() - self._stop_started) * 1000:.1f} ms')
 
-        if self.out_reader.is_alive():
-            self.out_reader.stop()
-
-        if self.error_reader.is_alive():
-            self.error_reader.stop()
+    def _send_signal(self, sig: signal.Signals):
+        if self.process.poll() is not None:
+            return
+        self.logger.info(f'Sending {sig.name} to process with pid {self.process.pid}')
+        self.process.send_signal(sig)
 
     @property
-    def returncode(self):
-        try:
-            return self.process.wait(0.1)
-        except TimeoutExpired:
+    def returncode(self) -> Optional[int]:
+        if self.process is None:
             return None
+        return self.process.poll()
@@ -0,0 +1,276 @@
+import logging
+import math
+import struct
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+from .metrics import Stats
+from .packet_index import (PCAPNG_PACKET_HEADER_SIZE, PacketIndexReader,
+                           flow_keys)
+from .pcap_stream import PCAP_RECORD_HEADER_SIZE
+from .pcapng_writer import (OPT_COMMENT, OPT_ENDOFOPT, enhanced_packet_block,
+                            interface_description_block, section_header_block)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # type: ignore
+
+DEGRADE_MODES = ('sample', 'flows', 'snaplen')
+
+# Snapshot lengths tried in turn, first one is full packet
+SNAPLEN_STEPS = (0, 1024, 512, 256, 128, 96)
+
+# Enhanced packet block without packet data and padding
+PACKET_OVERHEAD = 32
+
+# FIN, SYN and RST, connection setup and teardown is never dropped
+TCP_SIGNALLING_FLAGS = 0x07
+
+# Degradation is lifted only when input fits into this part of budget, so rate near budget
+# does not switch it on and off every window
+RELEASE_RATIO = 0.8
+
+# Packet counters of flows are dropped when there are more flows
+FLOWS_LIMIT = 1 << 20
+
+
+def packet_comment(options: bytearray, byteorder: str) -> Optional[str]:
+    pos = 0
+    while pos + 4 <= len(options):
+        code, length = struct.unpack_from(byteorder + 'HH', options, pos)
+        if code == OPT_ENDOFOPT:
+            break
+        if code == OPT_COMMENT:
+            return options[pos + 4:pos + 4 + length].decode(errors='replace')
+        pos += 4 + (length + 3) // 4 * 4
+    return None
+
+
+class BudgetOptions(NamedTuple):
+    max_rate: int = 0
+    mode: str = 'sample'
+    flow_packets: int = 100
+    signalling_ports: Sequence[int] = (5060, 5061)
+    window: float = 1.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_rate > 0
+
+
+class RateBudgetSink():
+    # Capture stream is rewritten as pcapng with packets selected by degradation level.
+    # Rate of each window of capture time sets level of next window, change of level is
+    # recorded as comment of first packet it applies to
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, name: str, sink, options: BudgetOptions):
+        if numpy is None:
+            raise ImportError('NumPy is required for capture budget, '
+                              'install remote_pcap[numpy]')
+        if options.mode not in DEGRADE_MODES:
+            raise ValueError(f'Unknown degrade mode: {options.mode}')
+        self.name = name
+        self.logger = logging.getLogger(self.name)
+        self.sink = sink
+        self.options = options
+        self.reader = PacketIndexReader(batch_size=1 << 62, tcp=True)
+        self.signalling_ports = numpy.array(sorted(options.signalling_ports), dtype=numpy.int64)
+        # 0 is full capture, meaning of other levels depends on mode
+        self.level = 0
+        self.input_rate = 0.0
+        self.packets = 0
+        self.dropped = 0
+        self.truncated = 0
+        self.changes = 0
+        self._window_ns = int(options.window * 1_000_000_000)
+        self._window_end: Optional[int] = None
+        self._window_sizes: List['numpy.ndarray'] = []
+        self._sampled = 0
+        self._flows: Dict[bytes, int] = {}
+        self._comment: Optional[str] = None
+        self._buffer = bytearray()
+        self._base = 0
+        self._interfaces = 0
+        self._output = bytearray(section_header_block())
+
+    def open(self):
+        self.sink.open()
+
+    def write(self, data: memoryview):
+        self._buffer += data
+        self.reader.feed(data)
+        for index in self.reader.flush():
+            self._process(index)
+        # Records before parsed offset are written, only incomplete one is kept
+        del self._buffer[:self.reader.parsed_offset - self._base]
+        self._base = self.reader.parsed_offset
+        self._flush()
+
+    def close(self):
+        self._flush()
+        self.sink.close()
+
+    def _flush(self):
+        if not self._output:
+            return
+        with memoryview(self._output) as view:
+            self.sink.write(view)
+        self._output.clear()
+
+    def _process(self, index: 'numpy.ndarray'):
+        timestamps = index['timestamp']
+        if self._window_end is None:
+            self._window_end = int(timestamps[0]) + self._window_ns
+        while len(index):
+            # Rows after end of window are handled with level decided from this window
+            later = timestamps >= self._window_end
+            split = int(numpy.argmax(later)) if later.any() else len(index)
+            self._emit(index[:split])
+            if split == len(index):
+                break
+            self._end_window()
+            index, timestamps = index[split:], timestamps[split:]
+            self._window_end = max(self._window_end + self._window_ns,
+                                   int(timestamps[0]) + self._window_ns)
+
+    def _emit(self, index: 'numpy.ndarray'):
+        if len(index) == 0:
+            return
+        self._window_sizes.append(index['caplen'])
+        selected = self._select(index)
+        snaplen = SNAPLEN_STEPS[self.level] if self.options.mode == 'snaplen' else 0
+        self._describe_interfaces()
+        header_size = PCAP_RECORD_HEADER_SIZE if self.reader.format == 'pcap' else \
+            PCAPNG_PACKET_HEADER_SIZE
+        comments = self._input_comments(index)
+        if comments:
+            selected[list(comments)] = True
+        numbers = numpy.flatnonzero(selected)
+        rows = index[numbers]
+        for number, offset, timestamp, caplen, origlen, interface_id in zip(
+                numbers.tolist(), rows['offset'].tolist(), rows['timestamp'].tolist(),
+                rows['caplen'].tolist(), rows['origlen'].tolist(), rows['interface'].tolist()):
+            start = offset - self._base + header_size
+            if snaplen and caplen > snaplen:
+                self.truncated += 1
+                caplen = snaplen
+            self._output += enhanced_packet_block(
+                interface_id, timestamp, origlen, self._buffer[start:start + caplen],
+                comment='; '.join(filter(None, (comments.get(number), self._comment))) or None)
+            self._comment = None
+        self.packets += len(rows)
+        self.dropped += len(index) - len(rows)
+
+    def _describe_interfaces(self):
+        while self._interfaces < len(self.reader.interfaces):
+            interface = self.reader.interfaces[self._interfaces]
+            self._output += interface_description_block(interface.linktype, interface.snaplen)
+            self._interfaces += 1
+
+    def _input_comments(self, index: 'numpy.ndarray') -> Dict[int, str]:
+        # Comments of pcapng input, like marks of capture gaps, are kept with their packets
+        if self.reader.format == 'pcap':
+            return {}
+        starts = index['offset'] - self._base
+        lengths = numpy.frombuffer(self._buffer, dtype=numpy.uint8)[
+            starts[:, None] + 4 + numpy.arange(4)].view(f'{self.reader.byteorder}u4')[:, 0]
+        padded = (index['caplen'].astype(numpy.int64) + 3) & ~3
+        comments = {}
+        for number in numpy.flatnonzero(lengths > PACKET_OVERHEAD + padded).tolist():
+            start = int(starts[number])
+            comment = packet_comment(self._buffer[start + PCAPNG_PACKET_HEADER_SIZE +
+                                                  int(padded[number]):
+                                                  start + int(lengths[number]) - 4],
+                                     self.reader.byteorder)
+            if comment is not None:
+                comments[number] = comment
+        return comments
+
+    def _select(self, index: 'numpy.ndarray') -> 'numpy.ndarray':
+        # Returns mask of packets kept at current level
+        mode = self.options.mode
+        if mode == 'flows':
+            selected = self._first_flow_packets(index)
+        elif mode == 'sample' and self.level:
+            selected = (numpy.arange(self._sampled, self._sampled + len(index)) %
+                        (self.level + 1)) == 0
+            self._sampled += len(index)
+        else:
+            return numpy.ones(len(index), dtype=bool)
+        if not self.level:
+            return numpy.ones(len(index), dtype=bool)
+        signalling = ((index['tcp_flags'] & TCP_SIGNALLING_FLAGS) != 0) | \
+            numpy.isin(index['sport'], self.signalling_ports) | \
+            numpy.isin(index['dport'], self.signalling_ports)
+        return selected | signalling
+
+    def _first_flow_packets(self, index: 'numpy.ndarray') -> 'numpy.ndarray':
+        # Packets are counted in both directions of conversation from start of capture
+        keys = flow_keys(index)
+        keys = keys.view(f'S{keys.dtype.itemsize}')
+        unique, inverse, counts = numpy.unique(keys, return_inverse=True, return_counts=True)
+        order = numpy.argsort(inverse, kind='stable')
+        starts = numpy.cumsum(counts) - counts
+        ranks = numpy.empty(len(index), dtype=numpy.int64)
+        ranks[order] = numpy.arange(len(index)) - numpy.repeat(starts, counts)
+        if len(self._flows) + len(unique) > FLOWS_LIMIT:
+            self.logger.warning(f'More than {FLOWS_LIMIT} flows, packet counters are reset')
+            self._flows.clear()
+        unique_keys = unique.tolist()
+        seen = numpy.array([self._flows.get(key, 0) for key in unique_keys], dtype=numpy.int64)
+        for key, total in zip(unique_keys, (seen + counts).tolist()):
+            self._flows[key] = total
+        return seen[inverse] + ranks < self.options.flow_packets
+
+    def _end_window(self):
+        sizes = numpy.concatenate(self._window_sizes) if self._window_sizes else \
+            numpy.zeros(0, dtype=numpy.int64)
+        self._window_sizes = []
+        self.input_rate = (int(sizes.sum()) + len(sizes) * PACKET_OVERHEAD) * 8 / \
+            self.options.window
+        level = self._level_for(sizes, self.options.max_rate)
+        if level < self.level:
+            level = max(level, self._level_for(sizes, self.options.max_rate * RELEASE_RATIO))
+        if level == self.level:
+            return
+        self.level = level
+        self.changes += 1
+        self._comment = f'remote_pcap: {self.describe()}'
+        if level:
+            self.logger.warning(self.describe())
+        else:
+            self.logger.info(self.describe())
+
+    def _level_for(self, sizes: 'numpy.ndarray', budget: float) -> int:
+        if self.input_rate <= budget:
+            return 0
+        if self.options.mode == 'sample':
+            return math.ceil(self.input_rate / budget) - 1
+        if self.options.mode == 'flows':
+            return 1
+        budget_bytes = budget * self.options.window / 8 - len(sizes) * PACKET_OVERHEAD
+        for level, snaplen in enumerate(SNAPLEN_STEPS[1:], start=1):
+            if numpy.minimum(sizes, snaplen).sum() <= budget_bytes:
+                return level
+        return len(SNAPLEN_STEPS) - 1
+
+    def describe(self) -> str:
+        rate = f'input {self.input_rate / 1e6:.1f} Mbit/s'
+        budget = f'budget {self.options.max_rate / 1e6:.1f} Mbit/s'
+        if not self.level:
+            return f'{rate} is within {budget}, all packets are kept from here'
+        if self.options.mode == 'snaplen':
+            return f'{rate} exceeds {budget}, packets are truncated to ' \
+                   f'{SNAPLEN_STEPS[self.level]} bytes from here'
+        if self.options.mode == 'sample':
+            kept = f'1 in {self.level + 1} packets'
+        else:
+            kept = f'first {self.options.flow_packets} packets of each flow'
+        return f'{rate} exceeds {budget}, {kept} and TCP SYN/FIN/RST and signalling packets ' \
+               'are kept from here'
+
+    def stats(self) -> Stats:
+        return {'input_bits_per_second': self.input_rate, 'level': self.level,
+                'packets': self.packets, 'dropped': self.dropped, 'truncated': self.truncated,
+                'level_changes': self.changes}
@@ -0,0 +1,135 @@
+import logging
+import os
+import select
+from subprocess import Popen
+from threading import Lock, Thread
+from typing import Callable, Dict, Optional
+
+
+class LineReader():
+
+    def __init__(self, name: str, reactor: 'Reactor', file_descriptor: int,
+                 data_handler: Optional[Callable[[str], None]] = None,
+                 read_size: int = 256 * 1024):
+        self.name = name
+        self.logger = logging.getLogger(self.name)
+        self.reactor = reactor
+        self.file_descriptor = file_descriptor
+        self.read_size = read_size
+        self._data_handler = data_handler if callable(data_handler) else None
+        self._buffer = bytearray()
+
+    def on_events(self, events: int):
+        if events & select.EPOLLIN:
+            try:
+                data = os.read(self.file_descriptor, self.read_size)
+            except BlockingIOError:
+                return
+            if data:
+                self._feed(data)
+                return
+        elif not events & (select.EPOLLHUP | select.EPOLLERR):
+            self.logger.error(f'Recived epoll data with unknown event {events}')
+            return
+
+        self.logger.info('Recive End-Of-Steam, terminate line reader')
+        self.close()
+
+    def close(self):
+        self.reactor.unregister(self.file_descriptor)
+        if self._buffer:
+            self._handle(bytes(self._buffer))
+            self._buffer.clear()
+
+    def _feed(self, data: bytes):
+        # One large read is split into lines in place instead of readline() per line
+        self._buffer += data
+        end = self._buffer.rfind(b'\n')
+        if end < 0:
+            return
+        lines = bytes(self._buffer[:end]).split(b'\n')
+        del self._buffer[:end + 1]
+        for line in lines:
+            self._handle(line)
+
+    def _handle(self, line: bytes):
+        if self._data_handler is not None:
+            self._data_handler(line.decode(encoding='utf8', errors='replace').strip(' \r\n'))
+
+
+class Reactor(Thread):
+
+    _instance: Optional['Reactor'] = None
+    _instance_lock = Lock()
+
+    def __init__(self, name: str = 'reactor'):
+        Thread.__init__(self, name=name, daemon=True)
+        self.logger = logging.getLogger(self.name)
+        self._epoll = select.epoll()
+        self._handlers: Dict[int, Callable[[int], None]] = {}
+
+    @classmethod
+    def instance(cls) -> 'Reactor':
+        with cls._instance_lock:
+            if cls._instance is None or not cls._instance.is_alive():
+                cls._instance = cls()
+                cls._instance.start()
+            return cls._instance
+
+    def register(self, file_descriptor: int, handler: Callable[[int], None],
+                 events: int = select.EPOLLIN):
+        self._handlers[file_descriptor] = handler
+        self._epoll.register(file_descriptor, events)
+
+    def unregister(self, file_descriptor: int):
+        if self._handlers.pop(file_descriptor, None) is not None:
+            try:
+                self._epoll.unregister(file_descriptor)
+            except OSError:
+                # Descriptor was already closed and removed from epoll by kernel
+                pass
+
+    def add_line_reader(self, name: str, file_descriptor: int,
+                        data_handler: Optional[Callable[[str], None]] = None) -> LineReader:
+        reader = LineReader(name, self, file_descriptor, data_handler)
+        os.set_blocking(file_descriptor, False)
+        self.register(file_descriptor, reader.on_events)
+        return reader
+
+    def watch_process(self, process: Popen, exit_handler: Callable[[], None]):
+        try:
+            # pidfd become readable when process exits, no polling with wait(timeout) needed
+            pidfd = os.pidfd_open(process.pid)  # type: ignore[attr-defined]
+        except (AttributeError, OSError):
+            # Python < 3.9 or kernel < 5.3, block in dedicated thread on waitpid instead
+            Thread(target=self._wait_process, args=(process, exit_handler),
+                   name=f'{self.name}.wait.{process.pid}', daemon=True).start()
+            return
+
+        def on_exit(_events: int):
+            self.unregister(pidfd)
+            os.close(pidfd)
+            process.poll()
+            exit_handler()
+
+        self.register(pidfd, on_exit)
+
+    @staticmethod
+    def _wait_process(process: Popen, exit_handler: Callable[[], None]):
+        process.wait()
+        exit_handler()
+
+    def run(self):
+        self.logger.info('Starting ...')
+        while True:
+            for file_descriptor, events in self._epoll.poll():
+                handler = self._handlers.get(file_descriptor)
+                if handler is None:
+                    self.logger.error('Recived epoll data with unknown file descriptor '
+                                      f'{file_descriptor}')
+                    continue
+                try:
+                    handler(events)
+                except Exception:  # pylint: disable=broad-exception-caught
+                    self.logger.exception(f'Handler of file descriptor {file_descriptor} failed')
+                    self.unregister(file_descriptor)
@@ -0,0 +1,257 @@
+import logging
+from threading import Event, Thread
+from time import monotonic
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from paramiko import SSHClient, SSHException
+
+from .compression import StreamDecompressor
+from .metrics import Stats
+from .pcap_stream import PcapStream
+from .pcapng_writer import (enhanced_packet_block, interface_description_block,
+                            section_header_block)
+from .remote_command import CaptureOptions, capture_command
+from .ssh_pump import SSHPump
+
+# Exit code of capture which lost SSH session and could not reconnect, as ssh client does
+CONNECTION_LOST_EXITCODE = 255
+
+
+class ReconnectOptions(NamedTuple):
+    enabled: bool = False
+    initial_delay: float = 1.0
+    max_delay: float = 60.0
+    # 0 is unlimited
+    attempts: int = 0
+    connect_timeout: float = 10.0
+    # Death of connection is noticed also while capture filter matches nothing
+    keepalive: int = 15
+
+
+class ContinuationSink():
+    # Consumer stays open while capture is restarted. Each remote session starts new capture
+    # file, so stream is rewritten as pcapng: interfaces of later sessions are described only
+    # when they differ and first packet after gap carries comment about it
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, name: str, sink):
+        self.name = name
+        self.logger = logging.getLogger(self.name)
+        self.sink = sink
+        self.stream = PcapStream(collect=True)
+        self.packets = 0
+        self.gap_seconds = 0.0
+        self.last_data_at: Optional[float] = None
+        self.resumed_at: Optional[float] = None
+        self._opened = False
+        self._output = bytearray()
+        self._interfaces: Dict[Tuple[int, int], int] = {}
+        self._session_interfaces: List[int] = []
+        self._comment: Optional[str] = None
+        self._gap_started: Optional[float] = None
+
+    def open(self):
+        if self._opened:
+            return
+        self._opened = True
+        self.sink.open()
+        self._output += section_header_block()
+
+    def write(self, data: memoryview):
+        records = self.stream.feed(data)
+        now = monotonic()
+        if self._gap_started is not None and records:
+            gap = now - self._gap_started
+            self.gap_seconds += gap
+            self._gap_started = None
+            self.resumed_at = now
+            self._comment = f'remote_pcap: capture gap of {gap:.1f} s, packets of this time ' \
+                            'were not captured while SSH session was reconnected'
+        while len(self._session_interfaces) < len(self.stream.interfaces):
+            interface = self.stream.interfaces[len(self._session_interfaces)]
+            key = (interface.linktype, interface.snaplen)
+            if key not in self._interfaces:
+                self._interfaces[key] = len(self._interfaces)
+                self._output += interface_description_block(*key)
+            self._session_interfaces.append(self._interfaces[key])
+        for record in records:
+            self._output += enhanced_packet_block(self._session_interfaces[record.interface],
+                                                  record.timestamp, record.origlen,
+                                                  record.data, comment=self._comment)
+            self._comment = None
+        self.packets += len(records)
+        self.last_data_at = now
+        if self._output:
+            with memoryview(self._output) as view:
+                self.sink.write(view)
+            self._output.clear()
+
+    def close(self):
+        # End of one remote session
+        pass
+
+    def start_gap(self):
+        # Next session begins with new capture file header
+        self.stream.reset()
+        self._session_interfaces = []
+        if self._gap_started is None:
+            self._gap_started = self.last_data_at or monotonic()
+
+    def finish(self):
+        if self._opened:
+            self.sink.close()
+
+
+class ReconnectingPump():
+    # Supervisor of SSHPump: when SSH session dies, connection is established again with
+    # exponential backoff and remote capture is restarted into the same consumer
+    # pylint: disable=too-many-instance-attributes
+
+    # pylint: disable-next=too-many-arguments,too-many-positional-arguments
+    def __init__(self, name: str, client: SSHClient, tcpdump_path: str, interface: str,
+                 options: CaptureOptions, sink, connect: Callable[[], SSHClient],
+                 reconnect: ReconnectOptions):
+        self.name = name
+        self.logger = logging.getLogger(self.name)
+        self.client = client
+        self.command = capture_command(tcpdump_path, interface, options)
+        self.compression = options.compression
+        self.connect = connect
+        self.options = reconnect
+        self.continuation = ContinuationSink(f'{name}.continuation', sink)
+        self.pump: Optional[SSHPump] = None
+        self.sessions = 0
+        self.reconnects = 0
+        self.failed_attempts = 0
+        self.last_reconnect_seconds = 0.0
+        self._finished_stats: Dict[str, float] = {}
+        self._own_clients: List[SSHClient] = []
+        self._session_done = Event()
+        self._need_stop = Event()
+        self._thread: Optional[Thread] = None
+        self._returncode: Optional[int] = None
+        self._exit_callbacks: List[Callable[[], None]] = []
+
+    def add_exit_callback(self, callback: Callable[[], None]):
+        self._exit_callbacks.append(callback)
+
+    def run(self):
+        # First session is started by caller thread, so its failure is raised as usual
+        self._start_session(self.client)
+        self._thread = Thread(target=self._supervise, name=f'{self.name}.supervisor',
+                              daemon=True)
+        self._thread.start()
+
+    def _start_session(self, client: SSHClient) -> SSHPump:
+        decompressor = None
+        if self.compression != 'none':
+            decompressor = StreamDecompressor(self.compression)
+        self.sessions += 1
+        pump = SSHPump(f'{self.name}.{self.sessions}', client=client, command=self.command,
+                       sink=self.continuation, decompressor=decompressor)
+        pump.add_exit_callback(self._session_done.set)
+        pump.run()
+        self.pump = pump
+        return pump
+
+    def _supervise(self):
+        try:
+            while True:
+                self._session_done.wait()
+                self._session_done.clear()
+                pump = self.pump
+                assert pump is not None
+                if self._need_stop.is_set() or not pump.connection_lost:
+                    self._returncode = pump.returncode
+                    break
+                lost_at = monotonic()
+                self.logger.warning('SSH session was lost, reconnecting ...')
+                self.continuation.start_gap()
+                self._add_finished_stats(pump.stats())
+                self.pump = None
+                if not self._reconnect():
+                    self._returncode = pump.returncode if self._need_stop.is_set() else \
+                        CONNECTION_LOST_EXITCODE
+                    break
+                self._wait_first_data(lost_at)
+        finally:
+            self.continuation.finish()
+            for client in self._own_clients:
+                client.close()
+            if self._returncode is None:
+                self._returncode = CONNECTION_LOST_EXITCODE
+            for callback in self._exit_callbacks:
+                callback()
+
+    def _reconnect(self) -> bool:
+        delay = self.options.initial_delay
+        attempt = 0
+        while self.options.attempts == 0 or attempt < self.options.attempts:
+            attempt += 1
+            if self._need_stop.wait(delay):
+                return False
+            started = monotonic()
+            try:
+                client = self.connect()
+                self._own_clients.append(client)
+                if (transport := client.get_transport()) is not None:
+                    transport.set_keepalive(self.options.keepalive)
+                pump = self._start_session(client)
+                self.client = client
+            except (OSError, SSHException) as error:
+                self.failed_attempts += 1
+                delay = min(delay * 2, self.options.max_delay)
+                self.logger.warning(f'Reconnect attempt {attempt} failed: {error}, next one in '
+                                    f'{delay:.1f} s')
+                continue
+            self.reconnects += 1
+            if self._need_stop.is_set():
+                pump.stop()
+            self.logger.info(f'Reconnected in {(monotonic() - started) * 1000:.0f} ms after '
+                             f'{attempt} attempts, capture restarted')
+            return True
+        self.logger.error(f'Failed to reconnect after {attempt} attempts')
+        return False
+
+    def _wait_first_data(self, lost_at: float):
+        # Reconnect time is measured from loss of session to first packet of new one, gap
+        # in capture is longer by time in which loss was not noticed yet
+        while not self._need_stop.is_set() and not self._session_done.is_set():
+            if self.continuation.resumed_at is not None and \
+                    self.continuation.resumed_at >= lost_at:
+                break
+            self._session_done.wait(0.1)
+        resumed_at = self.continuation.resumed_at
+        if resumed_at is None or resumed_at < lost_at:
+            return
+        self.last_reconnect_seconds = resumed_at - lost_at
+        self.logger.warning(f'Capture resumed {self.last_reconnect_seconds:.1f} s after SSH '
+                            'session was lost')
+
+    def _add_finished_stats(self, stats: Stats):
+        for key in ('bytes', 'packets', 'wire_bytes'):
+            self._finished_stats[key] = self._finished_stats.get(key, 0) + stats.get(key, 0)
+
+    def stats(self) -> Stats:
+        stats = dict(self.pump.stats()) if self.pump is not None else {}
+        for key, value in self._finished_stats.items():
+            stats[key] = stats.get(key, 0) + value
+        stats.update(reconnects=self.reconnects, failed_reconnects=self.failed_attempts,
+                     gap_seconds=self.continuation.gap_seconds,
+                     last_reconnect_seconds=self.last_reconnect_seconds)
+        return stats
+
+    def stop(self):
+        if self.returncode is not None:
+            return
+
+        self.logger.info('Stoping ...')
+        self._need_stop.set()
+        if self.pump is not None:
+            self.pump.stop()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+
+    @property
+    def returncode(self) -> Optional[int]:
+        return self._returncode
@@ -0,0 +1,43 @@
+from shlex import quote
+from typing import NamedTuple
+
+# Fastest levels, remote side is often a router or busy VoIP server
+COMPRESSOR_COMMANDS = {
+    'zstd': 'zstd -q -1 -c',
+    'lz4': 'lz4 -q -1 -c',
+    'gzip': 'gzip -1 -c'
+}
+
+
+class CaptureOptions(NamedTuple):
+    filter: str = ''
+    snaplen: int = 0
+    buffer_size: int = 0
+    compression: str = 'none'
+
+
+def capture_filter(options: CaptureOptions) -> str:
+    # SSH session which carries capture must never be captured itself
+    if options.filter:
+        return f'not tcp port 22 and ({options.filter})'
+    return 'not tcp port 22'
+
+
+def capture_command(tcpdump_path: str, interface: str,
+                    options: CaptureOptions = CaptureOptions()) -> str:
+    command = f'sudo {tcpdump_path} -i {interface} -U -w -'
+    if options.snaplen:
+        command += f' -s {options.snaplen}'
+    if options.buffer_size:
+        # tcpdump takes buffer size in KiB
+        command += f' -B {max(options.buffer_size // 1024, 1)}'
+    command += f' -f {quote(capture_filter(options))}'
+    if options.compression == 'none':
+        return command
+
+    # Exit status of tcpdump is passed through compressor pipe, so failed capture
+    # is still reported by exit status of remote command
+    compressor = COMPRESSOR_COMMANDS[options.compression]
+    script = (f'exec 4>&1; status=$({{ {{ {command} 3>&-; echo $? >&3; }} '
+              f'| {compressor} >&4; }} 3>&1); exit $status')
+    return f'sh -c {quote(script)}'
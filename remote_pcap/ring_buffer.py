@@ -0,0 +1,355 @@
+import json
+import logging
+import os
+import re
+import struct
+import sys
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta, timezone
+from pathlib import Path
+from shlex import quote
+from threading import Lock, local
+from time import localtime, monotonic, strftime
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from paramiko import SFTPClient, SSHClient
+
+from .capture_slice import parse_time
+from .connection import check_remote_host, resolve_connection, ssh_connection
+from .pcap_stream import PCAP_MAGIC_MICROSECONDS, PCAP_MAGIC_NANOSECONDS
+from .remote_command import CaptureOptions, capture_filter
+from .units import parse_size
+
+# Remote directory of ring buffer files, writable by login user
+DEFAULT_RING_DIR = '/var/tmp/remote_pcap'
+
+# Local record of pulled segments, kept next to them
+PULL_STATE_SUFFIX = '.pull.json'
+
+# Segment header compared before appending new data to segment pulled earlier, covers
+# file header and header of first record
+SEGMENT_HEAD_SIZE = 40
+
+COPY_CHUNK = 1024 * 1024
+
+duration_pattern = re.compile(r'(?P<value>\d+(\.\d+)?)\s*(?P<unit>[smhd]?)', re.IGNORECASE)
+
+DURATION_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+class RingOptions(NamedTuple):
+    ring_dir: str = DEFAULT_RING_DIR
+    file_size: int = 100 * 1000 * 1000
+    file_count: int = 10
+
+
+class RemoteSegment(NamedTuple):
+    name: str
+    size: int
+    # Last modification of segment, start is known from modification of previous one
+    mtime: int
+    start: Optional[int]
+
+
+def parse_duration(value: str) -> float:
+    if match_obj := duration_pattern.fullmatch(value.strip()):
+        return float(match_obj['value']) * DURATION_UNITS[match_obj['unit'].lower()]
+    raise ValueError(f'Invalid duration: {value!r}')
+
+
+def ring_paths(options: RingOptions, interface: str) -> Tuple[str, str, str]:
+    # Capture file name prefix, tcpdump output and PID file of interface
+    base = f'{options.ring_dir.rstrip("/")}/{interface}'
+    return f'{base}.pcap', f'{base}.log', f'{base}.pid'
+
+
+def ring_start_command(tcpdump_path: str, interface: str, user: str,
+                       options: RingOptions = RingOptions(),
+                       capture_options: CaptureOptions = CaptureOptions()) -> str:
+    # tcpdump drops root privileges to login user, so segments are readable over SFTP and
+    # new segments are created in directory of login user
+    capture_path, log_path, pid_path = ring_paths(options, interface)
+    command = (f'sudo -n {tcpdump_path} -i {interface} -U -w {quote(capture_path)} '
+               f'-C {max(options.file_size // 1_000_000, 1)} -W {options.file_count} '
+               f'-Z {quote(user)}')
+    if capture_options.snaplen:
+        command += f' -s {capture_options.snaplen}'
+    if capture_options.buffer_size:
+        command += f' -B {max(capture_options.buffer_size // 1024, 1)}'
+    command += f' -f {quote(capture_filter(capture_options))}'
+    pid = f'"$(cat {quote(pid_path)} 2>/dev/null)"'
+    script = (f'mkdir -p {quote(options.ring_dir)} || exit 1; '
+              f'if kill -0 {pid} 2>/dev/null; then echo "ring buffer is already running" >&2; '
+              f'exit 3; fi; '
+              f'nohup {command} > {quote(log_path)} 2>&1 < /dev/null & '
+              f'echo $! > {quote(pid_path)}; sleep 1; '
+              f'kill -0 $! 2>/dev/null || {{ cat {quote(log_path)} >&2; exit 1; }}')
+    return f'sh -c {quote(script)}'
+
+
+def ring_stop_command(interface: str, options: RingOptions = RingOptions()) -> str:
+    # sudo passes signal of invoking user to tcpdump
+    _, _, pid_path = ring_paths(options, interface)
+    pid = f'"$(cat {quote(pid_path)} 2>/dev/null)"'
+    script = (f'kill {pid} 2>/dev/null || {{ echo "ring buffer is not running" >&2; exit 3; }}; '
+              f'rm -f {quote(pid_path)}')
+    return f'sh -c {quote(script)}'
+
+
+def run_remote(client: SSHClient, command: str) -> str:
+    _, stdout, stderr = client.exec_command(command)
+    output = stdout.read().decode(errors='replace')
+    if (exitcode := stdout.channel.recv_exit_status()) != 0:
+        message = stderr.read().decode(errors='replace').strip()
+        raise RuntimeError(f'Remote command failed, {exitcode=}: {message}')
+    return output
+
+
+def list_segments(sftp: SFTPClient, options: RingOptions, interface: str) -> List[RemoteSegment]:
+    # Segments in order of writing, tcpdump reuses names when ring wraps around
+    capture_path, _, _ = ring_paths(options, interface)
+    prefix = os.path.basename(capture_path)
+    attributes = sorted((attributes for attributes in sftp.listdir_attr(options.ring_dir)
+                         if attributes.filename.startswith(prefix) and
+                         attributes.filename[len(prefix):].isdigit()),
+                        key=lambda attributes: (attributes.st_mtime or 0, attributes.filename))
+    segments = []
+    start = None
+    for attribute in attributes:
+        segments.append(RemoteSegment(attribute.filename, attribute.st_size or 0,
+                                      attribute.st_mtime or 0, start))
+        start = attribute.st_mtime
+    return segments
+
+
+def select_segments(segments: List[RemoteSegment], start: Optional[float],
+                    end: Optional[float]) -> List[RemoteSegment]:
+    # Last segment is still written, its modification time is not its end
+    return [segment for number, segment in enumerate(segments)
+            if (start is None or segment.mtime >= start or number == len(segments) - 1) and
+            (end is None or segment.start is None or segment.start <= end)]
+
+
+def first_record_time(head: bytes) -> Optional[int]:
+    # Seconds of first record of pcap file, None for pcapng or empty file
+    if len(head) < SEGMENT_HEAD_SIZE:
+        return None
+    for byteorder in '<>':
+        magic = struct.unpack_from(f'{byteorder}I', head)[0]
+        if magic in (PCAP_MAGIC_MICROSECONDS, PCAP_MAGIC_NANOSECONDS):
+            return struct.unpack_from(f'{byteorder}I', head, 24)[0]
+    return None
+
+
+class SegmentPuller():
+    # Copies remote segments into local directory, each segment is copied once, segment still
+    # written by tcpdump is continued from where previous pull stopped
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, client: SSHClient, options: RingOptions, interface: str, output_dir: Path,
+                 jobs: int = 4):
+        self.logger = logging.getLogger('pull')
+        self.client = client
+        self.options = options
+        self.interface = interface
+        self.output_dir = output_dir
+        self.jobs = jobs
+        self.state_path = output_dir / f'.{interface}{PULL_STATE_SUFFIX}'
+        self.state: Dict[str, Dict] = self.load_state()
+        self.pulled_bytes = 0
+        self._local = local()
+        self._names_lock = Lock()
+
+    def load_state(self) -> Dict[str, Dict]:
+        try:
+            with open(self.state_path, encoding='utf-8') as state_file:
+                return json.load(state_file)
+        except (OSError, ValueError):
+            return {}
+
+    def store_state(self):
+        temporary_path = self.state_path.with_name(f'{self.state_path.name}.tmp')
+        with open(temporary_path, 'w', encoding='utf-8') as state_file:
+            json.dump(self.state, state_file, indent=1)
+        temporary_path.replace(self.state_path)
+
+    @property
+    def sftp(self) -> SFTPClient:
+        # Each worker has own SFTP channel on the same SSH connection
+        if (sftp := getattr(self._local, 'sftp', None)) is None:
+            sftp = self._local.sftp = self.client.open_sftp()
+        return sftp
+
+    def pull(self, segments: List[RemoteSegment]) -> List[Path]:
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix='pull') as executor:
+            paths = list(executor.map(self.pull_segment, segments))
+        self.store_state()
+        return paths
+
+    def pull_segment(self, segment: RemoteSegment) -> Path:
+        remote_path = f'{self.options.ring_dir.rstrip("/")}/{segment.name}'
+        known = self.state.get(segment.name)
+        with self.sftp.open(remote_path, 'rb') as remote_file:
+            head = remote_file.read(SEGMENT_HEAD_SIZE)
+            if known and known['head'] == head.hex() and Path(known['path']).exists():
+                path, offset = Path(known['path']), known['size']
+                if offset >= segment.size:
+                    self.logger.debug(f'{segment.name} is already pulled to {path}')
+                    return path
+            else:
+                # New segment, or ring wrapped around and name was reused
+                path, offset = self.make_path(head), 0
+            self.copy(remote_file, path, offset, segment.size)
+        self.logger.info(f'Pulled {segment.size - offset} bytes of {segment.name} to {path}')
+        self.state[segment.name] = {'path': str(path), 'size': segment.size, 'head': head.hex()}
+        return path
+
+    def copy(self, remote_file, path: Path, offset: int, size: int):
+        # Only size known from listing is copied, segment may grow meanwhile
+        remote_file.seek(offset)
+        remote_file.prefetch(size)
+        with open(path, 'r+b' if offset else 'wb') as local_file:
+            local_file.seek(offset)
+            local_file.truncate()
+            while offset < size:
+                chunk = remote_file.read(min(COPY_CHUNK, size - offset))
+                if not chunk:
+                    break
+                local_file.write(chunk)
+                offset += len(chunk)
+                self.pulled_bytes += len(chunk)
+
+    def make_path(self, head: bytes) -> Path:
+        when = strftime('%Y%m%d%H%M%S', localtime(first_record_time(head)))
+        path = self.output_dir / f'{self.interface}_{when}.pcap'
+        number = 1
+        # Name is taken by creating empty file, segments started in the same second are
+        # pulled at once
+        with self._names_lock:
+            while path.exists():
+                path = self.output_dir / f'{self.interface}_{when}_{number}.pcap'
+                number += 1
+            path.touch()
+        return path
+
+
+def create_ring_parser(pull: bool = False) -> ArgumentParser:
+    if pull:
+        parser = ArgumentParser(prog='remote_pcap pull',
+                                description='Copy segments of remote ring buffer covering time '
+                                            'window')
+    else:
+        parser = ArgumentParser(prog='remote_pcap ring',
+                                description='Start or stop capture to ring buffer of files in '
+                                            'remote host')
+    parser.add_argument('remote', type=str, metavar='REMOTE HOST', help='Capture in host address')
+    parser.add_argument('-i', '--interface', type=str, required=True, help='Capture in interface')
+    parser.add_argument('-u', '--user', type=str, help='Username for login')
+    parser.add_argument('-p', '--password', type=str, help='Password for login')
+    parser.add_argument('-k', '--identityfile', type=str, help='File with custom private key')
+    parser.add_argument('--ring-dir', type=str, default=DEFAULT_RING_DIR, metavar='DIR',
+                        help=f'Directory of ring buffer in remote host, default {DEFAULT_RING_DIR}')
+    if pull:
+        parser.add_argument('-w', '--write', type=Path, default=Path('.'), metavar='DIR',
+                            help='Local directory of pulled segments')
+        parser.add_argument('--last', type=parse_duration, metavar='DURATION',
+                            help='Pull last DURATION of capture, e.g. 300, 5m or 1h')
+        parser.add_argument('--start', type=str, metavar='TIME',
+                            help='Start of window: epoch seconds, ISO date and time or '
+                                 'HH:MM:SS of today, in time zone of remote host')
+        parser.add_argument('--end', type=str, metavar='TIME', help='End of window')
+        parser.add_argument('-j', '--jobs', type=int, default=4, metavar='COUNT',
+                            help='Segments copied at once over the same SSH connection')
+        return parser
+    parser.add_argument('--stop', action='store_true', help='Stop running ring buffer capture')
+    parser.add_argument('-C', '--file-size', type=parse_size, default='100M', metavar='SIZE',
+                        help='Size of each segment, rounded down to millions of bytes')
+    parser.add_argument('-W', '--file-count', type=int, default=10, metavar='COUNT',
+                        help='Segments kept in remote host')
+    parser.add_argument('-f', '--filter', type=str, default='', metavar='EXPRESSION',
+                        help='Capture filter in pcap-filter syntax')
+    parser.add_argument('--snaplen', type=int, default=0, metavar='BYTES',
+                        help='Capture only first BYTES of each packet')
+    parser.add_argument('-B', '--buffer-size', type=parse_size, default=0, metavar='SIZE',
+                        help='Kernel capture buffer size in remote host')
+    return parser
+
+
+def connect(parser: ArgumentParser, prog_args: Namespace) -> Dict:
+    if prog_args.password is not None and prog_args.identityfile is not None:
+        parser.error('argument -k/--identityfile: not allowed with argument -p/--password')
+    return resolve_connection(parser, prog_args, prog_args.remote)
+
+
+def run_ring(argv: List[str]):
+    parser = create_ring_parser()
+    prog_args = parser.parse_args(argv)
+    connection = connect(parser, prog_args)
+    options = RingOptions(ring_dir=prog_args.ring_dir, file_size=prog_args.file_size,
+                          file_count=prog_args.file_count)
+    try:
+        with ssh_connection(**connection) as client:
+            if prog_args.stop:
+                run_remote(client, ring_stop_command(prog_args.interface, options))
+                logging.info(f'Ring buffer capture of {prog_args.interface} is stopped, '
+                             f'segments are kept in {options.ring_dir}')
+                return
+            # Same checks of tcpdump, sudo and interface as before streamed capture
+            preflight = check_remote_host(client, prog_args.interface)
+            assert preflight.tcpdump_path is not None
+            capture_options = CaptureOptions(filter=prog_args.filter, snaplen=prog_args.snaplen,
+                                             buffer_size=prog_args.buffer_size)
+            run_remote(client, ring_start_command(preflight.tcpdump_path, prog_args.interface,
+                                                  connection['user'], options, capture_options))
+    except (RuntimeError, LookupError) as error:
+        logging.error(str(error))
+        sys.exit(1)
+    logging.info(f'Ring buffer capture of {prog_args.interface} is running in '
+                 f'{options.ring_dir}: {options.file_count} segments of '
+                 f'{options.file_size // 1_000_000} MB')
+
+
+def pull_window(parser: ArgumentParser, prog_args: Namespace,
+                client: SSHClient) -> Tuple[Optional[float], Optional[float]]:
+    # Window is in clock and time zone of remote host, which set modification times of
+    # segments. Zone is taken as current UTC offset like +0300
+    output = run_remote(client, 'date +%s%z').strip()
+    now = float(output[:-5])
+    offset = int(output[-4:-2]) * 60 + int(output[-2:])
+    remote_zone = timezone(timedelta(minutes=-offset if output[-5] == '-' else offset))
+    if prog_args.last:
+        return now - prog_args.last, None
+    try:
+        start, end = (parse_time(value, round(now * 1e9), remote_zone) / 1e9 if value else None
+                      for value in (prog_args.start, prog_args.end))
+    except ValueError as error:
+        parser.error(f'invalid time: {error}')
+    return start, end
+
+
+def run_pull(argv: List[str]):
+    parser = create_ring_parser(pull=True)
+    prog_args = parser.parse_args(argv)
+    if prog_args.last and (prog_args.start or prog_args.end):
+        parser.error('argument --last: not allowed with argument --start or --end')
+    connection = connect(parser, prog_args)
+    options = RingOptions(ring_dir=prog_args.ring_dir)
+
+    with ssh_connection(**connection) as client:
+        start, end = pull_window(parser, prog_args, client)
+        puller = SegmentPuller(client, options, prog_args.interface, prog_args.write,
+                               jobs=prog_args.jobs)
+        segments = list_segments(puller.sftp, options, prog_args.interface)
+        if not segments:
+            logging.error(f'No ring buffer segments of {prog_args.interface} in '
+                          f'{options.ring_dir}')
+            sys.exit(1)
+        selected = select_segments(segments, start, end)
+        started = monotonic()
+        paths = puller.pull(selected)
+    logging.info(f'Pulled {len(selected)} of {len(segments)} segments, '
+                 f'{puller.pulled_bytes} bytes in {monotonic() - started:.1f} s')
+    for path in paths:
+        print(path)
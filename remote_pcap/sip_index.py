@@ -0,0 +1,193 @@
+import ipaddress
+import json
+import re
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # type: ignore
+
+from .packet_index import ENDPOINT_FIELDS, IPV4_MAPPED_PREFIX
+
+CALLS_SUFFIX = '.calls'
+RTP_OFFSETS_SUFFIX = '.calls.npy'
+
+# Oldest media endpoints are forgotten when there are more of them
+MAX_ENDPOINTS = 1_000_000
+
+sip_start_line = re.compile(rb'(?:[A-Z]+ \S+ SIP/2\.0|SIP/2\.0 \d{3} )')
+call_id_header = re.compile(rb'^(?:call-id|i)[ \t]*:[ \t]*(\S+)', re.IGNORECASE | re.MULTILINE)
+content_type_sdp = re.compile(rb'^(?:content-type|c)[ \t]*:[ \t]*application/sdp',
+                              re.IGNORECASE | re.MULTILINE)
+
+Endpoint = Tuple[str, int]
+
+
+def sdp_endpoints(body: bytes) -> List[Endpoint]:
+    # RTP and RTCP address and port of each media description of SDP body
+    session_address: Optional[str] = None
+    media: List[List] = []
+    for line in body.splitlines():
+        if line.startswith(b'c=') and len(fields := line[2:].split()) >= 3:
+            connection = fields[2].split(b'/')[0].decode(errors='replace')
+            if media:
+                media[-1][1] = connection
+            else:
+                session_address = connection
+        elif line.startswith(b'm=') and len(fields := line[2:].split()) >= 2:
+            media.append([int(fields[1].split(b'/')[0]), None])
+    endpoints: List[Endpoint] = []
+    for port, media_address in media:
+        address = media_address or session_address
+        # Port 0 is rejected or disabled stream
+        if port and address:
+            endpoints.extend(((address, port), (address, port + 1)))
+    return endpoints
+
+
+def endpoint_key(endpoint: Endpoint) -> Optional[bytes]:
+    # Same bytes as address and port fields of ENDPOINT_FIELDS
+    try:
+        address = ipaddress.ip_address(endpoint[0])
+    except ValueError:
+        return None
+    packed = address.packed if address.version == 6 else IPV4_MAPPED_PREFIX + address.packed
+    return packed + endpoint[1].to_bytes(2, 'big')
+
+
+def endpoint_keys(addresses: 'numpy.ndarray', ports: 'numpy.ndarray') -> 'numpy.ndarray':
+    endpoints = numpy.zeros(len(addresses), dtype=ENDPOINT_FIELDS)
+    endpoints['address'] = addresses
+    endpoints['port'] = ports
+    return endpoints.view(f'S{endpoints.dtype.itemsize}')
+
+
+class SipIndexer():
+    # Call-ID of SIP packets and RTP packets of endpoints negotiated by SDP, offsets are
+    # kept for current capture file, endpoints are kept across files
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, max_endpoints: int = MAX_ENDPOINTS):
+        if numpy is None:
+            raise ImportError('NumPy is required for SIP index, install remote_pcap[numpy]')
+        self.max_endpoints = max_endpoints
+        self.call_ids: List[str] = []
+        self._call_numbers: Dict[str, int] = {}
+        self._endpoints: Dict[bytes, int] = {}
+        self._endpoint_keys = numpy.zeros(0, dtype='S18')
+        self._endpoint_calls = numpy.zeros(0, dtype=numpy.int64)
+        self._endpoints_changed = False
+        self.sip: Dict[int, List[int]] = {}
+        self.media: Dict[int, Set[Endpoint]] = {}
+        self._rtp_offsets: List = []
+        self._rtp_calls: List = []
+
+    def reset(self):
+        self.sip = {}
+        self.media = {}
+        self._rtp_offsets = []
+        self._rtp_calls = []
+
+    def add_batch(self, batch: 'numpy.ndarray', payloads: Dict[int, bytes], delta: int):
+        # Payloads of batch are removed from payloads, delta converts stream offset to file
+        last_offset = int(batch['offset'][-1])
+        while payloads:
+            offset = next(iter(payloads))
+            if offset > last_offset:
+                break
+            self.on_sip(offset + delta, payloads.pop(offset))
+        if self._endpoints_changed:
+            self._update_endpoints()
+        if len(self._endpoint_keys) == 0:
+            return
+
+        calls = numpy.full(len(batch), -1, dtype=numpy.int64)
+        for addresses, ports in (('src', 'sport'), ('dst', 'dport')):
+            keys = endpoint_keys(batch[addresses], batch[ports])
+            positions = numpy.searchsorted(self._endpoint_keys, keys)
+            positions = numpy.minimum(positions, len(self._endpoint_keys) - 1)
+            found = self._endpoint_keys[positions] == keys
+            calls = numpy.where(found, self._endpoint_calls[positions], calls)
+        selected = (calls >= 0) & (batch['protocol'] == 17)
+        if selected.any():
+            self._rtp_offsets.append(batch['offset'][selected] + delta)
+            self._rtp_calls.append(calls[selected])
+
+    def on_sip(self, offset: int, payload: bytes):
+        if not sip_start_line.match(payload):
+            return
+        headers, _, body = payload.partition(b'\r\n\r\n')
+        if not (match_obj := call_id_header.search(headers)):
+            return
+        call_id = match_obj[1].decode(errors='replace')
+        number = self._call_numbers.get(call_id)
+        if number is None:
+            number = self._call_numbers[call_id] = len(self.call_ids)
+            self.call_ids.append(call_id)
+        self.sip.setdefault(number, []).append(offset)
+        if not body or not content_type_sdp.search(headers):
+            return
+        for endpoint in sdp_endpoints(body):
+            if (key := endpoint_key(endpoint)) is None:
+                continue
+            # Endpoint reused by later call belongs to it from now on
+            self._endpoints.pop(key, None)
+            self._endpoints[key] = number
+            self.media.setdefault(number, set()).add(endpoint)
+            self._endpoints_changed = True
+        while len(self._endpoints) > self.max_endpoints:
+            del self._endpoints[next(iter(self._endpoints))]
+
+    def _update_endpoints(self):
+        keys = numpy.array(list(self._endpoints), dtype='S18')
+        calls = numpy.array(list(self._endpoints.values()), dtype=numpy.int64)
+        order = numpy.argsort(keys)
+        self._endpoint_keys, self._endpoint_calls = keys[order], calls[order]
+        self._endpoints_changed = False
+
+    def write(self, file_path: Path):
+        # RTP offsets are stored grouped by call in binary file, JSON keeps their ranges
+        if self._rtp_offsets:
+            offsets = numpy.concatenate(self._rtp_offsets)
+            calls = numpy.concatenate(self._rtp_calls)
+        else:
+            offsets = calls = numpy.zeros(0, dtype=numpy.int64)
+        order = numpy.lexsort((offsets, calls))
+        numbers, starts, counts = numpy.unique(calls[order], return_index=True,
+                                               return_counts=True)
+        rtp = {number: (start, count) for number, start, count in
+               zip(numbers.tolist(), starts.tolist(), counts.tolist())}
+        with open(f'{file_path}{RTP_OFFSETS_SUFFIX}', 'wb') as rtp_file:
+            numpy.save(rtp_file, offsets[order])
+
+        calls_index = {}
+        for number in sorted(set(self.sip) | set(rtp)):
+            calls_index[self.call_ids[number]] = {
+                'sip': self.sip.get(number, []),
+                'rtp': rtp.get(number, (0, 0)),
+                'media': sorted(self.media.get(number, ()))
+            }
+        with open(f'{file_path}{CALLS_SUFFIX}', 'w', encoding='utf-8') as calls_file:
+            json.dump({'file': file_path.name, 'calls': calls_index}, calls_file)
+
+
+def load_calls(file_path: Union[Path, str]) -> Optional[Dict]:
+    try:
+        with open(f'{file_path}{CALLS_SUFFIX}', encoding='utf-8') as calls_file:
+            return json.load(calls_file)['calls']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def call_offsets(file_path: Union[Path, str], call: Dict) -> List[int]:
+    # Offsets of SIP and RTP records of call in capture file, in file order
+    offsets = list(call['sip'])
+    start, count = call['rtp']
+    if count:
+        if numpy is None:
+            raise ImportError('NumPy is required for SIP index, install remote_pcap[numpy]')
+        rtp_offsets = numpy.load(f'{file_path}{RTP_OFFSETS_SUFFIX}', mmap_mode='r')
+        offsets.extend(rtp_offsets[start:start + count].tolist())
+    return sorted(offsets)
@@ -0,0 +1,165 @@
+import logging
+import mmap
+import tempfile
+from threading import Condition, Thread
+from typing import Dict, Optional, Union
+
+
+class ByteRing():
+    def __init__(self, buffer: Union[bytearray, mmap.mmap]):
+        self.buffer = buffer
+        self.size = len(buffer)
+        self.start = 0
+        self.used = 0
+
+    @property
+    def free(self) -> int:
+        return self.size - self.used
+
+    def put(self, data: memoryview):
+        end = (self.start + self.used) % self.size
+        first = min(len(data), self.size - end)
+        self.buffer[end:end + first] = data[:first]
+        if first < len(data):
+            self.buffer[:len(data) - first] = data[first:]
+        self.used += len(data)
+
+    def peek(self, limit: int) -> memoryview:
+        length = min(self.used, self.size - self.start, limit)
+        return memoryview(self.buffer)[self.start:self.start + length]
+
+    def consume(self, length: int):
+        self.used -= length
+        self.start = 0 if self.used == 0 else (self.start + length) % self.size
+
+
+class SpillBuffer():
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, name: str, sink, memory_size: int = 32 * 1024 * 1024,
+                 spill_size: int = 1024 * 1024 * 1024, spill_dir: Optional[str] = None,
+                 write_size: int = 1024 * 1024, stall_timeout: float = 1.0):
+        if memory_size <= 0:
+            raise ValueError('Memory buffer size must be positive')
+        self.name = name
+        self.logger = logging.getLogger(self.name)
+        self.sink = sink
+        self.spill_size = spill_size
+        self.spill_dir = spill_dir
+        self.write_size = write_size
+        self.stall_timeout = stall_timeout
+        self.memory = ByteRing(bytearray(memory_size))
+        self.spill: Optional[ByteRing] = None
+        self.high_water = 0
+        self.memory_high_water = 0
+        self.spill_high_water = 0
+        self.spilled_bytes = 0
+        self.written_bytes = 0
+        self._spill_file = None
+        self._condition = Condition()
+        self._thread: Optional[Thread] = None
+        self._closing = False
+        self._broken = False
+
+    @property
+    def buffered_bytes(self) -> int:
+        return self.memory.used + (self.spill.used if self.spill else 0)
+
+    def stats(self) -> Dict[str, float]:
+        return {'bytes': self.written_bytes, 'queued_bytes': self.buffered_bytes,
+                'spilled_bytes': self.spilled_bytes, 'high_water_bytes': self.high_water}
+
+    def open(self):
+        if self.spill_size:
+            # Sparse temporary file, disk space is used only when analyzer really stalls
+            # pylint: disable-next=consider-using-with
+            self._spill_file = tempfile.TemporaryFile(prefix='remote_pcap_spill_',
+                                                      dir=self.spill_dir)
+            self._spill_file.truncate(self.spill_size)
+            self.spill = ByteRing(mmap.mmap(self._spill_file.fileno(), self.spill_size))
+        self._thread = Thread(target=self._drain, name=f'{self.name}.drain', daemon=True)
+        self._thread.start()
+
+    def write(self, data: memoryview):
+        with self._condition:
+            if self._broken:
+                raise BrokenPipeError('Consumer of spill buffer is closed')
+            spill = self.spill
+            if (spill is None or spill.used == 0) and self.memory.free >= len(data):
+                self.memory.put(data)
+            elif spill is not None:
+                # Keep stream order: while spill is not drained all new data go to spill
+                if spill.free < len(data):
+                    self.logger.warning('Spill buffer is full, blocking capture stream')
+                self._put_blocking(spill, data)
+                self.spilled_bytes += len(data)
+            else:
+                self._put_blocking(self.memory, data)
+            self.memory_high_water = max(self.memory_high_water, self.memory.used)
+            self.high_water = max(self.high_water, self.buffered_bytes)
+            self._condition.notify_all()
+
+    def _put_blocking(self, ring: ByteRing, data: memoryview):
+        # Data larger than free space is put in pieces as drain makes room
+        while data and not self._broken:
+            while ring.free == 0 and not self._broken:
+                self._condition.wait()
+            length = min(ring.free, len(data))
+            ring.put(data[:length])
+            if ring is self.spill:
+                self.spill_high_water = max(self.spill_high_water, ring.used)
+            self._condition.notify_all()
+            data = data[length:]
+
+    def _drain(self):
+        try:
+            self.sink.open()
+            while True:
+                with self._condition:
+                    while self.buffered_bytes == 0 and not self._closing:
+                        self._condition.wait()
+                    if self.buffered_bytes == 0:
+                        break
+                    ring = self.memory if self.memory.used else self.spill
+                    assert ring is not None
+                    view = ring.peek(self.write_size)
+                # Peeked region is not touched by writer until it is consumed
+                with view:
+                    self.sink.write(view)
+                    length = len(view)
+                with self._condition:
+                    ring.consume(length)
+                    self.written_bytes += length
+                    self._condition.notify_all()
+        except BrokenPipeError:
+            self.logger.info('Consumer closed the pipe')
+        except OSError as error:
+            self.logger.error(f'Failed to write to consumer: {error}')
+        finally:
+            with self._condition:
+                self._broken = True
+                self._condition.notify_all()
+            self.sink.close()
+
+    def close(self):
+        with self._condition:
+            self._closing = True
+            self._condition.notify_all()
+        # Buffered data is drained while consumer takes it, stalled consumer is abandoned
+        written = -1
+        while self._thread is not None and self._thread.is_alive() and \
+                written != self.written_bytes:
+            written = self.written_bytes
+            self._thread.join(timeout=self.stall_timeout)
+        if self._thread is not None and self._thread.is_alive():
+            # Drain thread may still use spill mapping, it is freed on exit
+            self.logger.warning(f'Consumer stalled, {self.buffered_bytes} buffered bytes '
+                                'are dropped')
+            return
+        self.logger.info(f'High water {self.high_water} bytes '
+                         f'(memory {self.memory_high_water}, spill {self.spill_high_water}), '
+                         f'spilled {self.spilled_bytes} bytes')
+        if self.spill is not None:
+            self.spill.buffer.close()
+        if self._spill_file is not None:
+            self._spill_file.close()
@@ -0,0 +1,203 @@
+import logging
+import socket
+from threading import Thread
+from time import monotonic
+from typing import Callable, List, Optional
+
+from paramiko import Channel, SSHClient, SSHException
+
+from .compression import StreamDecompressor
+from .exceptions import DecompressError, ParsePcapError
+from .metrics import Stats, parse_tcpdump_summary
+from .pcap_stream import PcapStream
+from .startup import record_first_packet
+
+# Largest chunk written to sink at once, buffers before analyzers hold at least one
+PUMP_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+class SSHPump():
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, name: str, client: SSHClient, command: str, sink,
+                 buffer_size: int = PUMP_BUFFER_SIZE,
+                 window_size: int = 32 * 1024 * 1024,
+                 max_packet_size: int = 256 * 1024,
+                 decompressor: Optional[StreamDecompressor] = None):
+        self.name = name
+        self.logger = logging.getLogger(self.name)
+        self.client = client
+        self.command = command
+        self.sink = sink
+        self.buffer_size = buffer_size
+        self.window_size = window_size
+        self.max_packet_size = max_packet_size
+        self.decompressor = decompressor
+        self.stream = PcapStream()
+        self.channel: Optional[Channel] = None
+        self.started_at: Optional[float] = None
+        self.first_data_at: Optional[float] = None
+        self._thread: Optional[Thread] = None
+        self._need_stop = False
+        self._exit_status: Optional[int] = None
+        # SSH session died under running capture, not set for end of stream or stop
+        self.connection_lost = False
+        # Capture stream could not be decoded, capture fails even if remote command succeeds
+        self.stream_failed = False
+        # Consumer closed its end, capture is ended by it and not by remote side
+        self.consumer_closed = False
+        # Packets are counted until stream turns out not to be pcap
+        self._counting = True
+        self._stderr_tail = bytearray()
+        self._exit_callbacks: List[Callable[[], None]] = []
+        self.remote_stats: Stats = {}
+
+    @property
+    def bytes(self) -> int:
+        return self.stream.bytes
+
+    @property
+    def packets(self) -> int:
+        return self.stream.packets
+
+    def run(self):
+        self.logger.info('Starting ...')
+        transport = self.client.get_transport()
+        if transport is None or not transport.is_active():
+            raise SSHException('SSH transport is not connected')
+
+        self.started_at = monotonic()
+        # Big window allow remote side to send without waiting for window adjust messages
+        self.channel = transport.open_session(window_size=self.window_size,
+                                              max_packet_size=self.max_packet_size)
+        self.logger.info(f'Executing remote command: {self.command}')
+        self.channel.exec_command(self.command)
+        self._thread = Thread(target=self._pump, name=f'{self.name}.pump', daemon=True)
+        self._thread.start()
+
+    def _pump(self):
+        channel = self.channel
+        assert channel is not None
+        buffer = bytearray(self.buffer_size)
+        view = memoryview(buffer)
+        filled = 0
+        try:
+            self.sink.open()
+            while self._need_stop is False:
+                chunk = channel.recv(self.buffer_size - filled)
+                if not chunk:
+                    self.logger.info('Recive End-Of-Stream from remote command')
+                    break
+                view[filled:filled + len(chunk)] = chunk
+                filled += len(chunk)
+                if self.first_data_at is None:
+                    self.first_data_at = monotonic()
+                    self.logger.info('Recived first data after '
+                                     f'{(self.first_data_at - self.started_at) * 1000:.1f} ms')
+                    record_first_packet(self.name, self.started_at, self.first_data_at)
+                # Coalesce small SSH messages into one write while remote keeps sending
+                if filled == self.buffer_size or not channel.recv_ready():
+                    self._flush(view[:filled])
+                    filled = 0
+                if channel.recv_stderr_ready():
+                    self._read_stderr()
+            if filled:
+                self._flush(view[:filled])
+        except BrokenPipeError:
+            self.logger.info('Packet analyzer closed the pipe')
+            self.consumer_closed = True
+        except (DecompressError, ParsePcapError) as error:
+            self.logger.error(f'Failed to decode capture stream: {error}')
+            self.stream_failed = True
+        except (OSError, socket.timeout, SSHException) as error:
+            self.logger.error(f'Failed to pump capture stream: {error}')
+        finally:
+            view.release()
+            transport = channel.get_transport()
+            self.connection_lost = self._need_stop is False and \
+                (transport is None or not transport.is_active())
+            # Exit status of finished remote command is known before consumers see end
+            # of stream, command which is still running is terminated by channel close
+            if not channel.eof_received:
+                channel.close()
+            self._read_stderr()
+            self._exit_status = self._remote_exit_status(channel)
+            channel.close()
+            self.sink.close()
+            self._log_summary()
+            for callback in self._exit_callbacks:
+                callback()
+
+    def _remote_exit_status(self, channel: Channel) -> int:
+        status = channel.recv_exit_status()
+        # Command terminated by our own channel close has no exit status, that is not failure
+        # of capture. Without stop or closed consumer it means remote side never sent one
+        if status == -1 and (self._need_stop or self.consumer_closed):
+            status = 0
+        # Remote command which succeeded with undecodable output is failed capture
+        return status or int(self.stream_failed)
+
+    def _log_summary(self):
+        self.logger.info(f'Pumped {self.packets} packets, {self.bytes} bytes, '
+                         f'remote exitcode {self._exit_status}')
+        if self.decompressor is not None:
+            self.logger.info(f'Recived {self.decompressor.input_bytes} bytes of '
+                             f'{self.decompressor.method} stream, compression ratio '
+                             f'{self.decompressor.ratio:.2f}')
+
+    def add_exit_callback(self, callback: Callable[[], None]):
+        self._exit_callbacks.append(callback)
+
+    def _flush(self, data: memoryview):
+        if self.decompressor is not None:
+            data = memoryview(self.decompressor.decompress(data))
+            if not data:
+                return
+        self.sink.write(data)
+        if not self._counting:
+            return
+        try:
+            self.stream.feed(data)
+        except ParsePcapError as error:
+            # Consumers get stream as it is, e.g. with banner of remote shell before capture
+            self._counting = False
+            self.logger.warning(f'Capture stream is not pcap, packets are not counted: {error}')
+
+    def _read_stderr(self):
+        channel = self.channel
+        assert channel is not None
+        while channel.recv_stderr_ready():
+            self._stderr_tail += channel.recv_stderr(65536)
+        *lines, tail = self._stderr_tail.split(b'\n')
+        self._stderr_tail = bytearray(tail)
+        for line in lines:
+            if line := line.strip():
+                self.handle_stderr(line.decode(encoding='utf8', errors='replace'))
+
+    def handle_stderr(self, data: str):
+        if parse_tcpdump_summary(data, self.remote_stats) and 'dropped' in data and \
+                not data.startswith('0 '):
+            self.logger.warning(f'remote -- {data}')
+        else:
+            self.logger.info(f'remote -- {data}')
+
+    def stats(self) -> Stats:
+        wire_bytes = self.decompressor.input_bytes if self.decompressor else self.bytes
+        return dict(self.remote_stats, bytes=self.bytes, packets=self.packets,
+                    wire_bytes=wire_bytes)
+
+    def stop(self):
+        if self.returncode is not None:
+            return
+
+        self.logger.info('Stoping ...')
+        self._need_stop = True
+        if self.channel is not None:
+            self.channel.close()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+
+    @property
+    def returncode(self) -> Optional[int]:
+        # Set by pump thread right before exit callbacks are called
+        return self._exit_status
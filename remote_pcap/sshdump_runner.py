@@ -1,28 +1,42 @@
+import logging
 import os
 from pathlib import Path
-from typing import Dict, Optional, Union
+from typing import Optional, Union
 
-from .exceptions import ParseMessageError
-from .log_patterns import (filename_lineno_func_msg, only_message,
-                           process_timestamp, subsystem_level)
+from .log_parser import LocalClock, LogLineParser
+from .metrics import Stats, parse_tcpdump_summary
+from .remote_command import CaptureOptions, capture_command
 from .wireshark_runner import WiresharkRunner
 
+# Most verbose sshdump level of which messages pass logger level, debug lines are not
+# even written to pipe unless they are logged
+SSHDUMP_LOG_LEVELS = ((logging.DEBUG, 'debug'), (logging.INFO, 'info'),
+                      (logging.WARNING, 'warning'), (logging.ERROR, 'error'))
+
 
 class SSHDumpRunner(WiresharkRunner):
+    # pylint: disable=too-many-instance-attributes
+
+    log_parser = LogLineParser()
 
+    # pylint: disable-next=too-many-arguments,too-many-positional-arguments
     def __init__(self, name: str, pipename: str,
                  hostname: str, port: Union[str, int],
                  interface: str, user: str, password: Optional[str] = None,
                  identityfile: Optional[Union[Path, str]] = None,
-                 tcpdump_path: str = '/usr/bin/tcpdump'):
-        super(WiresharkRunner, self).__init__(name)
+                 tcpdump_path: str = '/usr/bin/tcpdump',
+                 capture_options: Optional[CaptureOptions] = None, stop_timeout: float = 1.0):
+        super(WiresharkRunner, self).__init__(name, stop_timeout=stop_timeout)
         self.pipename = pipename
+        self.clock = LocalClock()
         self.hostname = hostname
         self.port = port
 
         self.user = user
         self.tcpdump_path = tcpdump_path
         self.interface = interface
+        self.capture_options = capture_options or CaptureOptions()
+        self.remote_stats: Stats = {}
         if identityfile is None:
             if password is None:
                 raise AttributeError('Public key or password is not set!')
@@ -34,7 +48,7 @@ class SSHDumpRunner(WiresharkRunner):
     @property
     def args(self):
         cmd = ['/usr/lib/x86_64-linux-gnu/wireshark/extcap/sshdump', '--capture',
-               '--log-level', 'debug',
+               '--log-level', self.log_level,
                '--extcap-interface', 'ssh', '--fifo', self.pipename,
                '--remote-host', self.hostname, '--remote-port', str(self.port),
                '--remote-username', self.user]
@@ -43,29 +57,18 @@ class SSHDumpRunner(WiresharkRunner):
         else:
             cmd.extend(['--remote-password', self.password])
         cmd.extend(['--remote-capture-command',
-                    f'sudo {self.tcpdump_path} -i {self.interface} -U -w - -f not tcp port 22'])
+                    capture_command(self.tcpdump_path, self.interface, self.capture_options)])
         return cmd
 
-    @staticmethod
-    def parse_message(data: str) -> Dict:
-        parsed_message = {}
-        starpos = 0
-        endpos = len(data)
+    @property
+    def log_level(self) -> str:
+        level = self.logger.getEffectiveLevel()
+        return next((name for limit, name in SSHDUMP_LOG_LEVELS if level <= limit), 'critical')
 
-        for pattern in (process_timestamp, subsystem_level):
-            if match_obj := pattern.match(data[starpos:endpos]):
-                parsed_message.update(match_obj.groupdict())
-                starpos += match_obj.end()
-            else:
-                raise ParseMessageError(f'Failed to parse log message: "{data}"')
+    def handle_line(self, data: str, unparsed_level: int):
+        # Statistics of remote tcpdump are passed by sshdump among its own messages
+        parse_tcpdump_summary(data, self.remote_stats)
+        super().handle_line(data, unparsed_level)
 
-        if match_obj := filename_lineno_func_msg.match(data[starpos:endpos]):
-            parsed_message.update(match_obj.groupdict())
-        elif match_obj := only_message.match(data[starpos:endpos]):
-            parsed_message.update(match_obj.groupdict())
-            parsed_message.update({'filename': parsed_message['subsystem'],
-                                   'lineno': 0,
-                                   'function': parsed_message['subsystem']})
-        else:
-            raise ParseMessageError(f'Failed to parse log message: "{data}"')
-        return parsed_message
+    def stats(self) -> Stats:
+        return dict(self.remote_stats)
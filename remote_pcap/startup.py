@@ -0,0 +1,91 @@
+import os
+import sys
+import time
+from contextlib import contextmanager
+from threading import Lock
+from time import monotonic
+from typing import Generator, List, Optional, TextIO, Tuple
+
+# Imported by package before other modules of it
+IMPORTED_AT = monotonic()
+
+
+def process_started_at() -> Optional[float]:
+    # Start of interpreter process on monotonic clock, known only in Linux
+    try:
+        with open('/proc/self/stat', encoding='ascii') as stat_file:
+            # Command name may contain spaces, fields after it are counted from its end
+            start_ticks = int(stat_file.read().rpartition(')')[2].split()[19])
+        since_boot = time.clock_gettime(time.CLOCK_BOOTTIME)  # type: ignore[attr-defined]
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+    return monotonic() - (since_boot - start_ticks / os.sysconf('SC_CLK_TCK'))
+
+
+class StartupProfile():
+    # Wall time of startup phases, phases of several sources run at once and overlap
+
+    installed: Optional['StartupProfile'] = None
+
+    def __init__(self, output: TextIO = sys.stderr):
+        self.output = output
+        self.started_at = process_started_at() or IMPORTED_AT
+        self.phases: List[Tuple[str, float, float]] = []
+        self.expected_packets = 0
+        self.reported = False
+        self._lock = Lock()
+        if self.started_at < IMPORTED_AT:
+            self.add('interpreter', self.started_at, IMPORTED_AT)
+
+    @classmethod
+    def install(cls, **kwargs) -> 'StartupProfile':
+        cls.installed = cls(**kwargs)
+        return cls.installed
+
+    def add(self, name: str, started: float, finished: float):
+        with self._lock:
+            self.phases.append((name, started, finished))
+
+    def first_packet(self, name: str, started: float, finished: float):
+        # Profile is complete when each started capture received its first data
+        self.add(f'first packet {name}', started, finished)
+        with self._lock:
+            self.expected_packets -= 1
+            complete = self.expected_packets == 0
+        if complete:
+            self.report()
+
+    def report(self):
+        with self._lock:
+            if self.reported:
+                return
+            self.reported = True
+            phases = sorted(self.phases, key=lambda phase: phase[1])
+        lines = ['Startup profile, ms:', f'  {"phase":<40} {"start":>8} {"time":>8}']
+        for name, started, finished in phases:
+            lines.append(f'  {name:<40} {(started - self.started_at) * 1000:8.1f} '
+                         f'{(finished - started) * 1000:8.1f}')
+        if phases:
+            total = max(finished for _, _, finished in phases) - self.started_at
+            lines.append(f'  {"total":<40} {"":>8} {total * 1000:8.1f}')
+        self.output.write('\n'.join(lines) + '\n')
+        self.output.flush()
+
+
+@contextmanager
+def startup_phase(name: str) -> Generator[None, None, None]:
+    profile = StartupProfile.installed
+    if profile is None:
+        yield
+        return
+    started = monotonic()
+    try:
+        yield
+    finally:
+        profile.add(name, started, monotonic())
+
+
+def record_first_packet(name: str, started: float, finished: float):
+    profile = StartupProfile.installed
+    if profile is not None and not profile.reported:
+        profile.first_packet(name, started, finished)
@@ -1,21 +1,64 @@
 import logging
+from contextlib import ExitStack
+from functools import partial
 from pathlib import Path
 from threading import Event, Thread
-from typing import Union
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Union
 
-from .pipe_manager import Pipe
+from paramiko import SSHClient
+
+from .capture_writer import CaptureWriter, RotationOptions
+from .compression import StreamDecompressor
+from .connection import connect_client
+from .fanout import TeeSink
+from .flow_stats import FlowStatsOptions, FlowStatsSink
+from .log_pipeline import LogPipeline
+from .metrics import (MetricsOptions, MetricsPublisher, MetricsRegistry,
+                      RemoteInterfaceStats)
+from .pcap_merge import PcapMerger
+from .pipe_manager import FifoSink, Pipe
+from .rate_budget import BudgetOptions, RateBudgetSink
+from .reconnect import ReconnectingPump, ReconnectOptions
+from .remote_command import CaptureOptions, capture_command
 from .sngrep_runner import SngrepRunner
+from .spill_buffer import SpillBuffer
+from .ssh_pump import SSHPump
 from .sshdump_runner import SSHDumpRunner
 from .wireshark_runner import WiresharkRunner
 
 
-class ToolRunner(Thread):
+class CaptureSource(NamedTuple):
+    name: str
+    client: SSHClient
+    tcpdump_path: str
+    interface: str
+    options: CaptureOptions = CaptureOptions()
+    # Login values used to connect again when SSH session is lost
+    connection: Optional[Dict[str, Any]] = None
+
+
+class ToolRunner(Thread):  # pylint: disable=too-many-instance-attributes
+    # pylint: disable-next=too-many-arguments,too-many-positional-arguments,too-many-locals
     def __init__(self, name: str, hostname: str, port: Union[str, int], user: str, password: str,
-                 identityfile: Union[Path, str], interface: str, analyzer: str,
-                 tcpdump_path: str = '/usr/bin/tcpdump'):
+                 identityfile: Union[Path, str], interface: str,
+                 analyzer: Union[str, List[str]],
+                 tcpdump_path: str = '/usr/bin/tcpdump',
+                 capture_options: Optional[CaptureOptions] = None, transport: str = 'pump',
+                 client: Optional[SSHClient] = None,
+                 sources: Optional[List[CaptureSource]] = None,
+                 outputs: Optional[List[str]] = None,
+                 rotation: Optional[RotationOptions] = None,
+                 memory_buffer_size: int = 32 * 1024 * 1024,
+                 spill_size: int = 1024 * 1024 * 1024,
+                 stop_timeout: float = 1.0,
+                 metrics_options: Optional[MetricsOptions] = None,
+                 sip_ports: Sequence[int] = (),
+                 flow_stats: Optional[FlowStatsOptions] = None,
+                 budget: Optional[BudgetOptions] = None,
+                 reconnect: Optional[ReconnectOptions] = None):
         Thread.__init__(self, name=name, daemon=True)
         self.logger = logging.getLogger(name)
-        self.ssh_dump_kwargs = {
+        self.ssh_dump_kwargs: Dict[str, Any] = {
             'hostname': hostname,
             'port': port,
             'user': user,
@@ -29,34 +72,185 @@ class ToolRunner(Thread):
         else:
             raise AttributeError('Public key or password is not set!')
 
-        self.analyzer_type = analyzer
+        if transport == 'pump' and client is None:
+            raise AttributeError('Connected SSH client is required for pump transport')
+        self.capture_options = capture_options or CaptureOptions()
+        self.transport = transport
+        self.client = client
+        self.sources = sources or []
+        if self.sources and transport != 'pump':
+            raise AttributeError('Additional capture sources require pump transport')
+        self.analyzer_types = [analyzer] if isinstance(analyzer, str) else list(analyzer)
+        self.outputs = outputs or []
+        self.rotation = rotation or RotationOptions()
+        self.memory_buffer_size = memory_buffer_size
+        self.spill_size = spill_size
+        self.stop_timeout = stop_timeout
+        self.metrics_options = metrics_options or MetricsOptions()
+        self.sip_ports = sip_ports
+        self.flow_stats = flow_stats or FlowStatsOptions()
+        self.budget = budget or BudgetOptions()
+        self.reconnect = reconnect or ReconnectOptions()
+        pump_features = (self.outputs, self.flow_stats.enabled, self.budget.enabled,
+                         self.reconnect.enabled)
+        if transport == 'sshdump' and (len(self.analyzer_types) != 1 or any(pump_features)):
+            raise AttributeError('Capture to file, flow statistics, capture budget, reconnect or '
+                                 'several analyzers require pump transport')
+        if not self.analyzer_types and not self.outputs and not self.flow_stats.enabled:
+            raise AttributeError('Neither packet analyzer nor output file is set')
 
         self._need_stop = Event()
+        self._children_started = False
+        self.capture_failed = False
         self.dumper = None
-        self.analyzer = None
+        self.sinks: List = []
+        self.analyzers: List = []
+
+    def all_sources(self) -> List[CaptureSource]:
+        assert self.client is not None
+        connection = {key: self.ssh_dump_kwargs.get(key)
+                      for key in ('hostname', 'port', 'user', 'password', 'identityfile')}
+        primary = CaptureSource(f'{self.ssh_dump_kwargs["hostname"]}/'
+                                f'{self.ssh_dump_kwargs["interface"]}',
+                                self.client, self.ssh_dump_kwargs['tcpdump_path'],
+                                self.ssh_dump_kwargs['interface'], self.capture_options,
+                                connection)
+        return [primary] + self.sources
+
+    def create_dumper(self, sink):
+        if self.transport == 'pump':
+            sources = self.all_sources()
+            if len(sources) == 1:
+                return self.create_pump('dumper', sources[0], sink)
+            merger = PcapMerger('merger', sink=sink)
+            for source in sources:
+                merger.add_dumper(self.create_pump(f'dumper.{source.name}', source,
+                                                   merger.create_source(source.name)))
+            return merger
+        if self.transport == 'sshdump':
+            assert isinstance(sink, FifoSink)
+            return SSHDumpRunner('dumper', pipename=sink.fifo_path,
+                                 capture_options=self.capture_options,
+                                 stop_timeout=self.stop_timeout, **self.ssh_dump_kwargs)
+        raise AttributeError(f'Unknown capture transport: {self.transport}')
+
+    def create_pump(self, name: str, source: CaptureSource, sink):
+        if self.reconnect.enabled and source.connection is not None:
+            connect = partial(connect_client, timeout=self.reconnect.connect_timeout,
+                              **source.connection)
+            return ReconnectingPump(name, source.client, source.tcpdump_path, source.interface,
+                                    source.options, sink, connect, self.reconnect)
+        command = capture_command(source.tcpdump_path, source.interface, source.options)
+        decompressor = None
+        if source.options.compression != 'none':
+            decompressor = StreamDecompressor(source.options.compression)
+        return SSHPump(name, client=source.client, command=command, sink=sink,
+                       decompressor=decompressor)
+
+    def create_fifo_sink(self, analyzer_type: str, fifo_path: str):
+        fifo_sink = FifoSink(fifo_path, name=f'fifo.{analyzer_type}')
+        if self.transport != 'pump':
+            return fifo_sink
+        # Short analyzer stalls are absorbed locally instead of closing SSH window
+        return SpillBuffer(f'spill.{analyzer_type}', fifo_sink,
+                           memory_size=self.memory_buffer_size, spill_size=self.spill_size)
+
+    @staticmethod
+    def create_analyzer(analyzer_type: str, fifo_path: str):
+        if analyzer_type == 'wireshark':
+            return WiresharkRunner('wireshark', pipename=fifo_path)
+        if analyzer_type == 'sngrep':
+            return SngrepRunner('sngrep', pipename=fifo_path)
+        raise AttributeError(f'Unknown packet analyzer: {analyzer_type}')
 
     def run(self):
         self.logger.info('Starting ...')
 
-        with Pipe() as fifo_path:
-            self.dumper = SSHDumpRunner('dumper', pipename=fifo_path, **self.ssh_dump_kwargs)
+        with ExitStack() as stack:
+            fifo_paths = [stack.enter_context(Pipe()) for _ in self.analyzer_types]
+            sinks = [self.create_fifo_sink(analyzer_type, fifo_path)
+                     for analyzer_type, fifo_path in zip(self.analyzer_types, fifo_paths)]
+            sinks.extend(CaptureWriter(f'writer.{index}', output, sip_ports=self.sip_ports,
+                                       **self.rotation._asdict())
+                         for index, output in enumerate(self.outputs))
+            stages = list(sinks)
+            if self.budget.enabled and sinks:
+                # Analyzers and files get degraded stream, flow statistics see every packet
+                budgeted = sinks[0] if len(sinks) == 1 else TeeSink('tee.budget', sinks)
+                sinks = [RateBudgetSink('budget', budgeted, self.budget)]
+                stages.append(sinks[0])
+            if self.flow_stats.enabled:
+                sinks.append(FlowStatsSink('flows', self.flow_stats))
+                stages.append(sinks[-1])
+            self.sinks = stages
+            # One remote stream is shared by all consumers
+            sink = sinks[0] if len(sinks) == 1 else TeeSink('tee', sinks)
+
+            self.dumper = self.create_dumper(sink)
+            self.dumper.add_exit_callback(self.on_child_exit)
+            if self.metrics_options.enabled:
+                registry = self.create_metrics_registry(self.dumper, stages, sink)
+                publisher = MetricsPublisher('metrics', registry, **self.metrics_options._asdict())
+                publisher.start()
+                stack.callback(publisher.stop)
             self.dumper.run()
 
-            if self.analyzer_type == 'wireshark':
-                self.analyzer = WiresharkRunner('wireshark', pipename=fifo_path)
-            elif self.analyzer_type == 'sngrep':
-                self.analyzer = SngrepRunner('sngrep', pipename=fifo_path)
-            else:
-                raise AttributeError(f'Unknown packet analyzer: {self.analyzer_type}')
-            self.analyzer.run()
-
-            while self._need_stop.wait(1) is False:
-                if self.dumper.returncode is not None:
-                    self.stop()
-                if self.analyzer.returncode is not None:
-                    self.stop()
+            for analyzer_type, fifo_path in zip(self.analyzer_types, fifo_paths):
+                analyzer = self.create_analyzer(analyzer_type, fifo_path)
+                analyzer.add_exit_callback(self.on_child_exit)
+                analyzer.run()
+                self.analyzers.append(analyzer)
+
+            self._children_started = True
+            # Child which exited before all of them were started is checked here
+            self.on_child_exit()
+            self._need_stop.wait()
             self.dumper.stop()
-            # self.analyzer.stop()
+
+    def create_metrics_registry(self, dumper, sinks: List, sink) -> MetricsRegistry:
+        registry = MetricsRegistry()
+        registry.register(dumper.name, dumper.stats)
+        if (pipeline := LogPipeline.installed) is not None:
+            registry.register('logging', pipeline.stats)
+        if self.transport != 'pump':
+            # sshdump writes FIFO itself, only remote statistics are known
+            return registry
+
+        pumps = [dumper]
+        if isinstance(dumper, PcapMerger):
+            pumps = dumper.dumpers
+            for source_dumper in dumper.dumpers:
+                registry.register(source_dumper.name, source_dumper.stats)
+        # Pump of each source holds client of its current SSH session
+        for source, pump in zip(self.all_sources(), pumps):
+            interface_stats = RemoteInterfaceStats(f'remote.{source.name}',
+                                                   partial(getattr, pump, 'client'),
+                                                   source.interface)
+            registry.register(interface_stats.name, interface_stats.stats)
+        tees = [sink] + [stage.sink for stage in sinks if isinstance(stage, RateBudgetSink)]
+        for tee in tees:
+            if isinstance(tee, TeeSink):
+                for consumer in tee.consumers:
+                    registry.register(consumer.name, consumer.stats)
+        for stage in sinks:
+            registry.register(stage.name, stage.stats)
+            if isinstance(stage, SpillBuffer):
+                registry.register(stage.sink.name, stage.sink.stats)
+        return registry
+
+    def on_child_exit(self):
+        # Called from reactor or dumper thread as soon as child exits, no polling needed
+        if not self._children_started or self._need_stop.is_set():
+            return
+        if (returncode := self.dumper.returncode) is not None:
+            self.logger.info(f'Dumper exited with exitcode {returncode}')
+            self.capture_failed = returncode != 0
+            self.stop()
+        # Headless capture to disk runs until remote side or user stops it
+        elif self.analyzers and all(analyzer.returncode is not None
+                                    for analyzer in self.analyzers):
+            self.logger.info('All packet analyzers exited')
+            self.stop()
 
     def stop(self):
         self.logger.info('Stoping ...')
@@ -0,0 +1,24 @@
+import re
+
+SIZE_SUFFIXES = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+size_pattern = re.compile(r'(?P<value>\d+(\.\d+)?)\s*(?P<suffix>[KMGT]?)(i?B)?', re.IGNORECASE)
+
+
+def parse_size(value: str) -> int:
+    if match_obj := size_pattern.fullmatch(value.strip()):
+        return int(float(match_obj['value']) * SIZE_SUFFIXES[match_obj['suffix'].upper()])
+    raise ValueError(f'Invalid size: {value!r}')
+
+
+RATE_SUFFIXES = {'': 1, 'K': 1000, 'M': 1000 ** 2, 'G': 1000 ** 3, 'T': 1000 ** 4}
+
+rate_pattern = re.compile(r'(?P<value>\d+(\.\d+)?)\s*(?P<suffix>[KMGT]?)(bit|bps)?(/s)?',
+                          re.IGNORECASE)
+
+
+def parse_rate(value: str) -> int:
+    # Bits per second with decimal suffixes, like 50Mbit or 1.5G
+    if match_obj := rate_pattern.fullmatch(value.strip()):
+        return int(float(match_obj['value']) * RATE_SUFFIXES[match_obj['suffix'].upper()])
+    raise ValueError(f'Invalid rate: {value!r}')
@@ -1,17 +1,17 @@
 import logging
-from time import localtime, mktime, struct_time
-from typing import Dict
 
-from .exceptions import ConvertLogLevelError, ParseMessageError
-from .log_patterns import (filename_lineno_func_msg, level_without_subsystem,
-                           only_message, process_timestamp, subsystem_level)
+from .log_parser import SKIPPED_LINE, LocalClock, LogLine, LogLineParser
 from .process_runner import ProcessRunner
 
 
 class WiresharkRunner(ProcessRunner):
+
+    log_parser = LogLineParser(no_subsystem_name='wireshark')
+
     def __init__(self, name, pipename):
         super().__init__(name)
         self.pipename = pipename
+        self.clock = LocalClock()
 
     @property
     def args(self):
@@ -19,87 +19,30 @@ class WiresharkRunner(ProcessRunner):
                 '--interface', self.pipename]
 
     def handle_stdout(self, data: str):
-        try:
-            record = self.message_to_logrecord(data)
-            self.logger.handle(record)
-        except ParseMessageError:
-            self.logger.debug(data)
+        self.handle_line(data, logging.DEBUG)
 
     def handle_stderr(self, data: str):
-        try:
-            record = self.message_to_logrecord(data)
-            self.logger.handle(record)
-        except (ParseMessageError, ConvertLogLevelError):
-            self.logger.error(data)
-
-    @staticmethod
-    def parse_message(data: str) -> Dict:
-        parsed_message = {}
-        starpos = 0
-        endpos = len(data)
-
-        if match_obj := process_timestamp.match(data[starpos:endpos]):
-            parsed_message.update(match_obj.groupdict())
-            starpos += match_obj.end()
-        else:
-            raise ParseMessageError(f'Failed to parse log message: "{data}"')
-
-        if match_obj := subsystem_level.match(data[starpos:endpos]):
-            parsed_message.update(match_obj.groupdict())
-            starpos += match_obj.end()
-        elif match_obj := level_without_subsystem.match(data[starpos:endpos]):
-            parsed_message.update(match_obj.groupdict())
-            parsed_message['subsystem'] = 'wireshark'
-            starpos += match_obj.end()
-        else:
-            raise ParseMessageError(f'Failed to parse log message: "{data}"')
+        self.handle_line(data, logging.ERROR)
 
-        if match_obj := filename_lineno_func_msg.match(data[starpos:endpos]):
-            parsed_message.update(match_obj.groupdict())
-        elif match_obj := only_message.match(data[starpos:endpos]):
-            parsed_message.update(match_obj.groupdict())
-            parsed_message.update({'filename': parsed_message['subsystem'],
-                                   'lineno': 0,
-                                   'function': parsed_message['subsystem']})
-        else:
-            raise ParseMessageError(f'Failed to parse log message: "{data}"')
+    def handle_line(self, data: str, unparsed_level: int):
+        # Level is known right after line header, rest of filtered line is not parsed
+        line = self.log_parser.parse(data, self.logger.getEffectiveLevel())
+        if line is None:
+            self.logger.log(unparsed_level, data)
+        elif line is not SKIPPED_LINE:
+            self.logger.handle(self.make_logrecord(line))
 
-        return parsed_message
-
-    def message_to_logrecord(self, data: str) -> logging.LogRecord:
-        current = localtime()
-        details = self.parse_message(data)
+    def make_logrecord(self, line: LogLine) -> logging.LogRecord:
         record = self.logger.makeRecord(name=self.logger.name,
-                                        level=self.convert_loglevel(details['level']),
-                                        fn=details['filename'],
-                                        lno=int(details['lineno']),
-                                        msg=f'{details["subsystem"]} -- {details["message"]}',
-                                        args=None,
+                                        level=line.level,
+                                        fn=line.filename,
+                                        lno=line.lineno,
+                                        msg=f'{line.subsystem} -- {line.message}',
+                                        args=(),
                                         exc_info=None,
-                                        func=details['function'])
-        record.created = mktime(struct_time((current.tm_year,
-                                             current.tm_mon,
-                                             current.tm_mday,
-                                             int(details['hour']),
-                                             int(details['mins']),
-                                             int(details['secs']),
-                                             current.tm_wday,
-                                             current.tm_yday,
-                                             current.tm_isdst,
-                                             current.tm_zone,
-                                             current.tm_gmtoff)))
-        record.msecs = int(details['microsecs']) // 1000
+                                        func=line.function)
+        # Rate limit and duplicate suppression of log pipeline apply per subsystem
+        record.subsystem = line.subsystem
+        record.created = self.clock.timestamp(line.clock) + line.microsecs / 1_000_000
+        record.msecs = line.microsecs // 1000
         return record
-
-    @staticmethod
-    def convert_loglevel(level: str) -> int:
-        if level == 'NONE':
-            return logging.NOTSET
-
-        if level in ('ERROR', 'CRITICAL', 'WARNING', 'INFO', 'DEBUG'):
-            return getattr(logging, level)
-
-        if level in ('MESSAGE', 'NOISY'):
-            return logging.DEBUG
-
-        raise ConvertLogLevelError(f'Unknown log level: {level}')
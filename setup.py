@@ -11,6 +11,13 @@ setup(
     url="https://github.com/itorayn/remote_pcap",
     python_requires=">=3.8",
     install_requires=["paramiko >= 2.5.0"],
+    extras_require={
+        'zstd': ["zstandard >= 0.15"],
+        'lz4': ["lz4 >= 3.1"],
+        'numpy': ["numpy >= 1.20"],
+        'yaml': ["PyYAML >= 5.1"],
+        'toml': ["tomli >= 1.1; python_version < '3.11'"],
+    },
     entry_points={
         'console_scripts': [
             'remote_pcap = remote_pcap:run_tool_runner',